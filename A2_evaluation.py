@@ -1,9 +1,30 @@
+"""
+Run evaluation.json against the RAG API.
+
+Questions are sent concurrently (asyncio + httpx) with a configurable number
+of requests in flight and an optional target request rate. Each result
+records its wall time and the server's stage timings (Server-Timing header);
+the latency distribution and throughput are written to
+evaluation_latency.json next to evaluation_results.json.
+
+    python A2_evaluation.py                          # 4 in flight, no rate cap
+    python A2_evaluation.py --concurrency 8 --rate 2 # at most 2 requests/s
+"""
+
+import argparse
+import asyncio
 import json
-import requests
 import time
-from datetime import datetime
+
+import httpx
+import requests
+
+from bench_common import stage_summary, summarize
+from timing import parse_server_timing
 
 API_URL = "http://localhost:8002"
+RESULTS_PATH = "evaluation_results.json"
+LATENCY_PATH = "evaluation_latency.json"
 
 
 def test_api():
@@ -14,62 +35,115 @@ def test_api():
         return False
 
 
-def run_evaluation():
-    if not test_api():
-        print("ERROR: API not responding. Start Docker: docker-compose up")
-        return
-
-    with open('evaluation.json', 'r', encoding='utf-8') as f:
-        questions = json.load(f)
-
-    print(f"Running {len(questions)} queries...")
-    print("=" * 60)
-
-    results = []
-
-    for i, q in enumerate(questions, 1):
-        print(f"[{i}/{len(questions)}] {q['question'][:50]}...")
+async def ask(client, semaphore, start_at, i, q, total, k):
+    """Send one question no earlier than `start_at`; return its result row."""
+    delay = start_at - time.perf_counter()
+    if delay > 0:
+        await asyncio.sleep(delay)
 
+    async with semaphore:
+        t0 = time.perf_counter()
         try:
-            response = requests.post(
+            response = await client.post(
                 f"{API_URL}/query",
-                json={"query": q["question"],
-                      "top_k": 5, "include_sources": True},
-                timeout=30
+                json={"query": q["question"], "k": k},
             )
-
+            latency = time.perf_counter() - t0
+            response.raise_for_status()
             data = response.json()
 
-            results.append({
+            print(f"[{i}/{total}] OK {latency * 1000:.0f} ms  {q['question'][:50]}")
+            return {
                 "question_number": i,
                 "question": q["question"],
                 "question_type": q.get("question_type", "factual"),
                 "ideal_answer": q["ideal_answer"],
                 "generated_answer": data["answer"],
                 "sources": data.get("sources", []),
+                "latency_ms": round(latency * 1000, 2),
+                "server_timings_ms": parse_server_timing(
+                    response.headers.get("Server-Timing", "")),
                 "success": True
-            })
-
-            print(f"  OK ({len(data['answer'])} chars)")
+            }
 
         except Exception as e:
-            print(f"  FAILED: {e}")
-            results.append({
+            latency = time.perf_counter() - t0
+            print(f"[{i}/{total}] FAILED: {e}")
+            return {
                 "question_number": i,
                 "question": q["question"],
                 "error": str(e),
+                "latency_ms": round(latency * 1000, 2),
                 "success": False
-            })
+            }
+
+
+def latency_report(results, wall_time, concurrency, rate):
+    """Latency percentiles, throughput and per-stage server timings."""
+    ok = [r for r in results if r["success"]]
+    report = {
+        "concurrency": concurrency,
+        "target_rate_rps": rate or None,
+        "successful": len(ok),
+        "failed": len(results) - len(ok),
+        **summarize([r["latency_ms"] / 1000 for r in ok], wall_time),
+        "server_stages_ms": stage_summary([r["server_timings_ms"] for r in ok]),
+    }
+    return report
+
+
+async def run_async(questions, concurrency, rate, k, timeout):
+    semaphore = asyncio.Semaphore(concurrency)
+    interval = 1.0 / rate if rate else 0.0
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+
+    async with httpx.AsyncClient(timeout=timeout, limits=limits) as client:
+        start = time.perf_counter()
+        results = await asyncio.gather(*[
+            ask(client, semaphore, start + n * interval, n + 1, q, len(questions), k)
+            for n, q in enumerate(questions)
+        ])
+        wall_time = time.perf_counter() - start
+    return list(results), wall_time
+
+
+def run_evaluation(concurrency=4, rate=0.0, k=5, timeout=120.0):
+    if not test_api():
+        print("ERROR: API not responding. Start Docker: docker-compose up")
+        return
 
-        time.sleep(1)
+    with open('evaluation.json', 'r', encoding='utf-8') as f:
+        questions = json.load(f)
 
-    with open('evaluation_results.json', 'w', encoding='utf-8') as f:
+    print(f"Running {len(questions)} queries "
+          f"(concurrency {concurrency}, rate {rate or 'unlimited'} req/s)...")
+    print("=" * 60)
+
+    results, wall_time = asyncio.run(run_async(questions, concurrency, rate, k, timeout))
+
+    with open(RESULTS_PATH, 'w', encoding='utf-8') as f:
         json.dump(results, f, indent=2, ensure_ascii=False)
 
+    report = latency_report(results, wall_time, concurrency, rate)
+    with open(LATENCY_PATH, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2)
+
     print("\n" + "=" * 60)
-    print(f"Results saved to evaluation_results.json")
-    print(f"Success: {sum(1 for r in results if r['success'])}/{len(results)}")
+    print(f"Results saved to {RESULTS_PATH}, latency to {LATENCY_PATH}")
+    print(f"Success: {report['successful']}/{len(results)}")
+    print(f"Wall time: {wall_time:.1f}s  throughput: {report['throughput_rps']} req/s")
+    print(f"Latency p50/p95/p99: {report['p50_ms']} / {report['p95_ms']} / {report['p99_ms']} ms")
 
 
 if __name__ == "__main__":
-    run_evaluation()
+    parser = argparse.ArgumentParser(description="Evaluate the RAG API on evaluation.json")
+    parser.add_argument("--concurrency", type=int, default=4, help="requests in flight")
+    parser.add_argument("--rate", type=float, default=0.0,
+                        help="target requests/second (0 = as fast as concurrency allows)")
+    parser.add_argument("--k", type=int, default=5)
+    parser.add_argument("--timeout", type=float, default=120.0, help="per-request timeout (s)")
+    parser.add_argument("--api-url", default=API_URL)
+    args = parser.parse_args()
+
+    API_URL = args.api_url
+    run_evaluation(args.concurrency, args.rate, args.k, args.timeout)
@@ -1,6 +1,9 @@
 import json
+import os
 from datetime import datetime
 
+LATENCY_PATH = "evaluation_latency.json"
+
 
 def calculate_score(ideal, generated):
     """Simple evaluation: keyword overlap"""
@@ -15,6 +18,43 @@ def calculate_score(ideal, generated):
     return min(score, 1.0)
 
 
+def latency_section():
+    """Markdown for the latency/throughput written by A2_evaluation.py, if any."""
+    if not os.path.exists(LATENCY_PATH):
+        return ""
+    with open(LATENCY_PATH, 'r', encoding='utf-8') as f:
+        lat = json.load(f)
+
+    rate = lat.get("target_rate_rps") or "unlimited"
+
+    def ms(key):
+        # None when no request succeeded
+        return "n/a" if lat.get(key) is None else f"{lat[key]:.0f} ms"
+
+    section = f"""## Latency & Throughput
+
+Concurrency {lat['concurrency']}, target rate {rate} req/s.
+
+| Metric | Value |
+|--------|-------|
+| Wall Time | {lat['wall_s']:.1f} s |
+| Throughput | {lat['throughput_rps']} req/s |
+| Mean Latency | {ms('mean_ms')} |
+| p50 Latency | {ms('p50_ms')} |
+| p95 Latency | {ms('p95_ms')} |
+| p99 Latency | {ms('p99_ms')} |
+
+"""
+    stages = lat.get("server_stages_ms") or {}
+    if stages:
+        section += "Server stage timings (ms, from the Server-Timing header):\n\n"
+        section += "| Stage | Mean | p50 | p95 | p99 |\n|-------|------|-----|-----|-----|\n"
+        for stage, t in stages.items():
+            section += f"| {stage} | {t['mean']:.1f} | {t['p50']:.1f} | {t['p95']:.1f} | {t['p99']:.1f} |\n"
+        section += "\n"
+    return section
+
+
 def evaluate_results():
     with open('evaluation_results.json', 'r', encoding='utf-8') as f:
         results = json.load(f)
@@ -52,7 +92,10 @@ def evaluate_results():
 | Average Score | {avg_score:.3f} |
 | Average Answer Length | {avg_length:.0f} chars |
 
-## Performance by Type
+"""
+
+    report += latency_section()
+    report += """## Performance by Type
 
 """
 
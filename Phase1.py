@@ -1,47 +1,216 @@
+"""
+Phase1: Re-stitch speaker chunks into clean scene chunks.
+
+Streams the input: each scene is written as soon as its run of speaker
+chunks ends, so memory holds one scene at a time regardless of corpus size.
+If a scene's chunks are not contiguous in the input, falls back to an
+external merge sort (bounded-size sorted runs on disk) that keeps scenes in
+order of first appearance and chunks in input order.
+
+Usage:
+    python Phase1.py                                   # Julius Caesar defaults
+    python Phase1.py plays/ -o all_scene_chunks.jsonl  # every *.jsonl in a directory
+    python Phase1.py hamlet.jsonl macbeth.jsonl -o out.jsonl
+
+With several input files, chunks without a "play" field take the file name
+as their play so that Act 1 Scene 1 of different plays stays separate.
+"""
+
+import argparse
+import heapq
 import json
-from collections import defaultdict
+import os
+import tempfile
 
 SPEAKER_CHUNKS_PATH = "julius_caesar_speaker_chunks.jsonl"
 CLEAN_SCENE_CHUNKS_PATH = "julius_caesar_scene_chunks_CLEAN.jsonl"
+DEFAULT_RUN_SIZE = 50_000
+
+
+class NotGrouped(Exception):
+    """A scene's speaker chunks reappear after another scene started."""
+
+
+def expand_inputs(paths):
+    """Resolve files and directories (all *.jsonl inside, sorted) to file paths."""
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(
+                os.path.join(path, name) for name in sorted(os.listdir(path))
+                if name.endswith(".jsonl")
+            )
+        elif os.path.exists(path):
+            files.append(path)
+        else:
+            raise FileNotFoundError(path)
+    return files
+
+
+def iter_chunks(files):
+    """Yield speaker chunks from every file, tagging a play when ambiguous."""
+    tag_play = len(files) > 1
+    for path in files:
+        play_name = os.path.splitext(os.path.basename(path))[0]
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                chunk = json.loads(line)
+                if tag_play and "play" not in chunk:
+                    chunk["play"] = play_name
+                yield chunk
+
+
+def scene_key(chunk):
+    return (chunk.get('play'), chunk['act'], chunk['scene'])
+
+
+def chunk_text(chunk):
+    if chunk['speaker'] == "NARRATOR":
+        return chunk['text']
+    return f"{chunk['speaker']}:\n{chunk['text']}"
+
+
+def make_scene(key, text_list, speakers):
+    play, act, scene = key
+    new_chunk = {}
+    if play is not None:
+        new_chunk["play"] = play
+    new_chunk.update({
+        "act": act,
+        "scene": scene,
+        # Everyone who speaks in the scene, in order of first line (for filters)
+        "speakers": speakers,
+        # Join all dialogue from that scene with newlines
+        "text": "\n\n".join(text_list)
+    })
+    return new_chunk
 
-print("Starting: Re-stitching speaker chunks into clean scene chunks...")
 
-try:
-    scene_data = defaultdict(list)
+def stitch(chunks, strict=True):
+    """Yield one scene per contiguous run of speaker chunks.
 
-    with open(SPEAKER_CHUNKS_PATH, 'r', encoding='utf-8') as f:
-        for line in f:
-            chunk = json.loads(line)
-            scene_key = (chunk['act'], chunk['scene'])
+    With strict=True, raise NotGrouped if a finished scene shows up again.
+    """
+    finished = set()
+    current_key, text_list, speakers = None, [], {}
 
-            if chunk['speaker'] == "NARRATOR":
-                scene_data[scene_key].append(chunk['text'])
-            else:
-                scene_data[scene_key].append(f"{chunk['speaker']}:\n{chunk['text']}")
+    for chunk in chunks:
+        key = scene_key(chunk)
+        if key != current_key:
+            if current_key is not None:
+                finished.add(current_key)
+                yield make_scene(current_key, text_list, list(speakers))
+            if strict and key in finished:
+                raise NotGrouped(key)
+            current_key, text_list, speakers = key, [], {}
+        text_list.append(chunk_text(chunk))
+        if chunk['speaker'] != "NARRATOR":
+            speakers[chunk['speaker']] = None
 
-    print(f"Read and grouped {len(scene_data)} scenes from speaker chunks.")
+    if current_key is not None:
+        yield make_scene(current_key, text_list, list(speakers))
 
-    with open(CLEAN_SCENE_CHUNKS_PATH, 'w', encoding='utf-8') as f:
-        for (act, scene), text_list in scene_data.items():
-            # Join all dialogue from that scene with newlines
-            full_scene_text = "\n\n".join(text_list)
 
-            new_chunk = {
-                "act": act,
-                "scene": scene,
-                "text": full_scene_text
-            }
+def external_sort(chunks, run_size, tmp_dir):
+    """Yield chunks grouped by scene using sorted runs spilled to disk.
+
+    Scenes keep their order of first appearance; chunks keep input order.
+    """
+    scene_rank = {}
+    run_paths = []
+    buffer = []
+
+    def spill():
+        buffer.sort(key=lambda item: item[0])
+        fd, path = tempfile.mkstemp(suffix=".jsonl", dir=tmp_dir)
+        with os.fdopen(fd, 'w', encoding='utf-8') as out:
+            for sort_key, chunk in buffer:
+                out.write(json.dumps([sort_key, chunk]) + '\n')
+        run_paths.append(path)
+        buffer.clear()
+
+    for seq, chunk in enumerate(chunks):
+        rank = scene_rank.setdefault(scene_key(chunk), len(scene_rank))
+        buffer.append(((rank, seq), chunk))
+        if len(buffer) >= run_size:
+            spill()
+    if buffer:
+        spill()
+
+    print(f"Input not grouped by scene: merging {len(run_paths)} sorted run(s) "
+          f"for {len(scene_rank)} scenes.")
+
+    run_files = [open(path, 'r', encoding='utf-8') for path in run_paths]
+    try:
+        runs = [(json.loads(line) for line in f) for f in run_files]
+        for _, chunk in heapq.merge(*runs, key=lambda item: item[0]):
+            yield chunk
+    finally:
+        for f in run_files:
+            f.close()
+        for path in run_paths:
+            os.remove(path)
+
+
+def write_scenes(scenes, path):
+    count = 0
+    with open(path, 'w', encoding='utf-8') as f:
+        for new_chunk in scenes:
             f.write(json.dumps(new_chunk) + '\n')
+            count += 1
+    return count
+
+
+def stitch_files(inputs, output, run_size=DEFAULT_RUN_SIZE):
+    """Stream-stitch `inputs` into `output`; returns the number of scenes."""
+    files = expand_inputs(inputs)
+    out_dir = os.path.dirname(os.path.abspath(output))
+    fd, tmp_output = tempfile.mkstemp(suffix=".jsonl", dir=out_dir)
+    os.close(fd)
+
+    try:
+        try:
+            count = write_scenes(stitch(iter_chunks(files)), tmp_output)
+        except NotGrouped:
+            grouped = external_sort(iter_chunks(files), run_size, out_dir)
+            count = write_scenes(stitch(grouped, strict=False), tmp_output)
+        os.replace(tmp_output, output)
+    finally:
+        if os.path.exists(tmp_output):
+            os.remove(tmp_output)
+
+    print(f"Stitched {count} scenes from {len(files)} file(s).")
+    return count
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Stitch speaker chunks into scene chunks")
+    parser.add_argument("inputs", nargs="*", default=[SPEAKER_CHUNKS_PATH],
+                        help="speaker-chunk .jsonl files or directories of them")
+    parser.add_argument("-o", "--output", default=CLEAN_SCENE_CHUNKS_PATH)
+    parser.add_argument("--run-size", type=int, default=DEFAULT_RUN_SIZE,
+                        help="chunks per sorted run when falling back to external sort")
+    args = parser.parse_args()
+
+    print("Starting: Re-stitching speaker chunks into clean scene chunks...")
+
+    try:
+        stitch_files(args.inputs, args.output, run_size=args.run_size)
+
+        print(f"SUCCESS: Created clean scene file at '{args.output}'")
 
-    print(f"SUCCESS: Created clean scene file at '{CLEAN_SCENE_CHUNKS_PATH}'")
+        # Print a sample from the new file
+        with open(args.output, 'r', encoding='utf-8') as f:
+            first_scene = json.loads(f.readline())
+            print(json.dumps(first_scene, indent=2))
 
-    # Print a sample from the new file
-    with open(CLEAN_SCENE_CHUNKS_PATH, 'r', encoding='utf-8') as f:
-        first_scene = json.loads(f.readline())
-        print(json.dumps(first_scene, indent=2))
+    except FileNotFoundError as e:
+        print(f"ERROR: Could not find {e}")
+    except Exception as e:
+        print(f"An error occurred: {e}")
 
 
-except FileNotFoundError:
-    print(f"ERROR: Could not find {SPEAKER_CHUNKS_PATH}")
-except Exception as e:
-    print(f"An error occurred: {e}")
\ No newline at end of file
+if __name__ == "__main__":
+    main()
@@ -1,64 +1,367 @@
-from sentence_transformers import SentenceTransformer
 import chromadb
+import argparse
+import hashlib
 import json
+import multiprocessing
 import os
+import time
+from collections import defaultdict
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
 
-MODEL_NAME = "all-MiniLM-L6-v2"
+from embedding import embedder_settings, load_embedder
+from lexical_index import LEXICAL_INDEX_FILE, BM25Index
+from retrieval import speaker_flag
+from Phase1 import chunk_text, iter_chunks as iter_speaker_chunks
+
+MODEL_NAME = os.environ.get("EMBED_MODEL", "all-MiniLM-L6-v2")
 COLLECTION_NAME = "julius_caesar_scenes_clean"
 DB_PATH = "chroma_db_scenes_clean"
 DATA_PATH = "julius_caesar_scene_chunks_CLEAN.jsonl"
 
+# Second, speech-level index built from Phase1's per-speaker chunks
+SPEECH_COLLECTION_NAME = "julius_caesar_speeches"
+SPEAKER_DATA_PATH = "julius_caesar_speaker_chunks.jsonl"
+
+# BM25 index over the same scene chunks, saved inside the DB directory
+LEXICAL_INDEX_PATH = os.path.join(DB_PATH, LEXICAL_INDEX_FILE)
+
+
+def as_number(value):
+    """Store numeric acts/scenes as ints so range filters ($gte/$lte) work."""
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return value
 
-def load_chunks(path):
+
+def iter_chunks(path):
+    """Yield (doc_id, text, metadata) for each scene chunk, one line at a time."""
     if not os.path.exists(path):
         raise FileNotFoundError(f"Missing input file: {path}")
 
-    docs, metas, ids = [], [], []
-
     with open(path, "r", encoding="utf-8") as f:
         for line in f:
             chunk = json.loads(line)
             doc_id = f"act_{chunk['act']}_scene_{chunk['scene']}"
+            meta = {"act": as_number(chunk["act"]), "scene": as_number(chunk["scene"])}
+            # Phase1 lists the scene's speakers; older scene files lack them
+            for speaker in chunk.get("speakers", []):
+                meta[speaker_flag(speaker)] = True
+            # Multi-play corpora from Phase1 tag each scene with its play
+            if chunk.get("play"):
+                doc_id = f"{chunk['play']}_{doc_id}"
+                meta["play"] = chunk["play"]
+
+            yield doc_id, chunk["text"], meta
+
+
+def iter_speeches(path):
+    """Yield (doc_id, text, metadata) for each speech, linked to its act/scene.
+
+    `position` is the speech's index within its scene, so retrieved speeches
+    can be put back in play order.
+    """
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"Missing input file: {path}")
+
+    positions = defaultdict(int)
+    for chunk in iter_speaker_chunks([path]):
+        key = (chunk.get("play"), chunk["act"], chunk["scene"])
+        position = positions[key]
+        positions[key] += 1
+
+        doc_id = f"act_{chunk['act']}_scene_{chunk['scene']}_speech_{position}"
+        meta = {
+            "act": as_number(chunk["act"]),
+            "scene": as_number(chunk["scene"]),
+            "speaker": chunk["speaker"].strip().upper(),
+            "position": position,
+        }
+        if chunk.get("play"):
+            doc_id = f"{chunk['play']}_{doc_id}"
+            meta["play"] = chunk["play"]
 
-            ids.append(doc_id)
-            docs.append(chunk["text"])
-            metas.append({"act": chunk["act"], "scene": chunk["scene"]})
+        yield doc_id, chunk_text(chunk), meta
 
-    print(f"Loaded {len(docs)} scene chunks.")
+
+def load_chunks(path, source=iter_chunks):
+    docs, metas, ids = [], [], []
+
+    for doc_id, doc, meta in source(path):
+        ids.append(doc_id)
+        docs.append(doc)
+        metas.append(meta)
+
+    print(f"Loaded {len(docs)} chunks from {path}.")
     return docs, metas, ids
 
 
-def build_db(docs, metas, ids):
-    print("Loading embedder...")
-    model = SentenceTransformer(MODEL_NAME)
+def content_hash(doc, meta, embedder=None):
+    """Hash of everything that affects a chunk's stored vector and row.
+
+    `embedder` is embedder_settings(); rows embedded with another backend or
+    quantization hash differently and are re-embedded. The default torch
+    backend is left out, so hashes written before backends existed still match.
+    """
+    fields = {"model": MODEL_NAME, "text": doc, "metadata": meta}
+    embedder = embedder or embedder_settings()
+    if embedder != {"backend": "torch"}:
+        fields["embedder"] = embedder
+    payload = json.dumps(fields, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def plan_sync(collection, ids, hashes, full=False):
+    """Compare input chunks with the collection by content hash.
+
+    Returns (indices to embed and upsert, ids to delete, counts).
+    """
+    existing = collection.get(include=["metadatas"])
+    stored = {
+        doc_id: (meta or {}).get("content_hash")
+        for doc_id, meta in zip(existing["ids"], existing["metadatas"])
+    }
 
-    print(f"Creating persistent Chroma DB → {DB_PATH}")
+    to_upsert = []
+    counts = {"added": 0, "updated": 0, "removed": 0, "skipped": 0}
+    for i, doc_id in enumerate(ids):
+        if doc_id not in stored:
+            counts["added"] += 1
+        elif full or stored[doc_id] != hashes[i]:
+            counts["updated"] += 1
+        else:
+            counts["skipped"] += 1
+            continue
+        to_upsert.append(i)
+
+    removed = sorted(set(stored) - set(ids))
+    counts["removed"] = len(removed)
+    return to_upsert, removed, counts
+
+
+def open_collection(name=COLLECTION_NAME):
+    print(f"Creating persistent Chroma DB → {DB_PATH} (collection: {name})")
     # Use PersistentClient instead of Client with Settings
     client = chromadb.PersistentClient(path=DB_PATH)
 
-    collection = client.get_or_create_collection(
-        name=COLLECTION_NAME,
+    return client.get_or_create_collection(
+        name=name,
         metadata={"hnsw:space": "cosine"}
     )
 
-    print("Encoding documents...")
-    embeddings = model.encode(docs, convert_to_numpy=True)
 
-    print("Upserting...")
-    collection.upsert(
-        ids=ids,
-        documents=docs,
-        embeddings=embeddings.tolist(),  # Convert to list for ChromaDB
-        metadatas=metas
-    )
+def print_sync_counts(counts):
+    print("Sync: {added} added, {updated} updated, {removed} removed, "
+          "{skipped} unchanged (skipped)".format(**counts))
+
+
+def build_db(docs, metas, ids, full=False, collection_name=COLLECTION_NAME):
+    """Bring the collection in line with the input chunks.
+
+    Only new or changed chunks (by content hash) are embedded and upserted;
+    chunks no longer present in the input are deleted. `full=True` re-embeds
+    everything.
+    """
+    collection = open_collection(collection_name)
 
+    embedder = embedder_settings()
+    metas = [dict(meta, content_hash=content_hash(doc, meta, embedder))
+             for doc, meta in zip(docs, metas)]
+    hashes = [meta["content_hash"] for meta in metas]
+    to_upsert, removed, counts = plan_sync(collection, ids, hashes, full=full)
+
+    if removed:
+        print(f"Deleting {len(removed)} stale chunks...")
+        collection.delete(ids=removed)
+
+    if to_upsert:
+        print("Loading embedder...")
+        model = load_embedder(MODEL_NAME)
+
+        print(f"Encoding {len(to_upsert)} new/changed documents...")
+        batch_docs = [docs[i] for i in to_upsert]
+        embeddings = model.encode(batch_docs, convert_to_numpy=True)
+
+        print("Upserting...")
+        collection.upsert(
+            ids=[ids[i] for i in to_upsert],
+            documents=batch_docs,
+            embeddings=embeddings.tolist(),  # Convert to list for ChromaDB
+            metadatas=[metas[i] for i in to_upsert]
+        )
+    else:
+        print("Nothing to embed; collection is up to date.")
+
+    print_sync_counts(counts)
+    print("✔ DB saved.")
+    return collection
+
+
+# ======== Pipelined ingest ========
+_worker_model = None
+
+
+def _init_encode_worker(model_name, threads):
+    """Process-pool initializer: load the embedder once per worker."""
+    global _worker_model
+    try:
+        import torch
+        torch.set_num_threads(threads)
+    except ImportError:
+        pass
+    _worker_model = load_embedder(model_name)
+
+
+def _encode_batch(docs):
+    t0 = time.perf_counter()
+    embeddings = _worker_model.encode(docs, convert_to_numpy=True)
+    return embeddings, time.perf_counter() - t0
+
+
+def build_db_pipelined(source, batch_size=64, workers=2, full=False,
+                       collection_name=COLLECTION_NAME):
+    """Incremental sync that streams chunks through a process pool.
+
+    Pass 1 reads the input once to hash every chunk (ids and hashes only).
+    Pass 2 re-reads it in batches of `batch_size` new/changed chunks, encodes
+    batches on `workers` processes and upserts each finished batch from the
+    main process while the next ones are still encoding. At most
+    2 * `workers` batches are in flight, which bounds memory.
+
+    `source` is a zero-argument callable returning a fresh chunk iterator.
+    """
+    collection = open_collection(collection_name)
+    wall_start = time.perf_counter()
+
+    t0 = time.perf_counter()
+    ids, hashes = [], []
+    embedder = embedder_settings()
+    for doc_id, doc, meta in source():
+        ids.append(doc_id)
+        hashes.append(content_hash(doc, meta, embedder))
+    read_s = time.perf_counter() - t0
+    print(f"Hashed {len(ids)} chunks in {read_s:.2f}s "
+          f"({len(ids) / max(read_s, 1e-9):.0f} chunks/s)")
+
+    to_upsert, removed, counts = plan_sync(collection, ids, hashes, full=full)
+    if removed:
+        print(f"Deleting {len(removed)} stale chunks...")
+        collection.delete(ids=removed)
+    if not to_upsert:
+        print("Nothing to embed; collection is up to date.")
+        print_sync_counts(counts)
+        return collection
+
+    wanted = set(to_upsert)
+    threads = max(1, (os.cpu_count() or 1) // workers)
+    stats = {"batches": 0, "docs": 0, "encode_s": 0.0, "upsert_s": 0.0}
+    pending = {}
+
+    def drain(max_pending):
+        while len(pending) > max_pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for fut in done:
+                batch_ids, batch_docs, batch_metas = pending.pop(fut)
+                embeddings, encode_s = fut.result()
+
+                t = time.perf_counter()
+                collection.upsert(
+                    ids=batch_ids,
+                    documents=batch_docs,
+                    embeddings=embeddings.tolist(),
+                    metadatas=batch_metas,
+                )
+                stats["upsert_s"] += time.perf_counter() - t
+                stats["encode_s"] += encode_s
+                stats["batches"] += 1
+                stats["docs"] += len(batch_ids)
+                print(f"  batch {stats['batches']}: {len(batch_ids)} docs "
+                      f"(encode {encode_s:.2f}s) → {stats['docs']}/{len(to_upsert)}")
+
+    print(f"Encoding {len(to_upsert)} new/changed documents with {workers} worker(s), "
+          f"batch size {batch_size}, {threads} thread(s) per worker...")
+    ctx = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=workers, mp_context=ctx,
+                             initializer=_init_encode_worker,
+                             initargs=(MODEL_NAME, threads)) as pool:
+        encode_start = time.perf_counter()
+        batch = ([], [], [])
+        for i, (doc_id, doc, meta) in enumerate(source()):
+            if i not in wanted:
+                continue
+            batch[0].append(doc_id)
+            batch[1].append(doc)
+            batch[2].append(dict(meta, content_hash=hashes[i]))
+            if len(batch[0]) >= batch_size:
+                pending[pool.submit(_encode_batch, batch[1])] = batch
+                batch = ([], [], [])
+                drain(2 * workers)
+        if batch[0]:
+            pending[pool.submit(_encode_batch, batch[1])] = batch
+        drain(0)
+        pipeline_s = time.perf_counter() - encode_start
+
+    docs_done = stats["docs"]
+    print("Stage throughput:")
+    print(f"  read+hash : {len(ids) / max(read_s, 1e-9):8.1f} chunks/s")
+    print(f"  encode    : {docs_done / max(stats['encode_s'], 1e-9):8.1f} docs/s per worker, "
+          f"{docs_done / max(pipeline_s, 1e-9):8.1f} docs/s overall")
+    print(f"  upsert    : {docs_done / max(stats['upsert_s'], 1e-9):8.1f} docs/s "
+          f"({stats['upsert_s']:.2f}s total)")
+    print(f"  wall      : {time.perf_counter() - wall_start:.2f}s "
+          f"(pipeline incl. worker start-up {pipeline_s:.2f}s)")
+    print_sync_counts(counts)
     print("✔ DB saved.")
     return collection
 
 
+def build_lexical_index(source, out_path=LEXICAL_INDEX_PATH):
+    """Rebuild the BM25 inverted index from the chunks (tokenizing only, no model)."""
+    t0 = time.perf_counter()
+    index = BM25Index.build((doc_id, doc) for doc_id, doc, _ in source())
+    index.save(out_path)
+    print(f"BM25 index: {len(index)} docs, {len(index.terms)} terms, "
+          f"{len(index.rows)} postings ({index.nbytes / 1024:.0f} KiB) "
+          f"in {time.perf_counter() - t0:.2f}s → {out_path}")
+
+
+def sync_collection(source, path, collection_name, args):
+    if args.pipeline:
+        build_db_pipelined(lambda: source(path), batch_size=args.batch_size,
+                           workers=args.workers, full=args.full,
+                           collection_name=collection_name)
+    else:
+        docs, metas, ids = load_chunks(path, source)
+        build_db(docs, metas, ids, full=args.full, collection_name=collection_name)
+
+
 def main():
-    docs, metas, ids = load_chunks(DATA_PATH)
-    build_db(docs, metas, ids)
+    parser = argparse.ArgumentParser(description="Build or update the scene and speech vector DBs")
+    parser.add_argument("--full", action="store_true",
+                        help="re-embed every chunk even if its content hash is unchanged")
+    parser.add_argument("--pipeline", action="store_true",
+                        help="stream batches through a process pool, upserting as they finish")
+    parser.add_argument("--batch-size", type=int, default=64,
+                        help="chunks per encode/upsert batch (with --pipeline)")
+    parser.add_argument("--workers", type=int, default=max(1, (os.cpu_count() or 2) // 2),
+                        help="encoder processes (with --pipeline)")
+    parser.add_argument("--no-speeches", action="store_true",
+                        help="skip the speech-level index")
+    parser.add_argument("--no-lexical", action="store_true",
+                        help="skip the BM25 index used for hybrid retrieval")
+    args = parser.parse_args()
+
+    sync_collection(iter_chunks, DATA_PATH, COLLECTION_NAME, args)
+    if not args.no_lexical:
+        build_lexical_index(lambda: iter_chunks(DATA_PATH))
+
+    if args.no_speeches:
+        pass
+    elif os.path.exists(SPEAKER_DATA_PATH):
+        print("\nBuilding speech-level index...")
+        sync_collection(iter_speeches, SPEAKER_DATA_PATH, SPEECH_COLLECTION_NAME, args)
+    else:
+        print(f"\nSkipping speech-level index: {SPEAKER_DATA_PATH} not found")
 
     print("Verifying DB...")
     # Use PersistentClient for verification too
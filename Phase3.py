@@ -3,20 +3,24 @@ Phase3: RAG API Backend (Updated for latest ChromaDB)
 
 This version works with ChromaDB >= 0.5.0
 - Uses PersistentClient (no deprecated Settings)
-- Loads persistent vector DB created in Phase2
+- Loads persistent vector DB created in Phase2 (in the app lifespan; see /ready)
+- Extractive answers: the retrieved sentences closest to the question
 """
 
 import chromadb
 from typing import List, Dict, Any, Optional
 import os
 import json
+import asyncio
+from contextlib import asynccontextmanager
 from fastapi import FastAPI, HTTPException
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import JSONResponse
 from pydantic import BaseModel
 import numpy as np
-from sentence_transformers import SentenceTransformer
 
-
-app = FastAPI(title="RAG API")
+from embedding import EmbeddingBatcher, encode_with, load_embedder
+from generators import NO_ANSWER, ExtractiveGenerator
 
 
 # ======== Request & Response Models ========
@@ -39,58 +43,103 @@ class QueryResponse(BaseModel):
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 DEFAULT_CHROMA_DIR = os.path.join(BASE_DIR, "chroma_db_scenes_clean")
 CHROMA_DB_DIR = os.environ.get("CHROMA_DB_DIR", DEFAULT_CHROMA_DIR)
+# Phase2 also writes a speech-level collection to the same DB; pick scenes by name
+COLLECTION_NAME = os.environ.get("COLLECTION_NAME", "julius_caesar_scenes_clean")
 
 
 # ======== Load Embedder ========
 EMBED_MODEL_NAME = os.environ.get("EMBED_MODEL", "all-MiniLM-L6-v2")
-embedder = SentenceTransformer(EMBED_MODEL_NAME)
+WARMUP_ON_STARTUP = os.environ.get("WARMUP_ON_STARTUP", "1") != "0"
+
+# Built in the app lifespan (load_resources), not at import time
+embedder = None
+embedding_batcher = None
+chroma_client = None
+collection = None
+readiness = {"loaded": False, "warmed_up": False, "error": None}
 
 
 # ======== Initialize Chroma Client ========
+def load_collection():
+    if not os.path.exists(CHROMA_DB_DIR):
+        raise RuntimeError(
+            f"Chroma DB directory not found at {CHROMA_DB_DIR}\n"
+            "Did you run Phase2 successfully?"
+        )
 
-if not os.path.exists(CHROMA_DB_DIR):
-    raise RuntimeError(
-        f"Chroma DB directory not found at {CHROMA_DB_DIR}\n"
-        "Did you run Phase2 successfully?"
-    )
+    try:
+        print(f"🔄 Loading Chroma DB from: {CHROMA_DB_DIR}")
+
+        # Use PersistentClient instead of deprecated Client(Settings(...))
+        client = chromadb.PersistentClient(path=CHROMA_DB_DIR)
 
-try:
-    print(f"🔄 Loading Chroma DB from: {CHROMA_DB_DIR}")
+        collections = client.list_collections()
+        if not collections:
+            raise RuntimeError(
+                f"No collections found inside Chroma DB at {CHROMA_DB_DIR}"
+            )
 
-    # Use PersistentClient instead of deprecated Client(Settings(...))
-    chroma_client = chromadb.PersistentClient(path=CHROMA_DB_DIR)
+        print("Found collections:", [c.name for c in collections])
 
-    collections = chroma_client.list_collections()
-    if not collections:
+        # Load the scene collection (fall back to the first one for older DBs)
+        names = [c.name for c in collections]
+        collection_name = COLLECTION_NAME if COLLECTION_NAME in names else names[0]
+        loaded = client.get_collection(collection_name)
+
+        print(f"✔ Loaded Chroma collection: {collection_name}")
+        return client, loaded
+
+    except Exception as e:
         raise RuntimeError(
-            f"No collections found inside Chroma DB at {CHROMA_DB_DIR}"
+            "\n❌ Failed to initialize ChromaDB:\n"
+            + str(e)
+            + "\n\nFix:\n"
+            " - Ensure Phase2 ran and created the DB folder\n"
+            " - Ensure Chroma is installed: pip install chromadb\n"
+            " - Ensure CHROMA_DB_DIR points to your DB\n"
         )
 
-    print("Found collections:", [c.name for c in collections])
 
-    # Load first (and only) collection
-    collection_name = collections[0].name
-    collection = chroma_client.get_collection(collection_name)
+def load_resources():
+    global embedder, embedding_batcher, chroma_client, collection
 
-    print(f"✔ Loaded Chroma collection: {collection_name}")
+    embedder = load_embedder(EMBED_MODEL_NAME)
+    embedding_batcher = EmbeddingBatcher.from_env(encode_with(embedder)).start()
+    chroma_client, collection = load_collection()
+    readiness["loaded"] = True
 
-except Exception as e:
-    raise RuntimeError(
-        "\n❌ Failed to initialize ChromaDB:\n"
-        + str(e)
-        + "\n\nFix:\n"
-        " - Ensure Phase2 ran and created the DB folder\n"
-        " - Ensure Chroma is installed: pip install chromadb\n"
-        " - Ensure CHROMA_DB_DIR points to your DB\n"
-    )
+    if WARMUP_ON_STARTUP:
+        # One encode + one query so the first real request is not cold
+        retrieve_with_chroma(embed_text(["Who is Brutus?"]), 1)
+    readiness["warmed_up"] = True
+
+
+async def startup_resources():
+    try:
+        await run_in_threadpool(load_resources)
+    except Exception as e:
+        readiness["error"] = str(e)
+        print(e)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    startup_task = asyncio.create_task(startup_resources())
+    try:
+        yield
+    finally:
+        startup_task.cancel()
+        if embedding_batcher is not None:
+            embedding_batcher.stop()
+
+
+app = FastAPI(title="RAG API", lifespan=lifespan)
 
 
 # ======== Utility Functions ========
 def embed_text(texts: List[str]) -> np.ndarray:
-    embs = embedder.encode(texts, convert_to_numpy=True)
-    if embs.ndim == 1:
-        embs = np.expand_dims(embs, 0)
-    return embs
+    # Requests run on the threadpool; concurrent ones share one encode call
+    return embedding_batcher.embed(texts)
 
 
 def retrieve_with_chroma(query_embedding: np.ndarray, k: int = 5):
@@ -118,17 +167,15 @@ def retrieve_with_chroma(query_embedding: np.ndarray, k: int = 5):
     return docs
 
 
-def generate_answer(query: str, retrieved: List[Dict[str, Any]]) -> str:
-    """Simple extractive placeholder."""
-    if not retrieved:
-        return "I found no relevant information in the knowledge base."
+# Same local answerer Phase4 falls back to (EXTRACTIVE_SENTENCES etc.)
+extractive_generator = ExtractiveGenerator.from_env(embed_text)
 
-    answer_chunks = "\n\n".join([f"- {r['document']}" for r in retrieved])
 
-    return (
-        "SYNTHESIZED ANSWER (extractive):\n"
-        "Relevant chunks found:\n\n" + answer_chunks
-    )
+def generate_answer(q_emb: np.ndarray, retrieved: List[Dict[str, Any]]) -> str:
+    """Extractive answer: the retrieved sentences most similar to the query."""
+    if not retrieved:
+        return NO_ANSWER
+    return extractive_generator.answer(q_emb[0], retrieved)
 
 
 # ======== FastAPI Endpoint ========
@@ -139,6 +186,9 @@ def query_endpoint(body: QueryRequest):
 
     if not q.strip():
         raise HTTPException(status_code=400, detail="Query text is empty")
+    if not readiness["loaded"]:
+        raise HTTPException(status_code=503,
+                            detail=readiness["error"] or "Service is still loading")
 
     q_emb = embed_text([q])
     retrieved = retrieve_with_chroma(q_emb, k)
@@ -147,11 +197,23 @@ def query_endpoint(body: QueryRequest):
         {"chunk": r["document"], "metadata": r["metadata"]} for r in retrieved
     ]
 
-    answer = generate_answer(q, retrieved)
+    answer = generate_answer(q_emb, retrieved)
 
     return {"answer": answer, "sources": sources}
 
 
+@app.get("/health")
+def health_check():
+    return {"status": "healthy", "ready": readiness["warmed_up"]}
+
+
+@app.get("/ready")
+def readiness_check():
+    if readiness["error"] or not readiness["warmed_up"]:
+        return JSONResponse(status_code=503, content={"status": "not ready", **readiness})
+    return {"status": "ready", **readiness}
+
+
 # ======== Run Server ========
 if __name__ == "__main__":
     import uvicorn
@@ -2,34 +2,101 @@
 Phase 4: Prompt Engineering & Generation with Gemini API
 
 Features:
-- Multiple API key rotation with rate limiting
+- Multiple API keys, each with its own token-bucket rate budget
 - Detailed system prompt for Shakespearean Scholar persona
-- 3-5 second cooldown between API calls
+- Per-key cooldown between API calls, awaited without blocking workers
+  (optionally shared across worker processes through KEY_STATE_DB)
 - Source citation enforcement
+- /query/stream relays tokens as server-sent events
+- Semantic answer cache for near-duplicate questions
+- /query/batch answers many questions with one embedding batch and one Chroma query
+- Optional in-process NumPy exact top-k backend (RETRIEVAL_BACKEND=numpy)
+- Models/DB load in the app lifespan with warm-up; /ready gates traffic
+- Optional hierarchical retrieval: scenes first, then their best speeches
+  (RETRIEVAL_GRANULARITY=speech)
+- Token-budgeted context packing (dedupe, trim to query-relevant sentences)
+- Hybrid retrieval: BM25 inverted index fused with vector ranks (RRF)
+- Optional act/scene/speaker filters pushed down into the index
+- Per-stage timings returned in the Server-Timing response header
+- Pluggable generators: remote chat model or local extractive answerer, with
+  automatic fallback on key budget/deadline; each answer names its backend
+- /metrics in Prometheus text format (stage histograms, key, cache and token counters)
+- Structured, leveled, sampled pipeline logs; opt-in per-request profiling
+  (X-Profile: timings | cprofile | flame)
+- Preload-and-fork serving (prefork.py): workers share the model weights and
+  indexes copy-on-write; /health and /metrics report per-worker unique RSS
+- Single-flight coalescing: identical in-flight questions share one
+  retrieval and LLM call
+- Persistent answer cache in SQLite (ANSWER_CACHE_DB) that survives
+  restarts; warm it offline with warm_cache.py
 """
 
 import os
+import json
+import hashlib
 import time
-import random
-import requests
-
-from typing import List, Dict, Any, Optional
-from fastapi import FastAPI, HTTPException
-from pydantic import BaseModel
+import asyncio
+import logging
+import sqlite3
+from contextlib import asynccontextmanager
+
+import httpx
+from typing import List, Dict, Any, Optional, Tuple
+from fastapi import FastAPI, HTTPException, Response
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from pydantic import BaseModel, Field
 import chromadb
 import numpy as np
-from sentence_transformers import SentenceTransformer
 from langchain_google_genai import ChatGoogleGenerativeAI
 from langchain_core.messages import SystemMessage, HumanMessage
 
-
-app = FastAPI(title="Julius Caesar RAG API with Generation")
+from answer_cache import PersistentAnswerCache, SemanticAnswerCache
+from context_packer import ContextPacker
+from embedding import EmbeddingBatcher, encode_with, load_embedder
+from generators import ExtractiveGenerator, Generation, GenerationRouter, RemoteGenerator
+from lexical_index import LEXICAL_INDEX_FILE, BM25Index, reciprocal_rank_fusion
+from llm_client import LLMClientConfig, OpenRouterClient
+from metrics import (
+    TOKEN_BUCKETS, Counter, Gauge, Histogram, Registry, RequestMetricsMiddleware, Sample,
+)
+from pipeline_log import log_event
+from prefork import memory_report, process_memory, run_in_subprocess, share_model_memory, worker_id
+from profiling import ProfilingMiddleware, profile_report
+from rate_limiter import KeyScheduler, SharedKeyScheduler
+from singleflight import SingleFlight, normalize_query
+from retrieval import (
+    NumpyIndex, best_speeches, filter_where, filters_key, normalize_filters,
+    passages_for, public_metadata, scene_key, scene_where,
+)
+from timing import StageTimer
 
 
 # ======== Request & Response Models ========
+# Largest k a request may ask for; k outside [1, MAX_K] is rejected with a 422
+MAX_K = int(os.environ.get("MAX_K", 50))
+
+
+class SceneRef(BaseModel):
+    act: int
+    scene: int
+
+
+class QueryFilters(BaseModel):
+    """Restrict retrieval to matching passages (all fields optional, ANDed)."""
+    act_min: Optional[int] = None
+    act_max: Optional[int] = None
+    acts: Optional[List[int]] = None
+    scenes: Optional[List[SceneRef]] = None
+    # Scenes in which any of these characters speak (or, at speech
+    # granularity, speeches by them)
+    speakers: Optional[List[str]] = None
+
+
 class QueryRequest(BaseModel):
     query: str
-    k: Optional[int] = 5
+    k: Optional[int] = Field(5, ge=1, le=MAX_K)
+    filters: Optional[QueryFilters] = None
 
 
 class Source(BaseModel):
@@ -40,45 +107,32 @@ class Source(BaseModel):
 class QueryResponse(BaseModel):
     answer: str
     sources: List[Source]
+    # Context token accounting from the packer (None for cached answers)
+    usage: Optional[Dict[str, Any]] = None
+    # Generator that produced the answer ("remote" or "extractive"), and why
+    # the local one was used in auto mode
+    backend: Optional[str] = None
+    fallback_reason: Optional[str] = None
+    # Stage breakdown when the request is profiled (X-Profile header or sampling)
+    profile: Optional[Dict[str, Any]] = None
 
 
-# ======== API Key Management ========
-class APIKeyManager:
-    """Manages multiple Gemini API keys with rotation and cooldown."""
-
-    def __init__(self, keys: List[str], cooldown_min: float = 6.0, cooldown_max: float = 8.0):
-        if not keys:
-            raise ValueError("At least one API key is required")
-        self.keys = keys
-        self.current_index = 0
-        self.cooldown_min = cooldown_min
-        self.cooldown_max = cooldown_max
-        self.last_call_time = 0
-        print(f" Initialized API Key Manager with {len(keys)} key(s)")
+class BatchQueryRequest(BaseModel):
+    queries: List[str]
+    k: Optional[int] = Field(5, ge=1, le=MAX_K)
+    filters: Optional[QueryFilters] = None  # applied to every query
 
-    def get_next_key(self) -> str:
-        """Get the next API key in rotation."""
-        key = self.keys[self.current_index]
-        self.current_index = (self.current_index + 1) % len(self.keys)
-        return key
 
-    def apply_cooldown(self):
-        """Apply cooldown between API calls."""
-        elapsed = time.time() - self.last_call_time
-        cooldown = random.uniform(self.cooldown_min, self.cooldown_max)
-
-        if elapsed < cooldown:
-            sleep_time = cooldown - elapsed
-            print(f" Cooldown: sleeping for {sleep_time:.2f}s")
-            time.sleep(sleep_time)
-
-        self.last_call_time = time.time()
+class BatchQueryResponse(BaseModel):
+    results: List[QueryResponse]
+    profile: Optional[Dict[str, Any]] = None
 
 
 # ======== Configuration ========
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 DEFAULT_CHROMA_DIR = os.path.join(BASE_DIR, "chroma_db_scenes_clean")
 CHROMA_DB_DIR = os.environ.get("CHROMA_DB_DIR", DEFAULT_CHROMA_DIR)
+COLLECTION_NAME = os.environ.get("COLLECTION_NAME", "julius_caesar_scenes_clean")
 EMBED_MODEL_NAME = os.environ.get("EMBED_MODEL", "all-MiniLM-L6-v2")
 
 # Load multiple API keys from environment
@@ -112,7 +166,83 @@ if not API_KEYS:
         "  - GEMINI_API_KEY"
     )
 
-api_key_manager = APIKeyManager(API_KEYS, cooldown_min=6.0, cooldown_max=7.0)
+# Spacing between two calls on the same key, drawn from [min, max] seconds
+KEY_COOLDOWN_MIN = float(os.environ.get("KEY_COOLDOWN_MIN", 6.0))
+KEY_COOLDOWN_MAX = float(os.environ.get("KEY_COOLDOWN_MAX", 7.0))
+# KEY_STATE_DB=<path> shares the per-key budgets with every worker process
+# using the same file (several uvicorn workers / replicas on one node)
+KEY_STATE_DB = os.environ.get("KEY_STATE_DB", "").strip()
+if KEY_STATE_DB:
+    api_key_manager = SharedKeyScheduler(API_KEYS, KEY_STATE_DB, cooldown_min=KEY_COOLDOWN_MIN,
+                                         cooldown_max=KEY_COOLDOWN_MAX)
+else:
+    api_key_manager = KeyScheduler(API_KEYS, cooldown_min=KEY_COOLDOWN_MIN,
+                                   cooldown_max=KEY_COOLDOWN_MAX)
+
+# Shared, pooled HTTP client for OpenRouter (opened/closed in the app lifespan)
+openrouter = OpenRouterClient(LLMClientConfig.from_env())
+
+# Upper bound on questions accepted by /query/batch
+MAX_BATCH_QUERIES = int(os.environ.get("MAX_BATCH_QUERIES", 64))
+
+# Semantic answer cache (ANSWER_CACHE_SIZE=0 disables it)
+answer_cache = SemanticAnswerCache(
+    max_entries=int(os.environ.get("ANSWER_CACHE_SIZE", 256)),
+    threshold=float(os.environ.get("ANSWER_CACHE_THRESHOLD", 0.92)),
+    ttl_seconds=float(os.environ.get("ANSWER_CACHE_TTL", 3600)),
+)
+FINGERPRINT_CHECK_INTERVAL = float(os.environ.get("ANSWER_CACHE_FINGERPRINT_INTERVAL", 10))
+
+# Prompt context token budget (CONTEXT_MAX_TOKENS=0 sends every passage whole)
+context_packer = ContextPacker.from_env()
+
+# Identical questions in flight at the same time share one pipeline run:
+# the whole of /query, retrieval+packing for /query/stream and generation
+# for /query/batch (SINGLE_FLIGHT=0 disables)
+query_flights = SingleFlight("query")
+retrieval_flights = SingleFlight("retrieval")
+generation_flights = SingleFlight("generation")
+
+
+# ======== Metrics ========
+# Hot-path histograms/counters; component counters are read at scrape time
+# (collect_component_metrics) and cost nothing per request.
+metrics_registry = Registry()
+stage_seconds = metrics_registry.register(Histogram(
+    "rag_stage_duration_seconds", "Time spent in each request stage", ("endpoint", "stage")))
+request_seconds = metrics_registry.register(Histogram(
+    "rag_request_duration_seconds", "Server-side time per request", ("endpoint",)))
+key_wait_seconds = metrics_registry.register(Histogram(
+    "rag_key_wait_seconds", "Cooldown wait before an API key slot was granted"))
+prompt_context_tokens = metrics_registry.register(Histogram(
+    "rag_prompt_context_tokens", "Context tokens per prompt after packing",
+    buckets=TOKEN_BUCKETS))
+llm_tokens = metrics_registry.register(Counter(
+    "rag_llm_tokens_total", "Tokens reported by the chat completions API", ("kind",)))
+requests_in_flight = metrics_registry.register(Gauge(
+    "rag_requests_in_flight", "HTTP requests currently being served"))
+http_requests = metrics_registry.register(Counter(
+    "rag_http_requests_total", "HTTP requests by path and status", ("path", "status")))
+api_key_manager.wait_observer = key_wait_seconds.observe
+
+
+def record_timings(endpoint: str, timer: StageTimer) -> Optional[Dict[str, Any]]:
+    """Feed a finished request's stage timings into the histograms and the log.
+
+    Returns the profile breakdown if this request is being profiled.
+    """
+    total_ms = timer.total_ms()
+    for stage, ms in timer.stages.items():
+        stage_seconds.observe(ms / 1000, endpoint, stage)
+    request_seconds.observe(total_ms / 1000, endpoint)
+    log_event(logging.INFO, "request_done", endpoint=endpoint, total_ms=round(total_ms, 1))
+    return profile_report(timer.stages, total_ms)
+
+
+def record_llm_usage(generation: Generation):
+    for kind, count in (generation.usage or {}).items():
+        if kind.endswith("_tokens") and isinstance(count, (int, float)):
+            llm_tokens.inc(count, kind[:-len("_tokens")])
 
 
 # ======== System Prompt ========
@@ -181,69 +311,424 @@ OUTPUT REQUIREMENTS:
 """
 
 
-# ======== Load Embedder ========
-print(f"Loading embedding model: {EMBED_MODEL_NAME}")
-embedder = SentenceTransformer(EMBED_MODEL_NAME)
-
+# ======== Retrieval Backend ========
+# RETRIEVAL_BACKEND=chroma (default) queries the collection directly;
+# RETRIEVAL_BACKEND=numpy serves exact top-k from an in-process matrix.
+RETRIEVAL_BACKEND = os.environ.get("RETRIEVAL_BACKEND", "chroma").strip().lower()
+if RETRIEVAL_BACKEND not in ("chroma", "numpy"):
+    raise RuntimeError(
+        f"Unknown RETRIEVAL_BACKEND={RETRIEVAL_BACKEND!r} (use 'chroma' or 'numpy')"
+    )
 
-# ======== Initialize ChromaDB ========
-if not os.path.exists(CHROMA_DB_DIR):
+# RETRIEVAL_GRANULARITY=scene (default) returns whole scenes as passages;
+# RETRIEVAL_GRANULARITY=speech picks the top-k scenes, then the
+# SPEECHES_PER_SCENE speeches in each that best match the query (Phase2
+# builds the speech collection from the speaker chunks).
+RETRIEVAL_GRANULARITY = os.environ.get("RETRIEVAL_GRANULARITY", "scene").strip().lower()
+if RETRIEVAL_GRANULARITY not in ("scene", "speech"):
     raise RuntimeError(
-        f"Chroma DB directory not found at {CHROMA_DB_DIR}\n"
-        "Run Phase2 first to build the vector database."
+        f"Unknown RETRIEVAL_GRANULARITY={RETRIEVAL_GRANULARITY!r} (use 'scene' or 'speech')"
     )
+SPEECHES_PER_SCENE = int(os.environ.get("SPEECHES_PER_SCENE", 4))
+SPEECH_COLLECTION_NAME = os.environ.get("SPEECH_COLLECTION_NAME", "julius_caesar_speeches")
+
+# Hybrid retrieval: fuse the vector ranking with the Phase2 BM25 index by
+# reciprocal-rank fusion. Both rankings go HYBRID_CANDIDATES deep; the fused
+# top-k is returned. Vector-only if the index file is missing or
+# HYBRID_RETRIEVAL=0.
+HYBRID_RETRIEVAL = os.environ.get("HYBRID_RETRIEVAL", "1") != "0"
+HYBRID_CANDIDATES = int(os.environ.get("HYBRID_CANDIDATES", 20))
+RRF_K = int(os.environ.get("RRF_K", 60))
+LEXICAL_INDEX_PATH = os.environ.get(
+    "LEXICAL_INDEX_PATH", os.path.join(CHROMA_DB_DIR, LEXICAL_INDEX_FILE))
+
+# Optional warm-up (one encode + one retrieval) before /ready reports ready
+WARMUP_ON_STARTUP = os.environ.get("WARMUP_ON_STARTUP", "1") != "0"
+WARMUP_QUERY = os.environ.get(
+    "WARMUP_QUERY", "Who warns Caesar about the Ides of March?")
+
+
+# ======== Lazily Loaded Resources ========
+# The embedder and Chroma collection are built in the app lifespan (see
+# load_resources), so importing this module, `uvicorn --reload` and tests
+# don't block on model/DB loading.
+embedder = None  # SentenceTransformer or OnnxEmbedder (EMBED_BACKEND)
+embedding_batcher: Optional[EmbeddingBatcher] = None
+chroma_client = None
+collection = None
+numpy_index: Optional[NumpyIndex] = None
+speech_collection = None  # only with RETRIEVAL_GRANULARITY=speech
+speech_index: Optional[NumpyIndex] = None
+lexical_index: Optional[BM25Index] = None
+
+readiness: Dict[str, Any] = {
+    "loaded": False,
+    "warmed_up": False,
+    "error": None,
+    "load_seconds": None,
+    "warmup_seconds": None,
+}
+
+
+def load_collection():
+    """Open the persistent Chroma DB built by Phase2 and return its collection."""
+    if not os.path.exists(CHROMA_DB_DIR):
+        raise RuntimeError(
+            f"Chroma DB directory not found at {CHROMA_DB_DIR}\n"
+            "Run Phase2 first to build the vector database."
+        )
+
+    try:
+        print(f" Loading Chroma DB from: {CHROMA_DB_DIR}")
+        client = chromadb.PersistentClient(path=CHROMA_DB_DIR)
+        collections = client.list_collections()
+
+        if not collections:
+            raise RuntimeError(f"No collections found in {CHROMA_DB_DIR}")
+
+        # Phase2 writes scenes and speeches to the same DB; fall back to the
+        # first collection for DBs built before the speech index existed
+        names = [c.name for c in collections]
+        collection_name = COLLECTION_NAME if COLLECTION_NAME in names else names[0]
+        loaded = client.get_collection(collection_name)
+        print(f" Loaded collection: {collection_name}")
+        return client, loaded
+
+    except Exception as e:
+        raise RuntimeError(f"Failed to initialize ChromaDB: {e}")
+
 
-try:
-    print(f" Loading Chroma DB from: {CHROMA_DB_DIR}")
-    chroma_client = chromadb.PersistentClient(path=CHROMA_DB_DIR)
-    collections = chroma_client.list_collections()
+def chroma_write_version(sqlite_path: str):
+    """Chroma's last write sequence number, or the sqlite mtime if unreadable.
 
-    if not collections:
-        raise RuntimeError(f"No collections found in {CHROMA_DB_DIR}")
+    The mtime alone is not enough with several workers: every client that
+    opens the DB rewrites the file, so each worker would see the others'
+    startup as a change.
+    """
+    try:
+        conn = sqlite3.connect(f"file:{sqlite_path}?mode=ro", uri=True)
+        try:
+            seq = conn.execute(
+                "SELECT MAX(seq) FROM (SELECT MAX(seq_id) AS seq FROM embeddings_queue"
+                " UNION ALL SELECT MAX(seq_id) FROM max_seq_id)"
+            ).fetchone()[0]
+        finally:
+            conn.close()
+        if seq is not None:
+            return f"seq{seq}"
+    except sqlite3.Error:
+        pass
+    return os.path.getmtime(sqlite_path) if os.path.exists(sqlite_path) else 0
+
+
+def collection_fingerprint() -> str:
+    """Cheap change detector for the Chroma collection (row count + write version)."""
+    version = chroma_write_version(os.path.join(CHROMA_DB_DIR, "chroma.sqlite3"))
+    speeches = f":{speech_collection.count()}" if speech_collection is not None else ""
+    return f"{collection.name}:{collection.count()}{speeches}:{version}"
+
+
+def load_speech_collection():
+    """Open the Phase2 speech-level collection used for hierarchical retrieval."""
+    try:
+        loaded = chroma_client.get_collection(SPEECH_COLLECTION_NAME)
+    except Exception as e:
+        raise RuntimeError(
+            f"Speech collection {SPEECH_COLLECTION_NAME!r} not found in {CHROMA_DB_DIR} ({e}).\n"
+            "Run Phase2 with the speaker chunks file present, or set RETRIEVAL_GRANULARITY=scene."
+        )
+    print(f" Loaded speech collection: {SPEECH_COLLECTION_NAME} ({loaded.count()} speeches)")
+    return loaded
+
+
+def load_resources():
+    """Load the embedder, Chroma collection and retrieval backend (blocking).
+
+    Anything already set by preload_for_fork() is kept as is.
+    """
+    global embedder, embedding_batcher, chroma_client, collection, numpy_index
+    global speech_collection, speech_index, lexical_index
+
+    if embedder is None:
+        print(f"Loading embedding model: {EMBED_MODEL_NAME}")
+        embedder = load_embedder(EMBED_MODEL_NAME)
+    # Concurrent queries are encoded together in micro-batches
+    embedding_batcher = EmbeddingBatcher.from_env(encode_with(embedder)).start()
+
+    chroma_client, collection = load_collection()
+    if RETRIEVAL_GRANULARITY == "speech":
+        speech_collection = load_speech_collection()
+
+    if RETRIEVAL_BACKEND == "numpy" and numpy_index is None:
+        fingerprint = collection_fingerprint()
+        numpy_index = NumpyIndex.from_collection(collection, fingerprint)
+        if speech_collection is not None:
+            speech_index = NumpyIndex.from_collection(speech_collection, fingerprint)
+    if HYBRID_RETRIEVAL and lexical_index is None:
+        if os.path.exists(LEXICAL_INDEX_PATH):
+            lexical_index = BM25Index.load(LEXICAL_INDEX_PATH)
+        else:
+            print(f" No BM25 index at {LEXICAL_INDEX_PATH} (run Phase2); vector-only retrieval")
+    print(f" Retrieval backend: {RETRIEVAL_BACKEND}, granularity: {RETRIEVAL_GRANULARITY}, "
+          f"hybrid: {lexical_index is not None}")
+
+
+def read_index_rows() -> Tuple[str, Dict[str, Any], Optional[Dict[str, Any]]]:
+    """(fingerprint, scene rows, speech rows) for the NumPy backend. Run by
+    preload_for_fork() in a spawned process, so the forking parent never
+    opens Chroma itself."""
+    global chroma_client, collection, speech_collection
+    chroma_client, collection = load_collection()
+    if RETRIEVAL_GRANULARITY == "speech":
+        speech_collection = load_speech_collection()
+    include = ["embeddings", "documents", "metadatas"]
+    return (collection_fingerprint(), collection.get(include=include),
+            speech_collection.get(include=include) if speech_collection is not None else None)
+
+
+def preload_for_fork():
+    """Load what workers can share before prefork.py forks them: the embedder
+    weights (torch only: an ONNX Runtime session owns threads, so each worker
+    builds its own) and the read-only NumPy and BM25 indexes. Workers open
+    their own Chroma client, batcher thread and HTTP pool in load_resources()."""
+    global embedder, numpy_index, speech_index, lexical_index
+
+    if os.environ.get("EMBED_BACKEND", "torch").strip().lower() == "torch":
+        print(f"Loading embedding model: {EMBED_MODEL_NAME}")
+        embedder = load_embedder(EMBED_MODEL_NAME, "torch")
+        share_model_memory(embedder)
+
+    if RETRIEVAL_BACKEND == "numpy":
+        fingerprint, scene_rows, speech_rows = run_in_subprocess(read_index_rows)
+        numpy_index = NumpyIndex.from_rows(scene_rows, fingerprint)
+        if speech_rows is not None:
+            speech_index = NumpyIndex.from_rows(speech_rows, fingerprint)
+        # A stray write would copy the pages into that worker (and diverge it)
+        for index in (numpy_index, speech_index):
+            if index is not None:
+                index.matrix.setflags(write=False)
+
+    if HYBRID_RETRIEVAL and os.path.exists(LEXICAL_INDEX_PATH):
+        lexical_index = BM25Index.load(LEXICAL_INDEX_PATH)
+
+
+def warm_up():
+    """Run one encode and one retrieval so the first real query is not cold."""
+    q_emb = embed_text([WARMUP_QUERY])
+    retrieve(q_emb, 1, WARMUP_QUERY)
+
+
+async def startup_resources():
+    """Background startup: load resources, then optionally warm them up."""
+    try:
+        t0 = time.perf_counter()
+        await run_in_threadpool(load_resources)
+        readiness["load_seconds"] = round(time.perf_counter() - t0, 3)
+        readiness["loaded"] = True
+
+        if WARMUP_ON_STARTUP:
+            t0 = time.perf_counter()
+            await run_in_threadpool(warm_up)
+            readiness["warmup_seconds"] = round(time.perf_counter() - t0, 3)
+        readiness["warmed_up"] = True
+        print(f" Ready (load {readiness['load_seconds']}s, "
+              f"warm-up {readiness['warmup_seconds']}s)")
+
+    except Exception as e:
+        readiness["error"] = str(e)
+        print(f" Startup failed: {e}")
 
-    collection_name = collections[0].name
-    collection = chroma_client.get_collection(collection_name)
-    print(f" Loaded collection: {collection_name}")
 
-except Exception as e:
-    raise RuntimeError(f"Failed to initialize ChromaDB: {e}")
+def ensure_loaded():
+    """Reject queries with 503 until the embedder and index are loaded."""
+    if not readiness["loaded"]:
+        detail = readiness["error"] or "Service is still loading"
+        raise HTTPException(status_code=503, detail=detail)
 
 
 # ======== Utility Functions ========
 def embed_text(texts: List[str]) -> np.ndarray:
-    """Generate embeddings for input texts."""
-    embs = embedder.encode(texts, convert_to_numpy=True)
-    if embs.ndim == 1:
-        embs = np.expand_dims(embs, 0)
-    return embs
+    """Generate embeddings for input texts (micro-batched with concurrent callers)."""
+    return embedding_batcher.embed(texts)
 
 
-def retrieve_with_chroma(query_embedding: np.ndarray, k: int = 5) -> List[Dict[str, Any]]:
-    """Retrieve top-k relevant passages from ChromaDB."""
-    results = collection.query(
-        query_embeddings=query_embedding.tolist(),
-        n_results=k,
-        include=["documents", "metadatas", "distances"],
-    )
-
+def unpack_query_results(results: Dict[str, Any], row: int) -> List[Dict[str, Any]]:
+    """Turn row `row` of a Chroma query result into a list of passage dicts."""
     docs = []
-    docs_list = results.get("documents", [[]])
-    meta_list = results.get("metadatas", [[]])
-    dist_list = results.get("distances", [[]])
+    docs_list = results.get("documents") or [[]]
+    meta_list = results.get("metadatas") or [[]]
+    dist_list = results.get("distances") or [[]]
 
-    for doc, meta, dist in zip(docs_list[0], meta_list[0], dist_list[0]):
+    for doc_id, doc, meta, dist in zip(results["ids"][row], docs_list[row],
+                                       meta_list[row], dist_list[row]):
         docs.append({
+            "id": doc_id,
             "document": doc,
             "metadata": meta or {},
             "distance": dist,
         })
-    print("=============================Retrieved data========================")
-    print(doc)
-    print("=========================================================================")
-
     return docs
 
 
+def retrieve_many_with_chroma(query_embeddings: np.ndarray, k: int = 5,
+                              where: Optional[Dict[str, Any]] = None) -> List[List[Dict[str, Any]]]:
+    """Retrieve top-k passages for several queries with one multi-vector query."""
+    results = collection.query(
+        query_embeddings=query_embeddings.tolist(),
+        n_results=k,
+        where=where,
+        include=["documents", "metadatas", "distances"],
+    )
+    return [unpack_query_results(results, row) for row in range(len(query_embeddings))]
+
+
+def retrieve_with_chroma(query_embedding: np.ndarray, k: int = 5,
+                         where: Optional[Dict[str, Any]] = None) -> List[Dict[str, Any]]:
+    """Retrieve top-k relevant passages from ChromaDB."""
+    return retrieve_many_with_chroma(query_embedding, k, where)[0]
+
+
+def refine_to_speeches(query_embedding: np.ndarray, scenes: List[Dict[str, Any]],
+                       filters: Optional[Dict[str, Any]] = None) -> List[Dict[str, Any]]:
+    """Hierarchical step 2: replace each retrieved scene by its best speeches."""
+    keys = list(dict.fromkeys(scene_key(p["metadata"]) for p in scenes))
+    if not keys:
+        return []
+    if speech_index is not None:
+        return speech_index.best_in_scenes(query_embedding, keys, SPEECHES_PER_SCENE, filters)
+
+    where = scene_where(keys)
+    speaker_where = filter_where(filters, speech_level=True)
+    if speaker_where is not None:
+        where = {"$and": [where, speaker_where]}
+    data = speech_collection.get(
+        where=where,
+        include=["embeddings", "documents", "metadatas"],
+    )
+    return best_speeches(
+        query_embedding, data["ids"], np.asarray(data["embeddings"], dtype=np.float32),
+        data["documents"], data["metadatas"], keys, SPEECHES_PER_SCENE,
+    )
+
+
+def lexical_rows(filters: Optional[Dict[str, Any]]) -> Optional[np.ndarray]:
+    """BM25 rows allowed by the filters (None = unfiltered)."""
+    if not filters:
+        return None
+    if numpy_index is not None:
+        allowed = numpy_index.filtered_rows(filters)
+        ids = [numpy_index.ids[r] for r in allowed]
+    else:
+        ids = collection.get(where=filter_where(filters), include=[])["ids"]
+    return lexical_index.rows_for_ids(ids)
+
+
+def fuse_with_lexical(query_text: str, query_embedding: np.ndarray,
+                      vector_passages: List[Dict[str, Any]], k: int,
+                      filters: Optional[Dict[str, Any]] = None) -> List[Dict[str, Any]]:
+    """Reciprocal-rank fusion of the vector ranking with the BM25 ranking."""
+    lexical_ids = [doc_id for doc_id, _ in lexical_index.top_k(
+        query_text, HYBRID_CANDIDATES, lexical_rows(filters))]
+    fused = reciprocal_rank_fusion(
+        [[p["id"] for p in vector_passages], lexical_ids], k=RRF_K)[:k]
+
+    by_id = {p["id"]: p for p in vector_passages}
+    missing = [doc_id for doc_id in fused if doc_id not in by_id]
+    if missing:
+        # Lexical-only hits: fetch their rows and score them against the query
+        if numpy_index is not None:
+            extra = numpy_index.get(missing, query_embedding)
+        else:
+            data = collection.get(ids=missing, include=["embeddings", "documents", "metadatas"])
+            extra = passages_for(query_embedding, data["ids"],
+                                 np.asarray(data["embeddings"], dtype=np.float32),
+                                 data["documents"], data["metadatas"])
+        by_id.update((p["id"], p) for p in extra)
+    return [by_id[doc_id] for doc_id in fused if doc_id in by_id]
+
+
+def clamp_k(k: int) -> int:
+    """k limited to [1, MAX_K] (requests are validated; internal callers are not)."""
+    return max(1, min(k, MAX_K))
+
+
+def candidate_depth(k: int, hybrid: bool) -> int:
+    """How deep to query the vector backend (deeper when fusing)."""
+    return max(k, HYBRID_CANDIDATES) if hybrid else k
+
+
+def retrieve(query_embedding: np.ndarray, k: int = 5, query_text: Optional[str] = None,
+             filters: Optional[Dict[str, Any]] = None) -> List[Dict[str, Any]]:
+    """Top-k passages for one query from the configured backend.
+
+    With the BM25 index loaded and `query_text` given, the vector ranking is
+    fused with the lexical one before the top k are taken. `filters`
+    (normalized, see retrieval.normalize_filters) restrict every stage.
+    """
+    k = clamp_k(k)
+    hybrid = lexical_index is not None and bool(query_text)
+    depth = candidate_depth(k, hybrid)
+    if numpy_index is not None:
+        passages = numpy_index.query(query_embedding, depth, filters)
+    else:
+        passages = retrieve_with_chroma(query_embedding, depth, filter_where(filters))
+    if hybrid:
+        passages = fuse_with_lexical(query_text, query_embedding, passages, k, filters)
+    if speech_collection is not None:
+        passages = refine_to_speeches(query_embedding, passages, filters)
+    return passages
+
+
+def retrieve_many(query_embeddings: np.ndarray, k: int = 5,
+                  query_texts: Optional[List[str]] = None,
+                  filters: Optional[Dict[str, Any]] = None) -> List[List[Dict[str, Any]]]:
+    """Top-k passages for each query row from the configured backend."""
+    k = clamp_k(k)
+    hybrid = lexical_index is not None and query_texts is not None
+    depth = candidate_depth(k, hybrid)
+    if numpy_index is not None:
+        results = numpy_index.query_many(query_embeddings, depth, filters)
+    else:
+        results = retrieve_many_with_chroma(query_embeddings, depth, filter_where(filters))
+    if hybrid:
+        results = [
+            fuse_with_lexical(text, query_embeddings[row:row + 1], passages, k, filters)
+            for row, (text, passages) in enumerate(zip(query_texts, results))
+        ]
+    if speech_collection is not None:
+        results = [
+            refine_to_speeches(query_embeddings[row:row + 1], passages, filters)
+            for row, passages in enumerate(results)
+        ]
+    return results
+
+
+_last_fingerprint_check = 0.0
+
+
+def refresh_cache_fingerprint():
+    """Invalidate the answer cache (and reload the NumPy/BM25 indexes) if the
+    collection changed. Checked at most every FINGERPRINT_CHECK_INTERVAL s."""
+    global _last_fingerprint_check, numpy_index, speech_index, lexical_index
+    now = time.monotonic()
+    if now - _last_fingerprint_check < FINGERPRINT_CHECK_INTERVAL:
+        return
+    _last_fingerprint_check = now
+    fingerprint = collection_fingerprint()
+    answer_cache.check_fingerprint(fingerprint)
+    if answer_store is not None:
+        answer_store.check_fingerprint(fingerprint)
+    if numpy_index is not None and numpy_index.fingerprint != fingerprint:
+        log_event(logging.WARNING, "numpy_index_reload", reason="collection changed")
+        numpy_index = NumpyIndex.from_collection(collection, fingerprint)
+        if speech_index is not None:
+            speech_index = NumpyIndex.from_collection(speech_collection, fingerprint)
+    if (lexical_index is not None and os.path.exists(LEXICAL_INDEX_PATH)
+            and os.path.getmtime(LEXICAL_INDEX_PATH) != lexical_index.mtime):
+        log_event(logging.WARNING, "bm25_index_reload", path=LEXICAL_INDEX_PATH)
+        lexical_index = BM25Index.load(LEXICAL_INDEX_PATH)
+
+
 def format_context(retrieved: List[Dict[str, Any]]) -> str:
     """Format retrieved passages into context string."""
     if not retrieved:
@@ -255,40 +740,43 @@ def format_context(retrieved: List[Dict[str, Any]]) -> str:
         act = meta.get("act", "?")
         scene = meta.get("scene", "?")
         text = doc["document"]
+        speaker = f", {meta['speaker']}" if meta.get("speaker") else ""
 
         context_parts.append(
-            f"[Passage {i} - Act {act}, Scene {scene}]\n{text}\n"
+            f"[Passage {i} - Act {act}, Scene {scene}{speaker}]\n{text}\n"
         )
 
     return "\n".join(context_parts)
 
 
-def generate_answer_with_gemini(query: str, context: str) -> str:
-    """Generate answer using OpenRouter API with key rotation and cooldown."""
+def pack_context(query: str, q_emb: np.ndarray, retrieved: List[Dict[str, Any]]
+                 ) -> Tuple[str, List[Dict[str, Any]], Dict[str, Any]]:
+    """Fit the passages into the token budget and format them (blocking).
 
-    # Apply cooldown before API call
-    api_key_manager.apply_cooldown()
+    Returns (context, packed passages, usage); the packed passages are what
+    the model sees, so they are also what gets returned as sources.
+    """
+    packed, usage = context_packer.pack(query, q_emb[0], retrieved, embed_fn=embed_text)
+    prompt_context_tokens.observe(usage["tokens_used"])
+    log_event(logging.INFO, "context_packed", tokens_used=usage["tokens_used"],
+              tokens_in=usage["tokens_in"], passages_used=usage["passages_used"],
+              passages_in=usage["passages_in"], duplicates=usage["duplicates_dropped"],
+              trimmed=usage["trimmed"])
+    return format_context(packed), packed, usage
 
-    # Get next API key
-    current_key = api_key_manager.get_next_key()
 
-    # OpenRouter headers
-    headers = {
-        "Authorization": f"Bearer {current_key}",
-        "Content-Type": "application/json",
-        "HTTP-Referer": "http://localhost",
-        "X-Title": "JuliusCaesar-RAG"
-    }
+# Choose model
+LLM_MODEL_NAME = "meta-llama/llama-3.1-8b-instruct"
+# Alternative models:
+# "qwen/qwen2.5-7b-instruct"
+# "mistral/mistral-small-latest"
+# "anthropic/claude-3-haiku"
 
-    # Choose model
-    model_name = "meta-llama/llama-3.1-8b-instruct"
-    # Alternative models:
-    # "qwen/qwen2.5-7b-instruct"
-    # "mistral/mistral-small-latest"
-    # "anthropic/claude-3-haiku"
 
+def build_payload(query: str, context: str, stream: bool = False) -> Dict[str, Any]:
+    """Build the chat completion request for a question and its context."""
     payload = {
-        "model": model_name,
+        "model": LLM_MODEL_NAME,
         "messages": [
             {"role": "system", "content": SYSTEM_PROMPT},
             {
@@ -306,73 +794,515 @@ Remember: Only use the provided context and cite Act and Scene."""
         "temperature": 0.2,
         "max_tokens": 1500
     }
-
+    if stream:
+        payload["stream"] = True
+    return payload
+
+
+# ======== Generation Backends ========
+# GENERATOR_BACKEND=remote (default) | auto | local; see generators.py
+remote_generator = RemoteGenerator(openrouter, api_key_manager, build_payload)
+# Shares the packer's sentence embeddings, so trimmed passages are not re-encoded
+extractive_generator = ExtractiveGenerator.from_env(embed_text, context_packer.sentence_cache)
+generator = GenerationRouter.from_env(remote_generator, extractive_generator)
+
+# Persistent answer cache (ANSWER_CACHE_DB), keyed on the prompt and the
+# model as well: editing SYSTEM_PROMPT or the template in build_payload
+# gives a new PROMPT_VERSION, so answers to the old prompt are not served
+PROMPT_VERSION = os.environ.get("PROMPT_VERSION") or hashlib.sha256(
+    json.dumps(build_payload("{query}", "{context}"), sort_keys=True).encode("utf-8")
+).hexdigest()[:12]
+answer_store = PersistentAnswerCache.from_env(
+    PROMPT_VERSION, "extractive" if generator.mode == "local" else LLM_MODEL_NAME)
+
+
+def sse_event(event: str, data: Any) -> str:
+    """Encode one server-sent event with a JSON payload."""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+# ======== FastAPI App ========
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await openrouter.start()
+    # Load models/DB in the background so /health answers immediately and
+    # /ready flips once everything is loaded and warmed up.
+    startup_task = asyncio.create_task(startup_resources())
     try:
-        print(
-            f" Generating answer with OpenRouter (key #{api_key_manager.current_index})")
+        yield
+    finally:
+        startup_task.cancel()
+        if embedding_batcher is not None:
+            embedding_batcher.stop()
+        if answer_store is not None:
+            answer_store.close()
+        await openrouter.aclose()
+
+
+app = FastAPI(title="Julius Caesar RAG API with Generation", lifespan=lifespan)
+app.add_middleware(ProfilingMiddleware)
+app.add_middleware(
+    RequestMetricsMiddleware, in_flight=requests_in_flight, requests=http_requests,
+    paths=("/query", "/query/batch", "/query/stream", "/health", "/ready", "/metrics"),
+)
+
+
+def request_filters(filters: Optional[QueryFilters]) -> Optional[Dict[str, Any]]:
+    """Normalized retrieval filters from the request body (None if unset)."""
+    filters = normalize_filters(filters.dict() if filters else None)
+    if filters:
+        log_event(logging.DEBUG, "filters", filters=filters)
+    return filters
+
+
+def cache_answer(q: str, q_emb: np.ndarray, k: int, generation: Generation,
+                 retrieved: List[Dict[str, Any]], filters: Optional[Dict[str, Any]] = None):
+    """Store a successful answer; errors and fallback answers are never cached."""
+    if generation.failed or generation.fallback_reason:
+        return
+    sources = [{"chunk": r["document"], "metadata": public_metadata(r["metadata"])}
+               for r in retrieved]
+    answer_cache.store(q, q_emb[0], k, generation.text, sources,
+                       scope=filters_key(filters), backend=generation.backend)
+    if answer_store is not None:
+        answer_store.store(q, k, generation.text, sources,
+                           scope=filters_key(filters), backend=generation.backend)
+
+
+async def retrieve_for_query(q: str, q_emb: np.ndarray, k: int,
+                             filters: Optional[Dict[str, Any]] = None) -> List[Dict[str, Any]]:
+    """Retrieve the top-k passages for an embedded query off the event loop."""
+    retrieved = await run_in_threadpool(retrieve, q_emb, k, q, filters)
+    log_event(logging.INFO, "retrieved", passages=len(retrieved))
+    log_event(logging.DEBUG, "retrieved_ids", ids=[r.get("id") for r in retrieved])
+    return retrieved
+
+
+def lookup_stored_answer_sync(q: str, k: int, filters: Optional[Dict[str, Any]] = None):
+    refresh_cache_fingerprint()
+    hit = answer_store.lookup(q, k, scope=filters_key(filters))
+    if hit is not None:
+        log_event(logging.INFO, "answer_store_hit", cached_query=hit.query)
+    return hit
+
+
+async def lookup_stored_answer(q: str, k: int, filters: Optional[Dict[str, Any]] = None):
+    """Return an answer to the same (normalized) question from the on-disk
+    cache, if enabled; checked before the query is embedded."""
+    if answer_store is None:
+        return None
+    return await run_in_threadpool(lookup_stored_answer_sync, q, k, filters)
+
+
+async def lookup_cached_answer(q_emb: np.ndarray, k: int,
+                               filters: Optional[Dict[str, Any]] = None):
+    """Return a cached answer for a semantically equivalent query, if any."""
+    await run_in_threadpool(refresh_cache_fingerprint)
+    if not answer_cache.enabled:
+        return None
+    hit = answer_cache.lookup(q_emb[0], k, scope=filters_key(filters))
+    if hit is not None:
+        log_event(logging.INFO, "answer_cache_hit", cached_query=hit.query)
+    return hit
+
+
+async def answer_query(q: str, k: int,
+                       filters: Optional[Dict[str, Any]] = None) -> Tuple[QueryResponse, StageTimer]:
+    """Run the /query pipeline for one question: embed, cache, retrieve, pack, generate."""
+    timer = StageTimer()
+
+    # Answered before (possibly before a restart): no embedding needed
+    with timer.stage("cache"):
+        stored = await lookup_stored_answer(q, k, filters)
+    if stored is not None:
+        return QueryResponse(answer=stored.answer, sources=stored.sources,
+                             backend=stored.backend or None), timer
 
-        response = requests.post(
-            "https://openrouter.ai/api/v1/chat/completions",
-            json=payload,
-            headers=headers
-        )
+    # Step 1: Embed query
+    with timer.stage("embed"):
+        q_emb = await embedding_batcher.embed_async([q])
 
-        if response.status_code != 200:
-            print(" OpenRouter Error:", response.text)
-            return f"Error: OpenRouter returned {response.status_code}"
+    # Serve semantically equivalent repeats from the cache
+    with timer.stage("cache"):
+        cached = await lookup_cached_answer(q_emb, k, filters)
+    if cached is not None:
+        return QueryResponse(answer=cached.answer, sources=cached.sources,
+                             backend=cached.backend or None), timer
 
-        data = response.json()
-        return data["choices"][0]["message"]["content"]
+    # Step 2: Retrieve relevant passages (filters are pushed into the index)
+    with timer.stage("retrieve"):
+        retrieved = await retrieve_for_query(q, q_emb, k, filters)
 
-    except Exception as e:
-        print("Error calling OpenRouter:", e)
-        return f"Error generating response: {str(e)}"
+    # Step 3: Pack passages into the context token budget
+    with timer.stage("pack"):
+        context, retrieved, usage = await run_in_threadpool(pack_context, q, q_emb, retrieved)
+
+    # Step 4: Generate the answer (remote model, or locally on fallback)
+    generation = await generator.generate(q, context, q_emb[0], retrieved, timer)
+    cache_answer(q, q_emb, k, generation, retrieved, filters)
+    record_llm_usage(generation)
+
+    # Step 5: Prepare sources
+    sources = [
+        Source(chunk=r["document"], metadata=public_metadata(r["metadata"]))
+        for r in retrieved
+    ]
+
+    return QueryResponse(answer=generation.text, sources=sources, usage=usage,
+                         backend=generation.backend,
+                         fallback_reason=generation.fallback_reason), timer
 
 
-# ======== FastAPI Endpoint ========
 @app.post("/query", response_model=QueryResponse)
-def query_endpoint(body: QueryRequest):
-    """Main RAG endpoint with retrieval and generation."""
+async def query_endpoint(body: QueryRequest, response: Response):
+    """Main RAG endpoint with retrieval and generation.
+
+    Identical questions (same normalized text, k and filters) that arrive
+    while one is being answered wait for that answer instead of repeating
+    the embedding, retrieval and LLM call.
+    """
     q = body.query.strip()
     k = body.k or 5
 
     if not q:
         raise HTTPException(status_code=400, detail="Query text is empty")
+    ensure_loaded()
 
-    print(f"\n Query: {q}")
+    log_event(logging.INFO, "query", query=q, k=k)
+    filters = request_filters(body.filters)
 
-    # Step 1: Embed query
-    q_emb = embed_text([q])
-
-    # Step 2: Retrieve relevant passages
-    retrieved = retrieve_with_chroma(q_emb, k)
-    print(f" Retrieved {len(retrieved)} passages")
-
-    # Step 3: Format context
-    context = format_context(retrieved)
+    wait_timer = StageTimer()
+    with wait_timer.stage("coalesced"):
+        (result, timer), coalesced = await query_flights.do(
+            (normalize_query(q), k, filters_key(filters)),
+            lambda: answer_query(q, k, filters),
+        )
+    if coalesced:
+        # The stages ran on another request's timer; this one only waited
+        log_event(logging.INFO, "query_coalesced")
+        timer = wait_timer
+    response.headers["Server-Timing"] = timer.header()
+    return result.copy(update={"profile": record_timings("query", timer)})
+
+
+@app.post("/query/batch", response_model=BatchQueryResponse)
+async def query_batch_endpoint(body: BatchQueryRequest, response: Response):
+    """Answer many questions with one embedding batch and one Chroma query.
+
+    Cached answers are served directly; the remaining LLM calls are issued
+    together and spread across the API keys by the scheduler.
+    """
+    queries = [q.strip() for q in body.queries]
+    k = body.k or 5
 
-    # Step 4: Generate answer with Gemini
-    answer = generate_answer_with_gemini(q, context)
+    if not queries:
+        raise HTTPException(status_code=400, detail="No queries given")
+    if len(queries) > MAX_BATCH_QUERIES:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Too many queries ({len(queries)} > {MAX_BATCH_QUERIES})",
+        )
+    if not all(queries):
+        raise HTTPException(status_code=400, detail="Query text is empty")
+    ensure_loaded()
+
+    log_event(logging.INFO, "batch", queries=len(queries), k=k)
+    filters = request_filters(body.filters)
+    timer = StageTimer()
+
+    results: List[Optional[QueryResponse]] = [None] * len(queries)
+    if answer_store is not None:
+        with timer.stage("cache"):
+            stored_rows = await run_in_threadpool(
+                lambda: [lookup_stored_answer_sync(q, k, filters) for q in queries])
+        for i, stored in enumerate(stored_rows):
+            if stored is not None:
+                results[i] = QueryResponse(answer=stored.answer, sources=stored.sources,
+                                           backend=stored.backend or None)
+    unanswered = [i for i, result in enumerate(results) if result is None]
+
+    # Step 1: Embed the queries not answered from disk in one batch; row[i]
+    # is query i's row in q_embs
+    row = {i: n for n, i in enumerate(unanswered)}
+    if unanswered:
+        with timer.stage("embed"):
+            q_embs = await embedding_batcher.embed_async([queries[i] for i in unanswered])
+
+    pending = []
+    with timer.stage("cache"):
+        for i in unanswered:
+            cached = await lookup_cached_answer(q_embs[row[i]:row[i] + 1], k, filters)
+            if cached is not None:
+                results[i] = QueryResponse(answer=cached.answer, sources=cached.sources,
+                                           backend=cached.backend or None)
+            else:
+                pending.append(i)
+
+    if pending:
+        # Step 2: One multi-vector retrieval for all uncached queries
+        with timer.stage("retrieve"):
+            retrieved_rows = await run_in_threadpool(
+                retrieve_many, q_embs[[row[i] for i in pending]], k,
+                [queries[i] for i in pending], filters
+            )
+
+        # Step 3: Pack each query's passages into the context budget
+        with timer.stage("pack"):
+            packed_rows = await asyncio.gather(*[
+                run_in_threadpool(pack_context, queries[i], q_embs[row[i]:row[i] + 1],
+                                  retrieved)
+                for i, retrieved in zip(pending, retrieved_rows)
+            ])
+
+        # Step 4: Schedule all generations together under the key budget
+        # (wall time of the whole group; per-call key waits overlap). The
+        # deadline, if any, runs from the arrival of the batch. Repeats of a
+        # question (in this batch or in other batches) share one call.
+        def generate_one(i: int, context: str, retrieved: List[Dict[str, Any]]):
+            return generation_flights.do(
+                (normalize_query(queries[i]), k, filters_key(filters)),
+                lambda: generator.generate(queries[i], context, q_embs[row[i]], retrieved,
+                                           started=timer.start),
+            )
+
+        with timer.stage("generate"):
+            generations = await asyncio.gather(*[
+                generate_one(i, context, retrieved)
+                for i, (context, retrieved, _) in zip(pending, packed_rows)
+            ])
+
+        for i, (_, retrieved, usage), (generation, coalesced) in zip(pending, packed_rows,
+                                                                     generations):
+            if not coalesced:  # the call that ran it caches and counts it
+                cache_answer(queries[i], q_embs[row[i]:row[i] + 1], k, generation, retrieved,
+                             filters)
+                record_llm_usage(generation)
+            results[i] = QueryResponse(
+                answer=generation.text,
+                sources=[Source(chunk=r["document"], metadata=public_metadata(r["metadata"]))
+                         for r in retrieved],
+                usage=usage,
+                backend=generation.backend,
+                fallback_reason=generation.fallback_reason,
+            )
+
+    response.headers["Server-Timing"] = timer.header()
+    return BatchQueryResponse(results=results, profile=record_timings("batch", timer))
+
+
+@app.post("/query/stream")
+async def query_stream_endpoint(body: QueryRequest):
+    """Streaming RAG endpoint (server-sent events).
+
+    Emits a `sources` event as soon as retrieval finishes, then one `token`
+    event per upstream delta, and finally `done` (or `error`).
+    """
+    q = body.query.strip()
+    k = body.k or 5
 
-    # Step 5: Prepare sources
+    if not q:
+        raise HTTPException(status_code=400, detail="Query text is empty")
+    ensure_loaded()
+
+    log_event(logging.INFO, "stream_query", query=q, k=k)
+    filters = request_filters(body.filters)
+    timer = StageTimer()
+
+    with timer.stage("cache"):
+        cached = await lookup_stored_answer(q, k, filters)
+    if cached is None:
+        with timer.stage("embed"):
+            q_emb = await embedding_batcher.embed_async([q])
+        with timer.stage("cache"):
+            cached = await lookup_cached_answer(q_emb, k, filters)
+
+    if cached is not None:
+        async def cached_stream():
+            yield sse_event("sources", cached.sources)
+            yield sse_event("token", {"text": cached.answer})
+            yield sse_event("done", {"cached": True, "backend": cached.backend or None,
+                                     "profile": record_timings("stream", timer)})
+
+        return StreamingResponse(cached_stream(), media_type="text/event-stream",
+                                 headers={"Cache-Control": "no-cache",
+                                          "Server-Timing": timer.header()})
+
+    async def retrieve_and_pack():
+        with timer.stage("retrieve"):
+            retrieved = await retrieve_for_query(q, q_emb, k, filters)
+        with timer.stage("pack"):
+            return await run_in_threadpool(pack_context, q, q_emb, retrieved)
+
+    # Tokens are streamed per client, but identical concurrent questions
+    # share the retrieval and packing
+    t0 = time.perf_counter()
+    (context, retrieved, usage), coalesced = await retrieval_flights.do(
+        (normalize_query(q), k, filters_key(filters)), retrieve_and_pack)
+    if coalesced:
+        timer.add("coalesced", time.perf_counter() - t0)
     sources = [
-        Source(chunk=r["document"], metadata=r["metadata"])
+        Source(chunk=r["document"], metadata=public_metadata(r["metadata"])).dict()
         for r in retrieved
     ]
 
-    return QueryResponse(answer=answer, sources=sources)
+    async def event_stream():
+        yield sse_event("sources", sources)
+        generation = Generation("", generator.mode)
+        try:
+            async for delta in generator.stream(q, context, q_emb[0], retrieved, generation, timer):
+                yield sse_event("token", {"text": delta})
+        except httpx.TimeoutException as e:
+            log_event(logging.ERROR, "llm_stream_timeout", error=repr(e))
+            yield sse_event("error", {"detail": "OpenRouter request timed out"})
+            return
+        except Exception as e:
+            log_event(logging.ERROR, "llm_stream_error", error=str(e))
+            yield sse_event("error", {"detail": f"Error generating response: {e}"})
+            return
+        cache_answer(q, q_emb, k, generation, retrieved, filters)
+        # Unlike the header, the histograms and profile see the generation stages too
+        yield sse_event("done", {"usage": usage, "backend": generation.backend,
+                                 "fallback_reason": generation.fallback_reason,
+                                 "profile": record_timings("stream", timer)})
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        # Headers go out before generation, so this covers the stages up to packing
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no",
+                 "Server-Timing": timer.header()},
+    )
 
 
 @app.get("/health")
 def health_check():
-    """Health check endpoint."""
+    """Liveness: the process is up (models may still be loading, see /ready)."""
     return {
         "status": "healthy",
+        "ready": readiness["warmed_up"],
         "api_keys_loaded": len(API_KEYS),
-        "collection": collection.name if collection else None
+        "key_scheduler": api_key_manager.stats(),
+        "answer_cache": answer_cache.stats(),
+        "answer_store": answer_store.stats() if answer_store is not None else None,
+        "context_packer": context_packer.stats(),
+        "generator": generator.stats(),
+        "single_flight": {f.name: f.stats()
+                          for f in (query_flights, retrieval_flights, generation_flights)},
+        "embedding_batcher": embedding_batcher.stats() if embedding_batcher else None,
+        "collection": collection.name if collection else None,
+        "retrieval_backend": RETRIEVAL_BACKEND,
+        "retrieval_granularity": RETRIEVAL_GRANULARITY,
+        "memory": memory_report(),
     }
 
 
+def collect_component_metrics() -> List[Sample]:
+    """Counters the components already keep, read at scrape time."""
+    samples = []
+    keys = api_key_manager.stats()
+    for key in keys["per_key"]:
+        label = {"key": str(key["index"])}
+        samples.append(Sample("rag_key_calls_total", "counter", "Calls scheduled per API key",
+                              label, key["calls"]))
+        samples.append(Sample("rag_key_errors_total", "counter", "Failed upstream calls per API key",
+                              label, key["errors"]))
+    samples.append(Sample("rag_key_waiting", "gauge", "Requests sleeping for a key slot",
+                          {}, keys["waiting"]))
+    samples.append(Sample("rag_key_rejected_total", "counter",
+                          "Key reservations refused for exceeding the wait budget",
+                          {}, keys["rejected"]))
+    if "lock_wait_s" in keys:
+        samples.append(Sample("rag_key_state_lock_wait_seconds_total", "counter",
+                              "Time this process waited for the shared key state lock",
+                              {}, keys["lock_wait_s"]))
+        samples.append(Sample("rag_key_state_transactions_total", "counter",
+                              "Reservations made against the shared key state",
+                              {}, keys["transactions"]))
+
+    cache = answer_cache.stats()
+    samples += [
+        Sample("rag_answer_cache_hits_total", "counter", "Answer cache hits", {}, cache["hits"]),
+        Sample("rag_answer_cache_misses_total", "counter", "Answer cache misses", {}, cache["misses"]),
+        Sample("rag_answer_cache_hit_ratio", "gauge", "Answer cache hit ratio", {}, cache["hit_rate"]),
+        Sample("rag_answer_cache_entries", "gauge", "Answer cache size", {}, cache["size"]),
+    ]
+
+    if answer_store is not None:
+        store = answer_store.stats()
+        samples += [
+            Sample("rag_answer_store_hits_total", "counter", "Persistent answer cache hits",
+                   {}, store["hits"]),
+            Sample("rag_answer_store_misses_total", "counter", "Persistent answer cache misses",
+                   {}, store["misses"]),
+            Sample("rag_answer_store_entries", "gauge", "Persistent answer cache size",
+                   {}, store["size"]),
+            Sample("rag_answer_store_evictions_total", "counter",
+                   "Persistent answer cache entries expired or evicted", {}, store["evictions"]),
+            Sample("rag_answer_store_errors_total", "counter",
+                   "Persistent answer cache writes that failed", {}, store["errors"]),
+        ]
+
+    packer = context_packer.stats()
+    sentences = packer["sentence_cache"]
+    lookups = sentences["hits"] + sentences["misses"]
+    samples += [
+        Sample("rag_context_tokens_total", "counter", "Context tokens before/after packing",
+               {"kind": "retrieved"}, packer["tokens_in"]),
+        Sample("rag_context_tokens_total", "counter", "Context tokens before/after packing",
+               {"kind": "sent"}, packer["tokens_used"]),
+        Sample("rag_sentence_cache_hit_ratio", "gauge", "Sentence embedding cache hit ratio",
+               {}, sentences["hits"] / lookups if lookups else 0.0),
+    ]
+
+    gen = generator.stats()
+    for backend, count in gen["answers"].items():
+        samples.append(Sample("rag_answers_total", "counter", "Answers by generator backend",
+                              {"backend": backend}, count))
+    for reason, count in gen["fallbacks"].items():
+        samples.append(Sample("rag_generator_fallbacks_total", "counter",
+                              "Local fallbacks by reason", {"reason": reason}, count))
+
+    for flight in (query_flights, retrieval_flights, generation_flights):
+        samples.append(Sample("rag_coalesced_requests_total", "counter",
+                              "Requests that waited for an identical in-flight request",
+                              {"flight": flight.name}, flight.coalesced))
+
+    memory = process_memory()
+    if memory is not None:
+        worker = worker_id()
+        for kind in ("rss", "pss", "uss"):
+            samples.append(Sample("rag_process_memory_bytes", "gauge",
+                                  "Resident memory of this worker (uss = private pages)",
+                                  {"kind": kind, "worker": "-" if worker is None else str(worker)},
+                                  memory[f"{kind}_mb"] * 1024 * 1024))
+
+    if embedding_batcher is not None:
+        batcher = embedding_batcher.stats()
+        samples.append(Sample("rag_embedding_batches_total", "counter", "Embedding batches encoded",
+                              {}, batcher["batches"]))
+        samples.append(Sample("rag_embedding_texts_total", "counter", "Texts embedded",
+                              {}, batcher["texts"]))
+    return samples
+
+
+metrics_registry.add_collector(collect_component_metrics)
+
+
+@app.get("/metrics")
+def metrics_endpoint():
+    """Prometheus text exposition of the metrics above."""
+    return PlainTextResponse(metrics_registry.render(),
+                             media_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+@app.get("/ready")
+def readiness_check():
+    """Readiness: 200 once the embedder and index are loaded and warmed up."""
+    if readiness["error"] or not readiness["warmed_up"]:
+        return JSONResponse(status_code=503, content={"status": "not ready", **readiness})
+    return {"status": "ready", **readiness}
+
+
 # ======== Run Server ========
 if __name__ == "__main__":
     import uvicorn
@@ -382,7 +1312,7 @@ if __name__ == "__main__":
     print("="*60)
     print(f" API Keys loaded: {len(API_KEYS)}")
     print(
-        f" Cooldown: {api_key_manager.cooldown_min}-{api_key_manager.cooldown_max}s")
+        f" Cooldown per key: {api_key_manager.cooldown_min}-{api_key_manager.cooldown_max}s")
     print(f" Server starting at http://127.0.0.1:8002")
     print("="*60 + "\n")
 
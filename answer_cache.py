@@ -0,0 +1,349 @@
+"""
+Answer caches: in-memory semantic matches and a persistent exact-match store.
+
+SemanticAnswerCache: a lookup returns a stored answer (and its sources) when
+the new query's embedding is within `threshold` cosine similarity of a
+cached query asked with the same `k` and scope (a string naming e.g. the
+retrieval filters). Entries expire after `ttl_seconds`, the least recently
+used entry is evicted once `max_entries` is reached, and everything is
+dropped when the index fingerprint changes.
+
+PersistentAnswerCache: answers in a SQLite file that survives restarts and
+is shared by worker processes. It is checked before the query is even
+embedded, by an exact key over the normalized query text, k, scope, prompt
+version, model and collection fingerprint. A new prompt, model or index
+simply misses, and its old entries age out through the TTL and the LRU
+size limit.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+from pipeline_log import log_event
+from singleflight import normalize_query
+
+
+@dataclass
+class CacheEntry:
+    query: str
+    k: int
+    embedding: Optional[np.ndarray]  # None for PersistentAnswerCache entries
+    answer: str
+    sources: List[Dict[str, Any]]
+    scope: str = ""
+    backend: str = ""  # generator that produced the answer
+    created: float = field(default_factory=time.monotonic)
+
+
+class SemanticAnswerCache:
+    def __init__(self, max_entries: int = 256, threshold: float = 0.92,
+                 ttl_seconds: float = 3600.0):
+        self.max_entries = max_entries
+        self.threshold = threshold
+        self.ttl_seconds = ttl_seconds
+        self.fingerprint: Optional[str] = None
+
+        self._entries: "OrderedDict[int, CacheEntry]" = OrderedDict()
+        self._next_id = 0
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_entries > 0
+
+    @staticmethod
+    def _normalize(embedding: np.ndarray) -> np.ndarray:
+        vec = np.asarray(embedding, dtype=np.float32).reshape(-1)
+        norm = np.linalg.norm(vec)
+        return vec / norm if norm > 0 else vec
+
+    def _expire(self, now: float):
+        expired = [eid for eid, e in self._entries.items()
+                   if now - e.created > self.ttl_seconds]
+        for eid in expired:
+            del self._entries[eid]
+        self.evictions += len(expired)
+
+    def check_fingerprint(self, fingerprint: str):
+        """Drop every entry if the underlying index has changed."""
+        with self._lock:
+            if self.fingerprint is not None and fingerprint != self.fingerprint:
+                print(f" Answer cache invalidated ({len(self._entries)} entries): index changed")
+                self._entries.clear()
+                self.invalidations += 1
+            self.fingerprint = fingerprint
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.invalidations += 1
+
+    def lookup(self, embedding: np.ndarray, k: int, scope: str = "") -> Optional[CacheEntry]:
+        """Return the most similar cached entry for `k` and `scope`, if above threshold."""
+        if not self.enabled:
+            return None
+        query = self._normalize(embedding)
+
+        with self._lock:
+            self._expire(time.monotonic())
+            candidates = [(eid, e) for eid, e in self._entries.items() if e.k == k and e.scope == scope]
+            if candidates:
+                matrix = np.stack([e.embedding for _, e in candidates])
+                sims = matrix @ query
+                best = int(np.argmax(sims))
+                if sims[best] >= self.threshold:
+                    eid, entry = candidates[best]
+                    self._entries.move_to_end(eid)
+                    self.hits += 1
+                    return entry
+            self.misses += 1
+            return None
+
+    def store(self, query: str, embedding: np.ndarray, k: int, answer: str,
+              sources: List[Dict[str, Any]], scope: str = "", backend: str = ""):
+        if not self.enabled:
+            return
+        entry = CacheEntry(query=query, k=k, embedding=self._normalize(embedding),
+                           answer=answer, sources=sources, scope=scope,
+                           backend=backend)
+        with self._lock:
+            self._entries[self._next_id] = entry
+            self._next_id += 1
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "enabled": self.enabled,
+            "size": len(self._entries),
+            "max_entries": self.max_entries,
+            "threshold": self.threshold,
+            "ttl_seconds": self.ttl_seconds,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+        }
+
+
+class PersistentAnswerCache:
+    """Exact-match answers in SQLite, keyed on everything that shapes them.
+
+    Lookups run on the caller's thread as one indexed read; in WAL mode a
+    reader never waits for a writer. Stores and the LRU timestamp updates of
+    hits go to a background writer thread with its own connection, so a
+    write waiting on another worker's lock never holds up a request.
+    """
+
+    def __init__(self, path: str, prompt_version: str, model: str,
+                 max_entries: int = 100_000, ttl_seconds: float = 7 * 86400.0,
+                 busy_timeout: float = 5.0):
+        self.path = path
+        self.prompt_version = prompt_version
+        self.model = model
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.busy_timeout = busy_timeout
+        self.fingerprint: Optional[str] = None
+
+        self._conn: Optional[sqlite3.Connection] = None
+        self._conn_pid = None
+        self._write_conn: Optional[sqlite3.Connection] = None
+        self._write_conn_pid = None
+        self._lock = threading.Lock()
+        self._touched: Dict[str, float] = {}  # hit key -> last_used, not yet written
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="answer-store")
+
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+        self.errors = 0  # background writes that failed (the answer is not stored)
+        with self._lock:
+            count = self._connection().execute("SELECT COUNT(*) FROM answers").fetchone()[0]
+        print(f" Persistent answer cache: {path} ({count} entries)")
+
+    @classmethod
+    def from_env(cls, prompt_version: str, model: str) -> Optional["PersistentAnswerCache"]:
+        """The cache at ANSWER_CACHE_DB, or None when that is unset."""
+        path = os.environ.get("ANSWER_CACHE_DB", "").strip()
+        if not path:
+            return None
+        return cls(
+            path, prompt_version, model,
+            max_entries=int(os.environ.get("ANSWER_CACHE_DB_MAX_ENTRIES", 100_000)),
+            ttl_seconds=float(os.environ.get("ANSWER_CACHE_DB_TTL", 7 * 86400)),
+        )
+
+    def _open(self) -> sqlite3.Connection:
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        conn = sqlite3.connect(self.path, timeout=self.busy_timeout, isolation_level=None,
+                               check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS answers ("
+            " key TEXT PRIMARY KEY, query TEXT NOT NULL, k INTEGER NOT NULL,"
+            " scope TEXT NOT NULL, prompt_version TEXT NOT NULL, model TEXT NOT NULL,"
+            " fingerprint TEXT NOT NULL, answer TEXT NOT NULL, sources TEXT NOT NULL,"
+            " backend TEXT NOT NULL, created REAL NOT NULL, last_used REAL NOT NULL)"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS answers_last_used ON answers (last_used)")
+        return conn
+
+    def _connection(self) -> sqlite3.Connection:
+        """This process's read connection (used under self._lock; reopened after fork)."""
+        if self._conn_pid != os.getpid():
+            self._conn, self._conn_pid = self._open(), os.getpid()
+        return self._conn
+
+    def _writer_connection(self) -> sqlite3.Connection:
+        """The writer thread's own connection: waiting for another process's
+        write lock there never holds self._lock."""
+        if self._write_conn_pid != os.getpid():
+            self._write_conn, self._write_conn_pid = self._open(), os.getpid()
+        return self._write_conn
+
+    def check_fingerprint(self, fingerprint: str):
+        """Key later lookups and stores on the current index fingerprint."""
+        self.fingerprint = fingerprint
+
+    def key(self, query: str, k: int, scope: str = "") -> str:
+        parts = [normalize_query(query), k, scope, self.prompt_version, self.model,
+                 self.fingerprint]
+        return hashlib.sha256(json.dumps(parts).encode("utf-8")).hexdigest()
+
+    def lookup(self, query: str, k: int, scope: str = "") -> Optional[CacheEntry]:
+        if self.fingerprint is None:
+            return None
+        key = self.key(query, k, scope)
+        now = time.time()
+        with self._lock:
+            conn = self._connection()
+            row = conn.execute(
+                "SELECT query, answer, sources, backend FROM answers"
+                " WHERE key = ? AND created >= ?",
+                (key, now - self.ttl_seconds),
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            schedule = not self._touched
+            self._touched[key] = now
+        if schedule:
+            self._submit("touch", self._write_touches)
+        cached_query, answer, sources, backend = row
+        return CacheEntry(query=cached_query, k=k, embedding=None, answer=answer,
+                          sources=json.loads(sources), scope=scope, backend=backend)
+
+    def store(self, query: str, k: int, answer: str, sources: List[Dict[str, Any]],
+              scope: str = "", backend: str = ""):
+        """Queue an answer for writing (returns immediately)."""
+        if self.fingerprint is None:
+            return
+        row = (self.key(query, k, scope), query, k, scope, self.prompt_version, self.model,
+               self.fingerprint, answer, json.dumps(sources, ensure_ascii=False), backend)
+        self._submit("store", self._write, row)
+
+    def _submit(self, operation: str, fn, *args):
+        self._writer.submit(fn, *args).add_done_callback(
+            lambda future: self._check_write(operation, future))
+
+    def _check_write(self, operation: str, future: Future):
+        error = future.exception()
+        if error is None:
+            return
+        with self._lock:
+            self.errors += 1
+        log_event(logging.ERROR, "answer_store_error", operation=operation, path=self.path,
+                  error=f"{type(error).__name__}: {error}")
+
+    def _write(self, row):
+        now = time.time()
+        conn = self._writer_connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute(
+                "INSERT OR REPLACE INTO answers (key, query, k, scope, prompt_version,"
+                " model, fingerprint, answer, sources, backend, created, last_used)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                row + (now, now),
+            )
+            expired = conn.execute("DELETE FROM answers WHERE created < ?",
+                                   (now - self.ttl_seconds,)).rowcount
+            excess = conn.execute("SELECT COUNT(*) FROM answers").fetchone()[0] - self.max_entries
+            if excess > 0:
+                conn.execute(
+                    "DELETE FROM answers WHERE key IN"
+                    " (SELECT key FROM answers ORDER BY last_used LIMIT ?)", (excess,))
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        with self._lock:
+            self.stores += 1
+            self.evictions += expired + max(0, excess)
+
+    def _write_touches(self):
+        """Write the LRU timestamps of the hits since the last call in one transaction."""
+        with self._lock:
+            touched, self._touched = self._touched, {}
+        if not touched:
+            return
+        conn = self._writer_connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.executemany("UPDATE answers SET last_used = ? WHERE key = ?",
+                             [(used, key) for key, used in touched.items()])
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    def flush(self):
+        """Wait for queued stores to be written."""
+        self._writer.submit(lambda: None).result()
+
+    def close(self):
+        self._writer.shutdown(wait=True)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            size = self._connection().execute("SELECT COUNT(*) FROM answers").fetchone()[0]
+        lookups = self.hits + self.misses
+        return {
+            "path": self.path,
+            "size": size,
+            "max_entries": self.max_entries,
+            "ttl_seconds": self.ttl_seconds,
+            "prompt_version": self.prompt_version,
+            "model": self.model,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "stores": self.stores,
+            "evictions": self.evictions,
+            "errors": self.errors,
+        }
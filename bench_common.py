@@ -0,0 +1,124 @@
+"""
+Helpers shared by the benchmark scripts (bench_*.py).
+"""
+
+import json
+import math
+import os
+import subprocess
+import sys
+import time
+import urllib.request
+from contextlib import contextmanager
+from typing import Dict, List, Optional
+
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Sample questions for the embedding benchmarks (kept here, free of model
+# imports, so a backend's worker process loads only that backend)
+QUERIES = [
+    "Who warns Caesar about the Ides of March?",
+    "Why does Brutus join the conspiracy?",
+    "What does Antony say at Caesar's funeral?",
+    "How does Portia prove her constancy?",
+    "Where do Brutus and Cassius quarrel?",
+    "What omens appear the night before Caesar's death?",
+    "Who is the last to stab Caesar?",
+    "How does Cassius die?",
+]
+
+
+def percentile(values: List[float], pct: float) -> float:
+    """Nearest-rank percentile (pct in 0-100) of an unsorted list."""
+    if not values:
+        return float("nan")
+    ordered = sorted(values)
+    rank = max(1, math.ceil(pct / 100.0 * len(ordered)))
+    return ordered[rank - 1]
+
+
+def summarize(latencies: List[float], wall_time: float) -> Dict[str, Optional[float]]:
+    """Latency distribution (ms) and throughput for one benchmark run.
+
+    The latency fields are None when there are no latencies (NaN is not
+    valid JSON).
+    """
+    n = len(latencies)
+    row: Dict[str, Optional[float]] = {
+        "requests": n,
+        "wall_s": round(wall_time, 3),
+        "throughput_rps": round(n / wall_time, 2) if wall_time > 0 else 0.0,
+    }
+    if not n:
+        return dict(row, mean_ms=None, p50_ms=None, p95_ms=None, p99_ms=None, max_ms=None)
+    return dict(
+        row,
+        mean_ms=round(1000 * sum(latencies) / n, 2),
+        p50_ms=round(1000 * percentile(latencies, 50), 2),
+        p95_ms=round(1000 * percentile(latencies, 95), 2),
+        p99_ms=round(1000 * percentile(latencies, 99), 2),
+        max_ms=round(1000 * max(latencies), 2),
+    )
+
+
+def stage_summary(timings: List[Dict[str, float]]) -> Dict[str, Dict[str, float]]:
+    """Per-stage mean/p50/p95/p99 (ms) over parsed Server-Timing dicts."""
+    stages: Dict[str, List[float]] = {}
+    for row in timings:
+        for stage, ms in row.items():
+            stages.setdefault(stage, []).append(ms)
+    return {
+        stage: {
+            "mean": round(sum(values) / len(values), 2),
+            "p50": round(percentile(values, 50), 2),
+            "p95": round(percentile(values, 95), 2),
+            "p99": round(percentile(values, 99), 2),
+        }
+        for stage, values in stages.items()
+    }
+
+
+def wait_for_http(url: str, timeout: float = 60.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with urllib.request.urlopen(url, timeout=1) as resp:
+                if resp.status == 200:
+                    return
+        except Exception:
+            time.sleep(0.2)
+    raise RuntimeError(f"Timed out waiting for {url}")
+
+
+@contextmanager
+def fake_openrouter(port: int = 8090, latency: float = 0.5, tokens: int = 40,
+                    tokens_per_sec: float = 200.0):
+    """Run fake_openrouter.py in a subprocess; yields its completions URL."""
+    proc = subprocess.Popen(
+        [sys.executable, os.path.join(BASE_DIR, "fake_openrouter.py"),
+         "--port", str(port), "--latency", str(latency),
+         "--tokens", str(tokens), "--tokens-per-sec", str(tokens_per_sec)],
+    )
+    try:
+        wait_for_http(f"http://127.0.0.1:{port}/stats")
+        yield f"http://127.0.0.1:{port}/api/v1/chat/completions"
+    finally:
+        proc.terminate()
+        proc.wait(timeout=10)
+
+
+def print_table(rows: Dict[str, Dict[str, float]]):
+    if not rows:
+        return
+    columns = list(next(iter(rows.values())).keys())
+    name_width = max(len(name) for name in rows) + 2
+    print("".ljust(name_width) + "".join(c.rjust(16) for c in columns))
+    for name, row in rows.items():
+        print(name.ljust(name_width) + "".join(str(row[c]).rjust(16) for c in columns))
+
+
+def save_json(path: str, payload):
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(payload, f, indent=2)
+    print(f"Results saved to {path}")
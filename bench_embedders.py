@@ -0,0 +1,105 @@
+"""
+Benchmark: PyTorch SentenceTransformer vs. ONNX Runtime (fp32 / int8) embedders.
+
+Each backend runs in its own subprocess so resident memory is measured in
+isolation. Reports single-query latency percentiles, batched throughput and
+peak RSS after loading and after encoding.
+
+    python onnx_embedder.py export --quantize      # once
+    python bench_embedders.py --backends torch onnx onnx-int8
+"""
+
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+
+from bench_common import QUERIES, print_table, save_json, summarize
+
+
+def rss_mb() -> float:
+    """Current resident set size of this process in MiB (Linux)."""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024.0
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def run_worker(backend: str, model: str, iterations: int, batch_size: int) -> dict:
+    base_rss = rss_mb()
+    t0 = time.perf_counter()
+    if backend == "torch":
+        from embedding import load_embedder
+        embedder = load_embedder(model, "torch")
+    else:
+        from onnx_embedder import OnnxEmbedder, default_onnx_dir
+        embedder = OnnxEmbedder(default_onnx_dir(model), quantized=backend == "onnx-int8")
+    load_s = time.perf_counter() - t0
+    loaded_rss = rss_mb()
+
+    embedder.encode(QUERIES)  # warm-up
+
+    latencies = []
+    start = time.perf_counter()
+    for i in range(iterations):
+        t = time.perf_counter()
+        embedder.encode([QUERIES[i % len(QUERIES)]])
+        latencies.append(time.perf_counter() - t)
+    row = summarize(latencies, time.perf_counter() - start)
+
+    batch = [QUERIES[i % len(QUERIES)] for i in range(batch_size)]
+    rounds = max(1, iterations // batch_size)
+    start = time.perf_counter()
+    for _ in range(rounds):
+        embedder.encode(batch, batch_size=batch_size)
+    row["batched_texts_per_s"] = round(rounds * batch_size / (time.perf_counter() - start), 1)
+
+    row.update({
+        "load_s": round(load_s, 2),
+        "rss_loaded_mb": round(loaded_rss - base_rss, 1),
+        "rss_total_mb": round(rss_mb(), 1),
+    })
+    return row
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Torch vs. ONNX embedder latency/throughput/RSS")
+    parser.add_argument("--backends", nargs="+", default=["torch", "onnx", "onnx-int8"],
+                        choices=["torch", "onnx", "onnx-int8"])
+    parser.add_argument("--model", default=os.environ.get("EMBED_MODEL", "all-MiniLM-L6-v2"))
+    parser.add_argument("--iterations", type=int, default=500)
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--output", default=None, help="optional JSON results path")
+    parser.add_argument("--worker", default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        print(json.dumps(run_worker(args.worker, args.model, args.iterations, args.batch_size)))
+        return
+
+    rows = {}
+    for backend in args.backends:
+        proc = subprocess.run(
+            [sys.executable, __file__, "--worker", backend, "--model", args.model,
+             "--iterations", str(args.iterations), "--batch-size", str(args.batch_size)],
+            capture_output=True, text=True,
+        )
+        if proc.returncode != 0:
+            print(f"{backend}: FAILED\n{proc.stderr.strip()[-500:]}")
+            continue
+        rows[backend] = json.loads(proc.stdout.strip().splitlines()[-1])
+
+    print_table(rows)
+    if args.output:
+        save_json(args.output, {"benchmark": "embedders", "args": vars(args), "results": rows})
+
+
+if __name__ == "__main__":
+    main()
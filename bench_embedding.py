@@ -0,0 +1,72 @@
+"""
+Benchmark: per-request encode vs. the micro-batching EmbeddingBatcher.
+
+Simulates N concurrent request threads, each embedding one query at a time,
+and reports embeddings/sec plus per-call latency percentiles for both paths.
+
+    python bench_embedding.py --requests 2000 --concurrency 32
+"""
+
+import argparse
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from sentence_transformers import SentenceTransformer
+
+from bench_common import QUERIES, print_table, save_json, summarize
+from embedding import EmbeddingBatcher, encode_with
+
+
+def run(embed_fn, n: int, concurrency: int):
+    def one(i):
+        t0 = time.perf_counter()
+        embed_fn([QUERIES[i % len(QUERIES)]])
+        return time.perf_counter() - t0
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        latencies = list(pool.map(one, range(n)))
+    return summarize(latencies, time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Per-request vs. micro-batched query embedding")
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--wait-ms", type=float, default=2.0)
+    parser.add_argument("--model", default=os.environ.get("EMBED_MODEL", "all-MiniLM-L6-v2"))
+    parser.add_argument("--output", default=None, help="optional JSON results path")
+    args = parser.parse_args()
+
+    model = SentenceTransformer(args.model)
+    encode = encode_with(model)
+    encode(QUERIES)  # warm-up
+
+    # SentenceTransformer is not safe to call from many threads at once, so the
+    # unbatched baseline serializes calls just like a shared model would.
+    lock = threading.Lock()
+
+    def unbatched(texts):
+        with lock:
+            return encode(texts)
+
+    batcher = EmbeddingBatcher(encode, max_batch_size=args.batch_size,
+                               max_wait_ms=args.wait_ms).start()
+    rows = {
+        "per-request": run(unbatched, args.requests, args.concurrency),
+        "micro-batched": run(batcher.embed, args.requests, args.concurrency),
+    }
+    batcher.stop()
+
+    print_table(rows)
+    print(f"\nBatcher: {batcher.stats()}")
+    if args.output:
+        save_json(args.output, {"benchmark": "embedding", "args": vars(args),
+                                "results": rows, "batcher": batcher.stats()})
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+"""
+Benchmark: bare requests.post vs. the pooled OpenRouterClient.
+
+Starts fake_openrouter.py locally and sends the same chat payload through
+both paths at a fixed concurrency. The fake server adds a fixed latency, so
+the difference between the two rows is connection setup and thread overhead.
+
+    python bench_llm_client.py --requests 200 --concurrency 16 --latency 0.05
+"""
+
+import argparse
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from bench_common import fake_openrouter, print_table, save_json, summarize
+from llm_client import LLMClientConfig, OpenRouterClient
+
+
+PAYLOAD = {
+    "model": "fake",
+    "messages": [{"role": "user", "content": "Who kills Caesar?"}],
+    "max_tokens": 20,
+}
+
+
+def run_requests(url: str, n: int, concurrency: int):
+    def one(_):
+        t0 = time.perf_counter()
+        resp = requests.post(url, json=PAYLOAD, headers=OpenRouterClient.headers("bench"))
+        resp.raise_for_status()
+        return time.perf_counter() - t0
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        latencies = list(pool.map(one, range(n)))
+    return summarize(latencies, time.perf_counter() - start)
+
+
+async def run_pooled(url: str, n: int, concurrency: int):
+    client = OpenRouterClient(LLMClientConfig(url=url, max_connections=concurrency,
+                                              max_keepalive=concurrency))
+    await client.start()
+    sem = asyncio.Semaphore(concurrency)
+
+    async def one():
+        async with sem:
+            t0 = time.perf_counter()
+            resp = await client.chat(PAYLOAD, "bench")
+            resp.raise_for_status()
+            return time.perf_counter() - t0
+
+    try:
+        start = time.perf_counter()
+        latencies = await asyncio.gather(*[one() for _ in range(n)])
+        return summarize(list(latencies), time.perf_counter() - start)
+    finally:
+        await client.aclose()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Pooled vs. unpooled LLM HTTP client")
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--port", type=int, default=8090)
+    parser.add_argument("--output", default=None, help="optional JSON results path")
+    args = parser.parse_args()
+
+    with fake_openrouter(port=args.port, latency=args.latency, tokens=20) as url:
+        # Warm the server once so neither row pays its startup
+        requests.post(url, json=PAYLOAD, timeout=10)
+        rows = {
+            "requests.post": run_requests(url, args.requests, args.concurrency),
+            "pooled httpx": asyncio.run(run_pooled(url, args.requests, args.concurrency)),
+        }
+
+    print_table(rows)
+    if args.output:
+        save_json(args.output, {"benchmark": "llm_client", "args": vars(args), "results": rows})
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,254 @@
+"""
+Load test: the full API (Phase4) against the local fake LLM.
+
+Starts fake_openrouter.py with a configurable latency and token rate, starts
+Phase4 under uvicorn pointed at it, then replays a query mix at each of a
+series of fixed concurrency levels (closed loop: every worker sends its next
+request as soon as the previous one returns). For each level it reports
+throughput, the client-side latency distribution and the per-stage breakdown
+from the Server-Timing header.
+
+The query mix is evaluation.json by default, or a query log given with
+--queries: a JSON list, JSONL (one {"query"/"question", "k"?, "filters"?}
+object per line) or plain text with one query per line.
+
+    python bench_loadtest.py --concurrency 1 4 16 --requests 200 --output load.json
+    python bench_loadtest.py --output load_new.json --compare load.json
+
+Results include the git commit so runs from different commits can be diffed;
+--compare prints the throughput and p95 change against an earlier file.
+
+The answer caches, single-flight coalescing and the shared key state are
+disabled by default so every request exercises retrieval and generation,
+whatever the shell sets; use --answer-cache, --answer-store PATH,
+--single-flight and --key-state-db PATH to measure them. The effective
+settings are saved with the results ("server_env"). --burst sends only the first query, like a
+popular question arriving in a burst; each level reports the LLM calls made
+and the requests coalesced onto an identical one in flight. Keys are fake
+and their cooldown is shortened (--key-cooldown) so the test measures the
+service rather than the per-key rate limit.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import time
+from contextlib import contextmanager
+
+import httpx
+
+from bench_common import (BASE_DIR, fake_openrouter, print_table, save_json,
+                          stage_summary, summarize, wait_for_http)
+from timing import parse_server_timing
+from warm_cache import load_queries
+
+
+def git_commit():
+    try:
+        out = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=BASE_DIR,
+                             capture_output=True, text=True, timeout=10)
+        return out.stdout.strip() or None
+    except Exception:
+        return None
+
+
+# Server settings that change what a run measures (saved with the results)
+CACHE_SETTINGS = ("ANSWER_CACHE_SIZE", "ANSWER_CACHE_DB", "KEY_STATE_DB", "SINGLE_FLIGHT")
+
+
+def server_env(llm_url: str, args):
+    """The API server's environment: the shell's, with the caches and shared
+    state set by the flags rather than inherited."""
+    env = dict(os.environ)
+    env.update({
+        "OPENROUTER_URL": llm_url,
+        "GEMINI_API_KEYS": ",".join(f"loadtest-key-{i}" for i in range(args.keys)),
+        "KEY_COOLDOWN_MIN": str(args.key_cooldown),
+        "KEY_COOLDOWN_MAX": str(args.key_cooldown),
+        "WARMUP_ON_STARTUP": "1",
+    })
+    if not args.answer_cache:
+        env["ANSWER_CACHE_SIZE"] = "0"
+    env["SINGLE_FLIGHT"] = "1" if args.single_flight else "0"
+    for name, value in (("ANSWER_CACHE_DB", args.answer_store),
+                        ("KEY_STATE_DB", args.key_state_db)):
+        if value:
+            env[name] = value
+        else:
+            env.pop(name, None)
+    return env
+
+
+@contextmanager
+def api_server(port: int, env, args):
+    """Run Phase4 under uvicorn in a subprocess; yields its base URL."""
+    proc = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "Phase4:app", "--port", str(port),
+         "--log-level", "warning"],
+        cwd=BASE_DIR, env=env,
+        # Phase4 logs every request to stdout; keep the report readable
+        stdout=None if args.verbose else subprocess.DEVNULL,
+    )
+    base_url = f"http://127.0.0.1:{port}"
+    try:
+        wait_for_http(f"{base_url}/ready", timeout=args.startup_timeout)
+        yield base_url
+    finally:
+        proc.terminate()
+        proc.wait(timeout=10)
+
+
+def server_counters(base_url: str):
+    """Totals from /health that a level's report is diffed on."""
+    health = httpx.get(f"{base_url}/health", timeout=10).json()
+    return {
+        "llm_calls": sum(key["calls"] for key in health["key_scheduler"]["per_key"]),
+        "coalesced": sum(f["coalesced"] for f in health["single_flight"].values()),
+    }
+
+
+async def run_level(base_url: str, queries, n: int, concurrency: int, k: int, timeout: float):
+    """Send n requests with `concurrency` in flight; return the level's report."""
+    latencies, timings, errors = [], [], {}
+    next_index = 0
+
+    async def worker(client):
+        nonlocal next_index
+        while next_index < n:
+            query = queries[next_index % len(queries)]
+            next_index += 1
+            body = {"k": k, **query}
+            t0 = time.perf_counter()
+            try:
+                resp = await client.post(f"{base_url}/query", json=body)
+                latency = time.perf_counter() - t0
+                if resp.status_code != 200:
+                    errors[str(resp.status_code)] = errors.get(str(resp.status_code), 0) + 1
+                    continue
+            except httpx.HTTPError as e:
+                errors[type(e).__name__] = errors.get(type(e).__name__, 0) + 1
+                continue
+            latencies.append(latency)
+            timings.append(parse_server_timing(resp.headers.get("Server-Timing", "")))
+
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(timeout=timeout, limits=limits) as client:
+        start = time.perf_counter()
+        await asyncio.gather(*[worker(client) for _ in range(concurrency)])
+        wall_time = time.perf_counter() - start
+
+    return {
+        "concurrency": concurrency,
+        "sent": n,
+        "ok": len(latencies),
+        "errors": errors,
+        **summarize(latencies, wall_time),
+        "server_stages_ms": stage_summary(timings),
+    }
+
+
+def compare(previous_path: str, levels):
+    with open(previous_path, "r", encoding="utf-8") as f:
+        previous = json.load(f)
+    old_levels = {str(level["concurrency"]): level for level in previous.get("levels", [])}
+
+    print(f"\nvs. {previous_path} (commit {previous.get('git_commit') or 'unknown'})")
+    rows = {}
+    for level in levels:
+        old = old_levels.get(str(level["concurrency"]))
+        if not old:
+            continue
+
+        def change(key):
+            if not old.get(key) or level.get(key) is None:
+                return "n/a"
+            return f"{(level[key] - old[key]) / old[key] * 100:+.1f}%"
+
+        rows[f"c={level['concurrency']}"] = {
+            "throughput_rps": change("throughput_rps"),
+            "p50_ms": change("p50_ms"),
+            "p95_ms": change("p95_ms"),
+            "p99_ms": change("p99_ms"),
+        }
+    print_table(rows)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the RAG API against a fake LLM")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 16])
+    parser.add_argument("--requests", type=int, default=100, help="requests per concurrency level")
+    parser.add_argument("--queries", default="evaluation.json",
+                        help="evaluation.json or a query log (JSON, JSONL or text)")
+    parser.add_argument("--k", type=int, default=5, help="default k when a query has none")
+    parser.add_argument("--latency", type=float, default=0.3, help="fake LLM time to first token (s)")
+    parser.add_argument("--tokens", type=int, default=40, help="fake LLM tokens per answer")
+    parser.add_argument("--tokens-per-sec", type=float, default=200.0)
+    parser.add_argument("--keys", type=int, default=8, help="number of fake API keys")
+    parser.add_argument("--key-cooldown", type=float, default=0.01,
+                        help="seconds between calls on one key (production: 6-7)")
+    parser.add_argument("--answer-cache", action="store_true", help="keep the answer cache enabled")
+    parser.add_argument("--answer-store", default=None,
+                        help="persistent answer cache file (ANSWER_CACHE_DB; default off)")
+    parser.add_argument("--key-state-db", default=None,
+                        help="shared key scheduler file (KEY_STATE_DB; default off)")
+    parser.add_argument("--single-flight", action="store_true",
+                        help="coalesce identical in-flight queries (SINGLE_FLIGHT=1)")
+    parser.add_argument("--burst", action="store_true",
+                        help="send only the first query (one popular question)")
+    parser.add_argument("--timeout", type=float, default=120.0, help="per-request timeout (s)")
+    parser.add_argument("--llm-port", type=int, default=8090)
+    parser.add_argument("--api-port", type=int, default=8012)
+    parser.add_argument("--startup-timeout", type=float, default=300.0)
+    parser.add_argument("--verbose", action="store_true", help="show the API server's output")
+    parser.add_argument("--output", default=None, help="optional JSON results path")
+    parser.add_argument("--compare", default=None, help="earlier --output file to diff against")
+    args = parser.parse_args()
+
+    queries = load_queries(args.queries)
+    if args.burst:
+        queries = queries[:1]
+    print(f"{len(queries)} queries from {args.queries}")
+
+    levels = []
+    with fake_openrouter(port=args.llm_port, latency=args.latency, tokens=args.tokens,
+                         tokens_per_sec=args.tokens_per_sec) as llm_url:
+        env = server_env(llm_url, args)
+        settings = {name: env.get(name) for name in CACHE_SETTINGS}
+        print("Server settings: " + " ".join(f"{name}={value}" for name, value in settings.items()))
+        with api_server(args.api_port, env, args) as base_url:
+            for concurrency in args.concurrency:
+                print(f"Concurrency {concurrency}: {args.requests} requests...")
+                before = server_counters(base_url)
+                level = asyncio.run(run_level(base_url, queries, args.requests,
+                                              concurrency, args.k, args.timeout))
+                after = server_counters(base_url)
+                level.update({name: after[name] - before[name] for name in after})
+                levels.append(level)
+
+    print_table({
+        f"c={level['concurrency']}": {
+            key: level[key] for key in
+            ("ok", "throughput_rps", "mean_ms", "p50_ms", "p95_ms", "p99_ms",
+             "llm_calls", "coalesced")
+        }
+        for level in levels
+    })
+    for level in levels:
+        print(f"\nServer stages (ms), concurrency {level['concurrency']}:")
+        print_table(level["server_stages_ms"])
+        if level["errors"]:
+            print(f"  errors: {level['errors']}")
+
+    if args.compare:
+        compare(args.compare, levels)
+    if args.output:
+        save_json(args.output, {"benchmark": "loadtest", "git_commit": git_commit(),
+                                "args": vars(args), "server_env": settings,
+                                "levels": levels})
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+"""
+Benchmark: shared (SQLite) vs. per-process key scheduling across processes.
+
+Starts P worker processes that each make N slot reservations as fast as they
+can on the same keys (nothing sleeps; reservations just queue up into the
+future). Rows:
+
+  shared     SharedKeyScheduler on one SQLite file: reservation latency,
+             time spent waiting for the file lock (contention), throughput
+  local      an in-memory KeyScheduler per process, i.e. what several
+             uvicorn workers did before: fast but not coordinated
+
+`overbooked` counts pairs of slots on the same key scheduled closer together
+than the cooldown, across all processes; it must be 0 for a correct shared
+budget.
+
+    python bench_rate_limiter.py --processes 1 2 4 8 --requests 2000
+"""
+
+import argparse
+import contextlib
+import io
+import multiprocessing as mp
+import os
+import tempfile
+import time
+
+from bench_common import percentile, print_table, save_json
+from rate_limiter import KeyScheduler, SharedKeyScheduler
+
+
+def worker(mode, path, keys, cooldown, n, barrier, results):
+    with contextlib.redirect_stdout(io.StringIO()):
+        if mode == "shared":
+            scheduler = SharedKeyScheduler(keys, path, cooldown_min=cooldown, cooldown_max=cooldown)
+        else:
+            scheduler = KeyScheduler(keys, cooldown_min=cooldown, cooldown_max=cooldown)
+    # Slot times are only comparable across processes on one clock
+    offset = time.time() - time.monotonic() if mode == "local" else 0.0
+
+    latencies, slots = [], []
+    barrier.wait()
+    for _ in range(n):
+        t0 = time.perf_counter()
+        bucket, wait = scheduler.reserve()
+        latencies.append(time.perf_counter() - t0)
+        # reserve() refilled the bucket at `now`, so updated + wait is the slot
+        slots.append((bucket.index, bucket.updated + offset + wait))
+    results.put({
+        "latencies": latencies,
+        "slots": slots,
+        "lock_wait": getattr(scheduler, "lock_wait", 0.0),
+    })
+
+
+def overbooked(slots, cooldown):
+    by_key = {}
+    for key, at in slots:
+        by_key.setdefault(key, []).append(at)
+    count = 0
+    for times in by_key.values():
+        times.sort()
+        count += sum(1 for a, b in zip(times, times[1:]) if b - a < cooldown * (1 - 1e-6))
+    return count
+
+
+def run(mode, processes, n, keys, cooldown):
+    ctx = mp.get_context("spawn")
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "keys.sqlite")
+        barrier = ctx.Barrier(processes + 1)
+        results = ctx.Queue()
+        procs = [ctx.Process(target=worker, args=(mode, path, keys, cooldown, n, barrier, results))
+                 for _ in range(processes)]
+        for p in procs:
+            p.start()
+        barrier.wait()
+        start = time.perf_counter()
+        collected = [results.get() for _ in procs]
+        wall_time = time.perf_counter() - start
+        for p in procs:
+            p.join()
+
+    latencies = [l for r in collected for l in r["latencies"]]
+    slots = [s for r in collected for s in r["slots"]]
+    lock_wait = sum(r["lock_wait"] for r in collected)
+    return {
+        "reservations": len(latencies),
+        "throughput_rps": round(len(latencies) / wall_time, 1),
+        "p50_us": round(1e6 * percentile(latencies, 50), 1),
+        "p95_us": round(1e6 * percentile(latencies, 95), 1),
+        "p99_us": round(1e6 * percentile(latencies, 99), 1),
+        "lock_wait_share": round(lock_wait / sum(latencies), 3) if latencies else 0.0,
+        "overbooked": overbooked(slots, cooldown),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Shared vs. per-process key scheduling")
+    parser.add_argument("--processes", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--requests", type=int, default=2000, help="reservations per process")
+    parser.add_argument("--keys", type=int, default=4)
+    parser.add_argument("--cooldown", type=float, default=6.0, help="seconds between calls on a key")
+    parser.add_argument("--output", default=None, help="optional JSON results path")
+    args = parser.parse_args()
+
+    keys = [f"bench-key-{i}" for i in range(args.keys)]
+    rows = {}
+    for processes in args.processes:
+        for mode in ("shared", "local"):
+            rows[f"{mode} x{processes}"] = run(mode, processes, args.requests, keys, args.cooldown)
+
+    print_table(rows)
+    if args.output:
+        save_json(args.output, {"benchmark": "rate_limiter", "args": vars(args), "results": rows})
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+"""
+Benchmark: Chroma collection.query vs. the in-process NumpyIndex.
+
+Loads the Phase2 collection, embeds a fixed query set once, then times both
+retrieval paths for single and batched queries. Also reports how often the
+two backends return the same top-k ids (HNSW is approximate; NumPy is exact).
+If Phase2 wrote the BM25 index, lexical scoring and RRF fusion are timed too.
+
+    python bench_retrieval.py --iterations 500 --k 5 --batch-sizes 1 8 32
+"""
+
+import argparse
+import os
+import time
+
+import chromadb
+import numpy as np
+from sentence_transformers import SentenceTransformer
+
+from bench_common import BASE_DIR, QUERIES, print_table, save_json, summarize
+from lexical_index import LEXICAL_INDEX_FILE, BM25Index, reciprocal_rank_fusion
+from retrieval import NumpyIndex
+
+
+def time_calls(fn, iterations: int):
+    latencies = []
+    start = time.perf_counter()
+    for _ in range(iterations):
+        t0 = time.perf_counter()
+        fn()
+        latencies.append(time.perf_counter() - t0)
+    return summarize(latencies, time.perf_counter() - start)
+
+
+def overlap_at_k(collection, index: NumpyIndex, q_embs: np.ndarray, k: int) -> float:
+    chroma_ids = collection.query(query_embeddings=q_embs.tolist(), n_results=k,
+                                  include=[])["ids"]
+    exact, _ = index.top_k(q_embs, k)
+    scores = [
+        len(set(c) & {index.ids[i] for i in e}) / k
+        for c, e in zip(chroma_ids, exact)
+    ]
+    return float(np.mean(scores))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Chroma vs. NumPy exact top-k retrieval")
+    parser.add_argument("--db", default=os.environ.get(
+        "CHROMA_DB_DIR", os.path.join(BASE_DIR, "chroma_db_scenes_clean")))
+    parser.add_argument("--collection", default=os.environ.get(
+        "COLLECTION_NAME", "julius_caesar_scenes_clean"))
+    parser.add_argument("--model", default=os.environ.get("EMBED_MODEL", "all-MiniLM-L6-v2"))
+    parser.add_argument("--iterations", type=int, default=500)
+    parser.add_argument("--k", type=int, default=5)
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 8, 32])
+    parser.add_argument("--output", default=None, help="optional JSON results path")
+    args = parser.parse_args()
+
+    client = chromadb.PersistentClient(path=args.db)
+    collection = client.get_collection(args.collection)
+
+    t0 = time.perf_counter()
+    index = NumpyIndex.from_collection(collection)
+    load_ms = (time.perf_counter() - t0) * 1000
+
+    model = SentenceTransformer(args.model)
+    pool = model.encode(QUERIES, convert_to_numpy=True)
+
+    rows = {}
+    for bs in args.batch_sizes:
+        q_embs = np.resize(pool, (bs, pool.shape[1])).astype(np.float32)
+        rows[f"chroma   batch={bs}"] = time_calls(
+            lambda: collection.query(query_embeddings=q_embs.tolist(), n_results=args.k,
+                                     include=["documents", "metadatas", "distances"]),
+            args.iterations)
+        rows[f"numpy    batch={bs}"] = time_calls(
+            lambda: index.query_many(q_embs, args.k), args.iterations)
+
+    lexical_path = os.path.join(args.db, LEXICAL_INDEX_FILE)
+    if os.path.exists(lexical_path):
+        lexical = BM25Index.load(lexical_path)
+        query = QUERIES[0]
+        rows["bm25     batch=1"] = time_calls(
+            lambda: lexical.top_k(query, 20), args.iterations)
+        rows["hybrid   batch=1"] = time_calls(
+            lambda: reciprocal_rank_fusion([
+                [p["id"] for p in index.query(pool[:1], 20)],
+                [doc_id for doc_id, _ in lexical.top_k(query, 20)],
+            ])[:args.k],
+            args.iterations)
+
+    print(f"Index: {len(index)} vectors, loaded in {load_ms:.1f} ms")
+    print_table(rows)
+    agreement = overlap_at_k(collection, index, pool, args.k)
+    print(f"\nTop-{args.k} id agreement (Chroma vs. exact): {agreement:.3f}")
+
+    if args.output:
+        save_json(args.output, {"benchmark": "retrieval", "args": vars(args),
+                                "index_load_ms": load_ms, "results": rows,
+                                "topk_agreement": agreement})
+
+
+if __name__ == "__main__":
+    main()
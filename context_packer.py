@@ -0,0 +1,339 @@
+"""
+Token-budgeted context packing for the generation prompt.
+
+`k` comes from the request body and a scene can run to thousands of tokens,
+so formatting every retrieved passage verbatim gives unbounded prompts.
+ContextPacker fits the passages into CONTEXT_MAX_TOKENS:
+
+1. Near-duplicates (word 3-shingle Jaccard >= threshold against an earlier,
+   more relevant passage) are dropped.
+2. The budget is water-filled in relevance order: passages shorter than the
+   fair share are kept whole, longer ones get an equal share of what is
+   left. If the share falls below `min_passage_tokens`, the least relevant
+   passages are dropped until it does not.
+3. Passages over their share are trimmed to the sentences most similar to
+   the query (MiniLM cosine via `embed_fn`, lexical overlap without it),
+   kept in play order with speaker labels and "..." for the gaps.
+
+Tokens are counted with a Hugging Face `tokenizers` tokenizer when
+CONTEXT_TOKENIZER names one (a tokenizer.json path or hub id, e.g. the
+generation model's), otherwise with a fast word/punctuation approximation.
+"""
+
+import math
+import os
+import re
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+
+
+WORD_RE = re.compile(r"\w+|[^\w\s]")
+SENTENCE_RE = re.compile(r"(?<=[.!?;:])\s+")
+SPEAKER_RE = re.compile(r"^([A-Z][A-Z .'-]+):\n")
+
+# BPE vocabularies split roughly one word/punctuation piece in six further
+APPROX_TOKENS_PER_PIECE = 1.2
+# "[Passage 3 - Act 2, Scene 1, BRUTUS]\n" plus separators
+PASSAGE_OVERHEAD_TOKENS = 16
+
+EmbedFn = Callable[[List[str]], np.ndarray]
+
+
+class TokenCounter:
+    """Count tokens with a real tokenizer if available, else approximate."""
+
+    def __init__(self, tokenizer=None, name: str = "approx"):
+        self.tokenizer = tokenizer
+        self.name = name
+
+    @classmethod
+    def from_env(cls) -> "TokenCounter":
+        spec = os.environ.get("CONTEXT_TOKENIZER", "").strip()
+        if not spec:
+            return cls()
+        try:
+            from tokenizers import Tokenizer
+
+            if os.path.exists(spec):
+                tokenizer = Tokenizer.from_file(spec)
+            else:
+                tokenizer = Tokenizer.from_pretrained(spec)
+        except Exception as e:
+            print(f" Tokenizer {spec!r} unavailable ({e}); approximating token counts")
+            return cls()
+        print(f" Context tokenizer: {spec}")
+        return cls(tokenizer, name=spec)
+
+    def count(self, text: str) -> int:
+        if not text:
+            return 0
+        if self.tokenizer is not None:
+            return len(self.tokenizer.encode(text, add_special_tokens=False).ids)
+        return math.ceil(len(WORD_RE.findall(text)) * APPROX_TOKENS_PER_PIECE)
+
+
+def split_units(text: str) -> List[Tuple[Optional[str], str]]:
+    """Split a passage into (speaker, sentence) units in play order."""
+    units = []
+    for block in text.split("\n\n"):
+        speaker = None
+        match = SPEAKER_RE.match(block)
+        if match:
+            speaker = match.group(1)
+            block = block[match.end():]
+        for sentence in SENTENCE_RE.split(block.strip()):
+            if sentence:
+                units.append((speaker, sentence))
+    return units
+
+
+def join_units(units: List[Tuple[Optional[str], str]], keep: List[int]) -> str:
+    """Reassemble the kept units, re-labelling speakers and marking gaps."""
+    parts, speaker, last = [], None, None
+    for i in sorted(keep):
+        unit_speaker, sentence = units[i]
+        gap = last is not None and i != last + 1
+        if unit_speaker != speaker or last is None or gap:
+            if parts:
+                parts.append("\n\n")
+            if gap:
+                parts.append("...\n\n")
+            if unit_speaker:
+                parts.append(f"{unit_speaker}:\n")
+            speaker = unit_speaker
+        else:
+            parts.append(" ")
+        parts.append(sentence)
+        last = i
+    return "".join(parts)
+
+
+def shingles(text: str, n: int = 3) -> set:
+    words = [w.lower() for w in WORD_RE.findall(text) if w.isalnum()]
+    if len(words) < n:
+        return {tuple(words)}
+    return {tuple(words[i:i + n]) for i in range(len(words) - n + 1)}
+
+
+def jaccard(a: set, b: set) -> float:
+    if not a or not b:
+        return 0.0
+    return len(a & b) / len(a | b)
+
+
+def water_level(lengths: List[int], budget: int) -> float:
+    """Largest share L with sum(min(length, L)) <= budget."""
+    if sum(lengths) <= budget:
+        return float("inf")
+    remaining, left = budget, len(lengths)
+    for length in sorted(lengths):
+        if length * left > remaining:
+            return remaining / left
+        remaining -= length
+        left -= 1
+    return float("inf")
+
+
+class SentenceEmbeddingCache:
+    """LRU of sentence -> embedding; the corpus is fixed, so sentences repeat."""
+
+    def __init__(self, max_entries: int = 20000):
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, np.ndarray]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def embed(self, sentences: List[str], embed_fn: EmbedFn) -> np.ndarray:
+        with self._lock:
+            missing = [s for s in dict.fromkeys(sentences) if s not in self._entries]
+            self.hits += len(sentences) - len(missing)
+            self.misses += len(missing)
+
+        if missing:
+            vectors = np.asarray(embed_fn(missing), dtype=np.float32)
+            with self._lock:
+                for sentence, vector in zip(missing, vectors):
+                    self._entries[sentence] = vector
+                    self._entries.move_to_end(sentence)
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+
+        with self._lock:
+            found = {s: self._entries.get(s) for s in sentences}
+        if any(v is None for v in found.values()):
+            # Evicted between the two lock sections (tiny cache): embed directly
+            return np.asarray(embed_fn(sentences), dtype=np.float32)
+        return np.stack([found[s] for s in sentences])
+
+
+class ContextPacker:
+    def __init__(self, counter: TokenCounter, max_tokens: int = 2000,
+                 dedup_threshold: float = 0.8, min_passage_tokens: int = 80,
+                 sentence_cache_size: int = 20000):
+        self.counter = counter
+        self.max_tokens = max_tokens
+        self.dedup_threshold = dedup_threshold
+        self.min_passage_tokens = min_passage_tokens
+        self.sentence_cache = SentenceEmbeddingCache(sentence_cache_size)
+
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.tokens_in = 0
+        self.tokens_used = 0
+        self.duplicates_dropped = 0
+        self.budget_dropped = 0
+        self.trimmed = 0
+
+    @classmethod
+    def from_env(cls) -> "ContextPacker":
+        return cls(
+            TokenCounter.from_env(),
+            max_tokens=int(os.environ.get("CONTEXT_MAX_TOKENS", 2000)),
+            dedup_threshold=float(os.environ.get("CONTEXT_DEDUP_THRESHOLD", 0.8)),
+            min_passage_tokens=int(os.environ.get("CONTEXT_MIN_PASSAGE_TOKENS", 80)),
+        )
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_tokens > 0
+
+    def dedupe(self, passages: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        kept, kept_shingles = [], []
+        for passage in passages:
+            sh = shingles(passage["document"])
+            if any(jaccard(sh, other) >= self.dedup_threshold for other in kept_shingles):
+                continue
+            kept.append(passage)
+            kept_shingles.append(sh)
+        return kept
+
+    def allocate(self, lengths: List[int]) -> Tuple[int, float]:
+        """Return (passages to keep, per-passage share) for the budget."""
+        keep = len(lengths)
+        if not self.enabled:
+            return keep, float("inf")
+        while keep > 0:
+            budget = self.max_tokens - keep * PASSAGE_OVERHEAD_TOKENS
+            if budget > 0:
+                level = water_level(lengths[:keep], budget)
+                if level >= self.min_passage_tokens or keep == 1:
+                    return keep, level
+            keep -= 1
+        return 0, 0.0
+
+    def unit_scores(self, query: str, query_embedding: Optional[np.ndarray],
+                    sentences: List[str], embed_fn: Optional[EmbedFn]) -> np.ndarray:
+        if embed_fn is not None and query_embedding is not None:
+            vectors = self.sentence_cache.embed(sentences, embed_fn)
+            vectors = vectors / np.clip(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12, None)
+            q = np.asarray(query_embedding, dtype=np.float32).reshape(-1)
+            return vectors @ (q / max(float(np.linalg.norm(q)), 1e-12))
+
+        terms = {w.lower() for w in WORD_RE.findall(query) if w.isalnum()}
+        return np.array([
+            len(terms & {w.lower() for w in WORD_RE.findall(s)}) / (len(terms) or 1)
+            for s in sentences
+        ], dtype=np.float32)
+
+    def trim(self, query: str, query_embedding: Optional[np.ndarray], text: str,
+             limit: float, embed_fn: Optional[EmbedFn]) -> str:
+        """Keep the sentences most similar to the query within `limit` tokens."""
+        units = split_units(text)
+        if not units:
+            return text
+        scores = self.unit_scores(query, query_embedding, [s for _, s in units], embed_fn)
+
+        keep, used = [], 0
+        for i in np.argsort(-scores, kind="stable"):
+            speaker, sentence = units[i]
+            cost = self.counter.count(sentence) + (self.counter.count(speaker) + 1 if speaker else 0)
+            if used + cost > limit:
+                continue
+            keep.append(int(i))
+            used += cost
+        if not keep:
+            # A single sentence longer than the share: cut it by words
+            words = units[int(np.argmax(scores))][1].split()
+            return " ".join(words[:max(1, int(limit / APPROX_TOKENS_PER_PIECE))]) + " ..."
+
+        # Gap markers and repeated speaker labels are only known after joining;
+        # drop the least similar kept sentences until the result fits
+        text = join_units(units, keep)
+        while len(keep) > 1 and self.counter.count(text) > limit:
+            keep.pop()
+            text = join_units(units, keep)
+        return text
+
+    def pack(self, query: str, query_embedding: Optional[np.ndarray],
+             passages: List[Dict[str, Any]],
+             embed_fn: Optional[EmbedFn] = None) -> Tuple[List[Dict[str, Any]], Dict[str, Any]]:
+        """Select, dedupe and trim `passages` (relevance order) to the budget.
+
+        Returns the packed passages (same dict shape, trimmed "document") and
+        a usage dict for this request.
+        """
+        tokens_in = sum(self.counter.count(p["document"]) + PASSAGE_OVERHEAD_TOKENS
+                        for p in passages)
+        unique = self.dedupe(passages) if self.enabled else list(passages)
+        duplicates = len(passages) - len(unique)
+
+        lengths = [self.counter.count(p["document"]) for p in unique]
+        keep, level = self.allocate(lengths)
+
+        packed, trimmed = [], 0
+        for passage, length in zip(unique[:keep], lengths[:keep]):
+            if length <= level:
+                packed.append(passage)
+                continue
+            text = self.trim(query, query_embedding, passage["document"], level, embed_fn)
+            packed.append(dict(passage, document=text))
+            trimmed += 1
+
+        usage = {
+            "budget": self.max_tokens,
+            "tokens_in": tokens_in,
+            "tokens_used": sum(self.counter.count(p["document"]) + PASSAGE_OVERHEAD_TOKENS
+                               for p in packed),
+            "passages_in": len(passages),
+            "passages_used": len(packed),
+            "duplicates_dropped": duplicates,
+            "budget_dropped": len(unique) - keep,
+            "trimmed": trimmed,
+            "tokenizer": self.counter.name,
+        }
+        self.record(usage)
+        return packed, usage
+
+    def record(self, usage: Dict[str, Any]):
+        with self._lock:
+            self.requests += 1
+            self.tokens_in += usage["tokens_in"]
+            self.tokens_used += usage["tokens_used"]
+            self.duplicates_dropped += usage["duplicates_dropped"]
+            self.budget_dropped += usage["budget_dropped"]
+            self.trimmed += usage["trimmed"]
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "enabled": self.enabled,
+                "max_tokens": self.max_tokens,
+                "tokenizer": self.counter.name,
+                "requests": self.requests,
+                "tokens_in": self.tokens_in,
+                "tokens_used": self.tokens_used,
+                "reduction": round(1 - self.tokens_used / self.tokens_in, 4)
+                if self.tokens_in else 0.0,
+                "duplicates_dropped": self.duplicates_dropped,
+                "budget_dropped": self.budget_dropped,
+                "trimmed": self.trimmed,
+                "sentence_cache": {
+                    "size": len(self.sentence_cache._entries),
+                    "hits": self.sentence_cache.hits,
+                    "misses": self.sentence_cache.misses,
+                },
+            }
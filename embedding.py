@@ -0,0 +1,196 @@
+"""
+Dynamic micro-batching for query embeddings.
+
+Concurrent requests each ask for one or two vectors; encoding them one at a
+time runs many tiny forward passes back to back. EmbeddingBatcher collects
+requests that arrive within a short window (or until `max_batch_size` texts
+are queued), encodes them with a single `encode` call on a background
+thread, and hands each caller its own rows.
+
+Shared by Phase3 and Phase4. Configure with:
+
+    EMBED_BATCH_SIZE      max texts per encode call      (default 32)
+    EMBED_BATCH_WAIT_MS   how long to wait for company   (default 2)
+
+load_embedder() picks the model backend used by Phase2, Phase3 and Phase4:
+
+    EMBED_BACKEND         torch (SentenceTransformer, default) or onnx
+    EMBED_ONNX_DIR        exported model directory (default onnx_models/<model>)
+    EMBED_ONNX_QUANTIZED  1 to load the int8-quantized ONNX model
+"""
+
+import asyncio
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future, InvalidStateError
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+
+
+EncodeFn = Callable[[List[str]], np.ndarray]
+
+EMBED_BACKENDS = ("torch", "onnx")
+
+
+def embedder_settings(backend: Optional[str] = None) -> Dict[str, Any]:
+    """The backend load_embedder() uses, and for ONNX whether it is quantized."""
+    backend = (backend or os.environ.get("EMBED_BACKEND", "torch")).strip().lower()
+    settings: Dict[str, Any] = {"backend": backend}
+    if backend == "onnx":
+        settings["quantized"] = os.environ.get("EMBED_ONNX_QUANTIZED", "0") == "1"
+    return settings
+
+
+def load_embedder(model_name: str, backend: Optional[str] = None):
+    """Load a model exposing SentenceTransformer-style `encode` for the backend."""
+    settings = embedder_settings(backend)
+    backend = settings["backend"]
+
+    if backend == "torch":
+        from sentence_transformers import SentenceTransformer
+        return SentenceTransformer(model_name)
+
+    if backend == "onnx":
+        from onnx_embedder import OnnxEmbedder, default_onnx_dir
+        return OnnxEmbedder(
+            os.environ.get("EMBED_ONNX_DIR") or default_onnx_dir(model_name),
+            quantized=settings["quantized"],
+        )
+
+    raise ValueError(f"Unknown EMBED_BACKEND={backend!r} (use one of {EMBED_BACKENDS})")
+
+
+def encode_with(model) -> EncodeFn:
+    """Wrap a SentenceTransformer-like model as a texts -> 2-D array function."""
+    def encode(texts: List[str]) -> np.ndarray:
+        embs = model.encode(texts, convert_to_numpy=True)
+        if embs.ndim == 1:
+            embs = np.expand_dims(embs, 0)
+        return embs
+    return encode
+
+
+class EmbeddingBatcher:
+    def __init__(self, encode_fn: EncodeFn, max_batch_size: int = 32,
+                 max_wait_ms: float = 2.0):
+        self.encode_fn = encode_fn
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max(0.0, max_wait_ms) / 1000.0
+
+        self._queue: "queue.Queue[Optional[Tuple[List[str], Future]]]" = queue.Queue()
+        self._thread: Optional[threading.Thread] = None
+        self._start_lock = threading.Lock()
+
+        self.batches = 0
+        self.texts = 0
+
+    @classmethod
+    def from_env(cls, encode_fn: EncodeFn) -> "EmbeddingBatcher":
+        return cls(
+            encode_fn,
+            max_batch_size=int(os.environ.get("EMBED_BATCH_SIZE", 32)),
+            max_wait_ms=float(os.environ.get("EMBED_BATCH_WAIT_MS", 2.0)),
+        )
+
+    def start(self):
+        with self._start_lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="embedding-batcher",
+                                                daemon=True)
+                self._thread.start()
+        return self
+
+    def stop(self):
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join(timeout=5)
+            self._thread = None
+
+    def submit(self, texts: List[str]) -> Future:
+        """Queue texts for the next batch; the future resolves to their rows."""
+        fut: Future = Future()
+        if not texts:
+            fut.set_result(np.zeros((0, 0), dtype=np.float32))
+            return fut
+        self.start()
+        self._queue.put((list(texts), fut))
+        return fut
+
+    def embed(self, texts: List[str]) -> np.ndarray:
+        """Blocking embed for sync code (e.g. threadpool endpoints)."""
+        return self.submit(texts).result()
+
+    async def embed_async(self, texts: List[str]) -> np.ndarray:
+        """Embed without blocking the event loop."""
+        return await asyncio.wrap_future(self.submit(texts))
+
+    def _collect(self, first) -> List[Tuple[List[str], Future]]:
+        batch = [first]
+        size = len(first[0])
+        deadline = None
+        while size < self.max_batch_size:
+            try:
+                # Take whatever is already queued; only wait if the queue is empty
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                if deadline is None:
+                    deadline = time.monotonic() + self.max_wait
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+            if item is None:
+                self._queue.put(None)
+                break
+            batch.append(item)
+            size += len(item[0])
+        return batch
+
+    def _run(self):
+        while True:
+            first = self._queue.get()
+            if first is None:
+                return
+            batch = self._collect(first)
+
+            texts = [t for item_texts, _ in batch for t in item_texts]
+            try:
+                embs = self.encode_fn(texts)
+            except Exception as e:
+                for _, fut in batch:
+                    _resolve(fut, error=e)
+                continue
+
+            self.batches += 1
+            self.texts += len(texts)
+            offset = 0
+            for item_texts, fut in batch:
+                n = len(item_texts)
+                _resolve(fut, embs[offset:offset + n])
+                offset += n
+
+    def stats(self) -> dict:
+        return {
+            "batches": self.batches,
+            "texts": self.texts,
+            "avg_batch_size": round(self.texts / self.batches, 2) if self.batches else 0.0,
+            "max_batch_size": self.max_batch_size,
+            "max_wait_ms": self.max_wait * 1000.0,
+        }
+
+
+def _resolve(fut: Future, result=None, error: Optional[BaseException] = None):
+    # A caller may have given up (cancelled) while its batch was encoding
+    try:
+        if error is not None:
+            fut.set_exception(error)
+        else:
+            fut.set_result(result)
+    except InvalidStateError:
+        pass
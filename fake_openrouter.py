@@ -0,0 +1,126 @@
+"""
+Local stand-in for OpenRouter's /api/v1/chat/completions endpoint.
+
+Used to benchmark the generation path without spending real quota. The reply
+is a canned answer whose timing is controlled by:
+
+    --latency          seconds before the first token          (default 0.5)
+    --tokens           completion length in tokens              (default 40)
+    --tokens-per-sec   generation speed after the first token   (default 200)
+
+Requests with `"stream": true` get server-sent `chat.completion.chunk` events
+ending in `data: [DONE]`, like the real endpoint.
+
+Run:
+    python fake_openrouter.py --port 8090 --latency 0.3
+    OPENROUTER_URL=http://127.0.0.1:8090/api/v1/chat/completions uvicorn Phase4:app
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import time
+import uuid
+
+from fastapi import FastAPI, Request
+from fastapi.responses import StreamingResponse
+
+
+LATENCY = float(os.environ.get("FAKE_LLM_LATENCY", 0.5))
+TOKENS = int(os.environ.get("FAKE_LLM_TOKENS", 40))
+TOKENS_PER_SEC = float(os.environ.get("FAKE_LLM_TOKENS_PER_SEC", 200))
+
+CANNED_WORDS = (
+    "Brutus joins the conspiracy because he fears Caesar's ambition "
+    "will harm Rome (Act 2, Scene 1)."
+).split()
+
+app = FastAPI(title="Fake OpenRouter")
+stats = {"requests": 0, "in_flight": 0, "max_in_flight": 0}
+
+
+def completion_tokens(n: int):
+    return [CANNED_WORDS[i % len(CANNED_WORDS)] + " " for i in range(n)]
+
+
+def stream_completion(completion_id: str, model: str, n_tokens: int):
+    async def events():
+        stats["in_flight"] += 1
+        stats["max_in_flight"] = max(stats["max_in_flight"], stats["in_flight"])
+        try:
+            await asyncio.sleep(LATENCY)
+            for i, token in enumerate(completion_tokens(n_tokens)):
+                if i:
+                    await asyncio.sleep(1.0 / TOKENS_PER_SEC)
+                chunk = {
+                    "id": completion_id,
+                    "object": "chat.completion.chunk",
+                    "model": model,
+                    "choices": [{"index": 0, "delta": {"content": token}}],
+                }
+                yield f"data: {json.dumps(chunk)}\n\n"
+            yield "data: [DONE]\n\n"
+        finally:
+            stats["in_flight"] -= 1
+
+    return StreamingResponse(events(), media_type="text/event-stream")
+
+
+@app.post("/api/v1/chat/completions")
+async def chat_completions(request: Request):
+    body = await request.json()
+    stats["requests"] += 1
+    n_tokens = min(TOKENS, int(body.get("max_tokens") or TOKENS))
+    completion_id = f"fake-{uuid.uuid4().hex[:12]}"
+
+    if body.get("stream"):
+        return stream_completion(completion_id, body.get("model", "fake"), n_tokens)
+
+    stats["in_flight"] += 1
+    stats["max_in_flight"] = max(stats["max_in_flight"], stats["in_flight"])
+    try:
+        await asyncio.sleep(LATENCY + n_tokens / TOKENS_PER_SEC)
+        text = "".join(completion_tokens(n_tokens)).strip()
+        return {
+            "id": completion_id,
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get("model", "fake"),
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": text},
+                "finish_reason": "stop",
+            }],
+            "usage": {"completion_tokens": n_tokens},
+        }
+    finally:
+        stats["in_flight"] -= 1
+
+
+@app.get("/stats")
+def get_stats():
+    return stats
+
+
+def main():
+    global LATENCY, TOKENS, TOKENS_PER_SEC
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8090)
+    parser.add_argument("--latency", type=float, default=LATENCY)
+    parser.add_argument("--tokens", type=int, default=TOKENS)
+    parser.add_argument("--tokens-per-sec", type=float, default=TOKENS_PER_SEC)
+    args = parser.parse_args()
+
+    LATENCY, TOKENS, TOKENS_PER_SEC = args.latency, args.tokens, args.tokens_per_sec
+
+    import uvicorn
+
+    print(f" Fake OpenRouter at http://{args.host}:{args.port}/api/v1/chat/completions "
+          f"(latency={LATENCY}s, tokens={TOKENS}, {TOKENS_PER_SEC} tok/s)")
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
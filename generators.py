@@ -0,0 +1,336 @@
+"""
+Interchangeable answer generation backends.
+
+- RemoteGenerator: chat completions (OpenRouter) on the API key that frees
+  up soonest.
+- ExtractiveGenerator: a local CPU answerer that returns the passage
+  sentences most similar to the question, scored with the MiniLM model the
+  server has already loaded. No network, a few milliseconds per answer.
+- GenerationRouter: picks the backend per request (GENERATOR_BACKEND):
+
+    remote  always the chat model (waits for a key as long as it takes;
+            default)
+    local   always the extractive answerer
+    auto    the chat model, but answer locally instead when
+              - no key frees up within KEY_WAIT_BUDGET seconds,
+              - GENERATION_DEADLINE (seconds since the request arrived) would
+                be missed, judged from the recent remote call latency, or
+                is hit while waiting for the remote answer,
+              - the remote call fails.
+
+Every answer is returned as a Generation naming the backend that produced it
+(and, for fallbacks, why).
+"""
+
+import asyncio
+import logging
+import os
+import re
+import threading
+import time
+from dataclasses import dataclass
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional
+
+import httpx
+import numpy as np
+
+from context_packer import EmbedFn, SentenceEmbeddingCache, split_units
+from llm_client import OpenRouterClient
+from pipeline_log import log_event
+from rate_limiter import KeyBucket, KeyScheduler
+from timing import StageTimer
+
+
+NO_ANSWER = ("The retrieved passages do not contain enough information to "
+             "answer this confidently.")
+
+WORD_RE = re.compile(r"\w+")
+
+
+@dataclass
+class Generation:
+    text: str
+    backend: str
+    fallback_reason: Optional[str] = None
+    # Token counts reported by the chat API ({"prompt_tokens": ..., ...})
+    usage: Optional[Dict[str, int]] = None
+    # Why the remote call failed (`text` then holds the message shown to the client)
+    error: Optional[str] = None
+
+    @property
+    def failed(self) -> bool:
+        return self.error is not None
+
+    @classmethod
+    def failure(cls, message: str, backend: str) -> "Generation":
+        return cls(message, backend, error=message)
+
+
+class RemoteGenerator:
+    """Chat completions through the pooled client and the key scheduler."""
+
+    name = "remote"
+
+    def __init__(self, client: OpenRouterClient, scheduler: KeyScheduler,
+                 build_payload: Callable[..., Dict[str, Any]]):
+        self.client = client
+        self.scheduler = scheduler
+        self.build_payload = build_payload
+        # Moving average of the call time, used to predict deadline misses
+        self.latency_ewma: Optional[float] = None
+
+    def expected_latency(self) -> float:
+        return self.latency_ewma or 0.0
+
+    def observe(self, seconds: float, alpha: float = 0.2):
+        if self.latency_ewma is None:
+            self.latency_ewma = seconds
+        else:
+            self.latency_ewma += alpha * (seconds - self.latency_ewma)
+
+    async def generate(self, query: str, context: str, key_slot: KeyBucket,
+                       timer: StageTimer) -> Generation:
+        payload = self.build_payload(query, context)
+        try:
+            log_event(logging.INFO, "llm_call", key=key_slot.index)
+
+            t0 = time.perf_counter()
+            with timer.stage("llm"):
+                response = await self.client.chat(payload, key_slot.key)
+
+            if response.status_code != 200:
+                log_event(logging.ERROR, "llm_error", key=key_slot.index,
+                          status=response.status_code, body=response.text[:500])
+                key_slot.errors += 1
+                return Generation.failure(f"Error: OpenRouter returned {response.status_code}",
+                                          self.name)
+
+            self.observe(time.perf_counter() - t0)
+            data = response.json()
+            return Generation(data["choices"][0]["message"]["content"], self.name,
+                              usage=data.get("usage"))
+
+        except httpx.TimeoutException as e:
+            log_event(logging.ERROR, "llm_timeout", key=key_slot.index, error=repr(e))
+            key_slot.errors += 1
+            return Generation.failure("Error: OpenRouter request timed out", self.name)
+
+        except Exception as e:
+            log_event(logging.ERROR, "llm_error", key=key_slot.index, error=str(e))
+            key_slot.errors += 1
+            return Generation.failure(f"Error generating response: {str(e)}", self.name)
+
+    async def stream(self, query: str, context: str, key_slot: KeyBucket) -> AsyncIterator[str]:
+        payload = self.build_payload(query, context, stream=True)
+        log_event(logging.INFO, "llm_stream", key=key_slot.index)
+        try:
+            async for delta in self.client.stream_chat(payload, key_slot.key):
+                yield delta
+        except Exception:
+            key_slot.errors += 1
+            raise
+
+
+class ExtractiveGenerator:
+    """Answer with the retrieved sentences closest to the question."""
+
+    name = "extractive"
+
+    def __init__(self, embed_fn: EmbedFn, sentence_cache: Optional[SentenceEmbeddingCache] = None,
+                 max_sentences: int = 3, min_similarity: float = 0.25, min_words: int = 4):
+        self.embed_fn = embed_fn
+        self.sentence_cache = sentence_cache or SentenceEmbeddingCache()
+        self.max_sentences = max_sentences
+        self.min_similarity = min_similarity
+        self.min_words = min_words
+
+    @classmethod
+    def from_env(cls, embed_fn: EmbedFn,
+                 sentence_cache: Optional[SentenceEmbeddingCache] = None) -> "ExtractiveGenerator":
+        return cls(
+            embed_fn,
+            sentence_cache,
+            max_sentences=int(os.environ.get("EXTRACTIVE_SENTENCES", 3)),
+            min_similarity=float(os.environ.get("EXTRACTIVE_MIN_SIMILARITY", 0.25)),
+        )
+
+    def answer(self, query_embedding: np.ndarray, passages: List[Dict[str, Any]]) -> str:
+        """Best sentences (play order within a passage), each with its source."""
+        candidates = []  # (passage rank, unit index, speaker, sentence, metadata)
+        for rank, passage in enumerate(passages):
+            for i, (speaker, sentence) in enumerate(split_units(passage["document"])):
+                if len(WORD_RE.findall(sentence)) >= self.min_words:
+                    candidates.append((rank, i, speaker or passage["metadata"].get("speaker"),
+                                       sentence, passage["metadata"]))
+        if not candidates:
+            return NO_ANSWER
+
+        vectors = self.sentence_cache.embed([c[3] for c in candidates], self.embed_fn)
+        vectors = vectors / np.clip(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12, None)
+        q = np.asarray(query_embedding, dtype=np.float32).reshape(-1)
+        scores = vectors @ (q / max(float(np.linalg.norm(q)), 1e-12))
+
+        best = [i for i in np.argsort(-scores, kind="stable")[:self.max_sentences]
+                if scores[i] >= self.min_similarity]
+        if not best:
+            return NO_ANSWER
+
+        lines = []
+        for i in sorted(best, key=lambda i: candidates[i][:2]):
+            _, _, speaker, sentence, meta = candidates[i]
+            who = f"{speaker.title()}, " if speaker else ""
+            lines.append(f"\"{sentence}\" ({who}Act {meta.get('act', '?')}, "
+                         f"Scene {meta.get('scene', '?')})")
+        return "\n".join(lines)
+
+    async def generate(self, query_embedding: np.ndarray, passages: List[Dict[str, Any]],
+                       timer: StageTimer, fallback_reason: Optional[str] = None) -> Generation:
+        with timer.stage("extractive"):
+            text = await asyncio.to_thread(self.answer, query_embedding, passages)
+        return Generation(text, self.name, fallback_reason)
+
+
+class GenerationRouter:
+    MODES = ("auto", "remote", "local")
+
+    def __init__(self, remote: RemoteGenerator, local: ExtractiveGenerator, mode: str = "remote",
+                 key_wait_budget: float = 10.0, deadline: float = 0.0):
+        if mode not in self.MODES:
+            raise ValueError(f"GENERATOR_BACKEND must be one of {self.MODES}, got {mode!r}")
+        self.remote = remote
+        self.local = local
+        self.mode = mode
+        self.key_wait_budget = key_wait_budget
+        self.deadline = deadline  # seconds from request start; 0 disables
+
+        self._lock = threading.Lock()
+        self.answers: Dict[str, int] = {}
+        self.fallbacks: Dict[str, int] = {}
+
+    @classmethod
+    def from_env(cls, remote: RemoteGenerator, local: ExtractiveGenerator) -> "GenerationRouter":
+        return cls(
+            remote,
+            local,
+            mode=os.environ.get("GENERATOR_BACKEND", "remote").strip().lower(),
+            key_wait_budget=float(os.environ.get("KEY_WAIT_BUDGET", 10.0)),
+            deadline=float(os.environ.get("GENERATION_DEADLINE", 0.0)),
+        )
+
+    def record(self, generation: Generation) -> Generation:
+        with self._lock:
+            self.answers[generation.backend] = self.answers.get(generation.backend, 0) + 1
+            if generation.fallback_reason:
+                reason = generation.fallback_reason
+                self.fallbacks[reason] = self.fallbacks.get(reason, 0) + 1
+        if generation.fallback_reason:
+            log_event(logging.WARNING, "generator_fallback", reason=generation.fallback_reason)
+        return generation
+
+    def remaining(self, started: float) -> Optional[float]:
+        """Seconds left before the deadline (None without one)."""
+        if not self.deadline:
+            return None
+        return self.deadline - (time.perf_counter() - started)
+
+    async def acquire_key(self, started: float, timer: StageTimer):
+        """(key slot, None) or (None, reason) when the remote would be too slow."""
+        if self.mode == "remote":
+            with timer.stage("key_wait"):
+                return await self.remote.scheduler.acquire(), None
+
+        max_wait, reason = self.key_wait_budget, "key_budget"
+        remaining = self.remaining(started)
+        if remaining is not None:
+            deadline_wait = remaining - self.remote.expected_latency()
+            if deadline_wait < max_wait:
+                max_wait, reason = deadline_wait, "deadline"
+        if max_wait < 0:
+            return None, reason
+        with timer.stage("key_wait"):
+            key_slot = await self.remote.scheduler.acquire(max_wait=max_wait)
+        return key_slot, None if key_slot is not None else reason
+
+    async def generate(self, query: str, context: str, query_embedding: np.ndarray,
+                       passages: List[Dict[str, Any]], timer: Optional[StageTimer] = None,
+                       started: Optional[float] = None) -> Generation:
+        """Answer one question; `started` (perf_counter) anchors the deadline."""
+        timer = timer or StageTimer()
+        started = timer.start if started is None else started
+
+        if self.mode == "local":
+            return self.record(await self.local.generate(query_embedding, passages, timer))
+
+        key_slot, reason = await self.acquire_key(started, timer)
+        if key_slot is None:
+            return self.record(await self.local.generate(query_embedding, passages, timer, reason))
+
+        remaining = self.remaining(started)
+        if self.mode == "remote" or remaining is None:
+            generation = await self.remote.generate(query, context, key_slot, timer)
+        else:
+            t0 = time.perf_counter()
+            try:
+                generation = await asyncio.wait_for(
+                    self.remote.generate(query, context, key_slot, timer), max(remaining, 0.0))
+            except asyncio.TimeoutError:
+                # The call took at least this long; count it so that later
+                # requests predict the miss instead of spending a key on it
+                self.remote.observe(time.perf_counter() - t0)
+                return self.record(await self.local.generate(
+                    query_embedding, passages, timer, "deadline"))
+
+        if generation.failed and self.mode == "auto":
+            return self.record(await self.local.generate(
+                query_embedding, passages, timer, "remote_error"))
+        return self.record(generation)
+
+    async def stream(self, query: str, context: str, query_embedding: np.ndarray,
+                     passages: List[Dict[str, Any]], result: Generation,
+                     timer: Optional[StageTimer] = None) -> AsyncIterator[str]:
+        """Yield answer deltas; `result` is filled in with the full text and backend.
+
+        In auto mode the stream falls back to the local answer (sent as one
+        delta) if no key is available in time or the remote stream fails
+        before its first token. Later failures propagate to the caller.
+        """
+        timer = timer or StageTimer()
+        key_slot, reason = (None, None) if self.mode == "local" else \
+            await self.acquire_key(timer.start, timer)
+
+        if key_slot is not None:
+            parts = []
+            t0 = time.perf_counter()
+            try:
+                async for delta in self.remote.stream(query, context, key_slot):
+                    parts.append(delta)
+                    yield delta
+            except Exception as e:
+                timer.add("llm", time.perf_counter() - t0)
+                if parts or self.mode == "remote":
+                    raise
+                log_event(logging.ERROR, "llm_stream_error", error=str(e))
+                reason = "remote_error"
+            else:
+                timer.add("llm", time.perf_counter() - t0)
+                result.text, result.backend = "".join(parts), self.remote.name
+                self.record(result)
+                return
+
+        generation = await self.local.generate(query_embedding, passages, timer, reason)
+        result.text, result.backend = generation.text, generation.backend
+        result.fallback_reason = generation.fallback_reason
+        self.record(result)
+        yield generation.text
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "mode": self.mode,
+                "key_wait_budget_s": self.key_wait_budget,
+                "deadline_s": self.deadline or None,
+                "remote_latency_ewma_s": round(self.remote.latency_ewma, 3)
+                if self.remote.latency_ewma is not None else None,
+                "answers": dict(self.answers),
+                "fallbacks": dict(self.fallbacks),
+            }
@@ -0,0 +1,160 @@
+"""
+Compact in-memory BM25 inverted index for hybrid lexical + vector retrieval.
+
+Queries that name characters or quote lines ("Et tu, Brute") rank poorly with
+MiniLM over whole scenes. Phase2 builds this index from the same chunks and
+saves it next to the Chroma DB; Phase4 fuses its ranking with the vector
+ranking by reciprocal-rank fusion (RRF).
+
+Postings are stored CSR-style in three flat arrays (term offsets, document
+rows, precomputed BM25 weights), so scoring a query is one vectorised
+`scores[rows] += weights` per query term and needs no per-document work:
+
+    weight(t, d) = idf(t) * tf * (k1 + 1) / (tf + k1 * (1 - b + b * |d| / avgdl))
+    idf(t)       = ln(1 + (N - df + 0.5) / (df + 0.5))
+"""
+
+import os
+import re
+from collections import Counter
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+
+LEXICAL_INDEX_FILE = "bm25_scenes.npz"
+
+TOKEN_RE = re.compile(r"[a-z0-9]+")
+STOPWORDS = frozenset("""
+a an and are as at be but by for from had has have he her him his i if in is it
+its me my not of on or our so than that the their them then there these they
+this to was we were what when which who will with you your thou thee thy thine
+""".split())
+
+
+def tokenize(text: str) -> List[str]:
+    return [t for t in TOKEN_RE.findall(text.lower()) if t not in STOPWORDS]
+
+
+def reciprocal_rank_fusion(rankings: Sequence[Sequence[str]], k: int = 60) -> List[str]:
+    """Fuse ranked id lists: score(id) = sum over lists of 1 / (k + rank)."""
+    scores: Dict[str, float] = {}
+    for ranking in rankings:
+        for rank, doc_id in enumerate(ranking, 1):
+            scores[doc_id] = scores.get(doc_id, 0.0) + 1.0 / (k + rank)
+    return sorted(scores, key=lambda doc_id: -scores[doc_id])
+
+
+class BM25Index:
+    def __init__(self, ids: List[str], vocab: List[str], offsets: np.ndarray,
+                 rows: np.ndarray, weights: np.ndarray, k1: float = 1.5, b: float = 0.75):
+        self.ids = list(ids)
+        self.terms = {term: i for i, term in enumerate(vocab)}
+        self.offsets = offsets
+        self.rows = rows
+        self.weights = weights
+        self.k1 = k1
+        self.b = b
+        self.mtime = None  # of the file it was loaded from
+        self._row_of = {doc_id: row for row, doc_id in enumerate(self.ids)}
+
+    @classmethod
+    def build(cls, docs: Iterable[Tuple[str, str]], k1: float = 1.5, b: float = 0.75) -> "BM25Index":
+        """Build from (doc_id, text) pairs in one streaming pass."""
+        ids, doc_terms, lengths = [], [], []
+        vocab: Dict[str, int] = {}
+        for doc_id, text in docs:
+            tokens = tokenize(text)
+            counts = Counter(vocab.setdefault(t, len(vocab)) for t in tokens)
+            ids.append(doc_id)
+            doc_terms.append((np.fromiter(counts.keys(), dtype=np.int32, count=len(counts)),
+                              np.fromiter(counts.values(), dtype=np.float32, count=len(counts))))
+            lengths.append(len(tokens))
+
+        n_docs = len(ids)
+        if n_docs == 0:
+            empty = np.zeros(0)
+            return cls([], [], np.zeros(1, dtype=np.int64), empty.astype(np.int32),
+                       empty.astype(np.float32), k1, b)
+
+        term_ids = np.concatenate([t for t, _ in doc_terms])
+        tfs = np.concatenate([c for _, c in doc_terms])
+        rows = np.repeat(np.arange(n_docs, dtype=np.int32), [len(t) for t, _ in doc_terms])
+
+        lengths = np.asarray(lengths, dtype=np.float32)
+        avgdl = max(float(lengths.mean()), 1.0)
+        df = np.bincount(term_ids, minlength=len(vocab)).astype(np.float32)
+        idf = np.log1p((n_docs - df + 0.5) / (df + 0.5))
+        norm = k1 * (1 - b + b * lengths[rows] / avgdl)
+        weights = (idf[term_ids] * tfs * (k1 + 1) / (tfs + norm)).astype(np.float32)
+
+        order = np.argsort(term_ids, kind="stable")
+        offsets = np.zeros(len(vocab) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(term_ids, minlength=len(vocab)), out=offsets[1:])
+
+        by_id = sorted(vocab, key=vocab.get)
+        # Scene/speech corpora fit in 16-bit row numbers, halving posting memory
+        row_dtype = np.uint16 if n_docs <= np.iinfo(np.uint16).max else np.int32
+        return cls(ids, by_id, offsets, rows[order].astype(row_dtype), weights[order], k1, b)
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def scores(self, query: str) -> np.ndarray:
+        scores = np.zeros(len(self.ids), dtype=np.float32)
+        for term, qtf in Counter(tokenize(query)).items():
+            t = self.terms.get(term)
+            if t is None:
+                continue
+            start, end = self.offsets[t], self.offsets[t + 1]
+            scores[self.rows[start:end]] += qtf * self.weights[start:end]
+        return scores
+
+    def rows_for_ids(self, ids: Iterable[str]) -> np.ndarray:
+        return np.array([self._row_of[i] for i in ids if i in self._row_of], dtype=np.int64)
+
+    def top_k(self, query: str, k: int, rows: Optional[np.ndarray] = None) -> List[Tuple[str, float]]:
+        """Best (doc_id, score) pairs with a positive score, best first.
+
+        With `rows`, documents outside that (pre-filtered) set are excluded.
+        """
+        scores = self.scores(query)
+        if rows is not None:
+            allowed = np.zeros(len(scores), dtype=bool)
+            allowed[rows] = True
+            scores[~allowed] = 0.0
+        k = min(k, len(scores))
+        if k <= 0:
+            return []
+        top = np.argpartition(-scores, k - 1)[:k] if k < len(scores) else np.arange(len(scores))
+        top = top[np.argsort(-scores[top], kind="stable")]
+        return [(self.ids[i], float(scores[i])) for i in top if scores[i] > 0]
+
+    @property
+    def nbytes(self) -> int:
+        return self.offsets.nbytes + self.rows.nbytes + self.weights.nbytes
+
+    def save(self, path: str):
+        vocab = sorted(self.terms, key=self.terms.get)
+        tmp_path = path + ".tmp.npz"
+        np.savez(
+            tmp_path,
+            ids=np.array(self.ids, dtype=str),
+            vocab=np.array(vocab, dtype=str),
+            offsets=self.offsets,
+            rows=self.rows,
+            weights=self.weights,
+            params=np.array([self.k1, self.b]),
+        )
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str) -> "BM25Index":
+        with np.load(path, allow_pickle=False) as data:
+            k1, b = data["params"].tolist()
+            index = cls(data["ids"].tolist(), data["vocab"].tolist(), data["offsets"],
+                        data["rows"], data["weights"], k1=k1, b=b)
+        index.mtime = os.path.getmtime(path)
+        print(f" BM25 index: {len(index)} docs, {len(index.terms)} terms, "
+              f"{len(index.rows)} postings ({index.nbytes / 1024:.0f} KiB)")
+        return index
@@ -0,0 +1,143 @@
+"""
+Shared async HTTP client for the OpenRouter chat completions endpoint.
+
+One connection-pooled httpx.AsyncClient is created when the app starts and
+closed when it stops, so answers reuse keep-alive connections instead of
+paying a TCP+TLS handshake per request. Connect/read/write/pool deadlines and
+pool sizes come from the environment:
+
+    OPENROUTER_URL          chat completions URL (point at fake_openrouter.py
+                            for benchmarks)
+    LLM_CONNECT_TIMEOUT     seconds to establish a connection   (default 5)
+    LLM_READ_TIMEOUT        seconds between received bytes      (default 60)
+    LLM_WRITE_TIMEOUT       seconds to send the request body    (default 10)
+    LLM_POOL_TIMEOUT        seconds to wait for a free pool slot (default 5)
+    LLM_MAX_CONNECTIONS     total pooled connections            (default 20)
+    LLM_MAX_KEEPALIVE       idle keep-alive connections kept    (default 10)
+"""
+
+import json
+import os
+from dataclasses import dataclass
+from typing import Any, AsyncIterator, Dict, Optional
+
+import httpx
+
+
+DEFAULT_OPENROUTER_URL = "https://openrouter.ai/api/v1/chat/completions"
+
+
+@dataclass
+class LLMClientConfig:
+    url: str = DEFAULT_OPENROUTER_URL
+    connect_timeout: float = 5.0
+    read_timeout: float = 60.0
+    write_timeout: float = 10.0
+    pool_timeout: float = 5.0
+    max_connections: int = 20
+    max_keepalive: int = 10
+
+    @classmethod
+    def from_env(cls) -> "LLMClientConfig":
+        return cls(
+            url=os.environ.get("OPENROUTER_URL", DEFAULT_OPENROUTER_URL),
+            connect_timeout=float(os.environ.get("LLM_CONNECT_TIMEOUT", 5.0)),
+            read_timeout=float(os.environ.get("LLM_READ_TIMEOUT", 60.0)),
+            write_timeout=float(os.environ.get("LLM_WRITE_TIMEOUT", 10.0)),
+            pool_timeout=float(os.environ.get("LLM_POOL_TIMEOUT", 5.0)),
+            max_connections=int(os.environ.get("LLM_MAX_CONNECTIONS", 20)),
+            max_keepalive=int(os.environ.get("LLM_MAX_KEEPALIVE", 10)),
+        )
+
+
+class UpstreamError(RuntimeError):
+    """Non-200 response or in-stream error from the chat completions API."""
+
+    def __init__(self, status_code: int, detail: str):
+        super().__init__(f"OpenRouter returned {status_code}: {detail}")
+        self.status_code = status_code
+        self.detail = detail
+
+
+class OpenRouterClient:
+    """Owns the pooled AsyncClient; call start()/aclose() from the app lifespan."""
+
+    def __init__(self, config: LLMClientConfig):
+        self.config = config
+        self._client: Optional[httpx.AsyncClient] = None
+
+    async def start(self):
+        if self._client is not None:
+            return
+        cfg = self.config
+        self._client = httpx.AsyncClient(
+            timeout=httpx.Timeout(
+                connect=cfg.connect_timeout,
+                read=cfg.read_timeout,
+                write=cfg.write_timeout,
+                pool=cfg.pool_timeout,
+            ),
+            limits=httpx.Limits(
+                max_connections=cfg.max_connections,
+                max_keepalive_connections=cfg.max_keepalive,
+            ),
+        )
+        print(f" HTTP client ready → {cfg.url} "
+              f"(pool={cfg.max_connections}, read timeout={cfg.read_timeout}s)")
+
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        if self._client is None:
+            raise RuntimeError("OpenRouterClient used before start()")
+        return self._client
+
+    @staticmethod
+    def headers(api_key: str) -> Dict[str, str]:
+        return {
+            "Authorization": f"Bearer {api_key}",
+            "Content-Type": "application/json",
+            "HTTP-Referer": "http://localhost",
+            "X-Title": "JuliusCaesar-RAG"
+        }
+
+    async def chat(self, payload: Dict[str, Any], api_key: str) -> httpx.Response:
+        """POST a chat completion request on a pooled connection."""
+        return await self.client.post(
+            self.config.url, json=payload, headers=self.headers(api_key)
+        )
+
+    async def stream_chat(self, payload: Dict[str, Any], api_key: str) -> AsyncIterator[str]:
+        """POST a `stream: true` request and yield content deltas as they arrive.
+
+        The upstream speaks server-sent events: `data: {json}` lines, keep-alive
+        comments starting with `:`, and a final `data: [DONE]`.
+        """
+        payload = dict(payload, stream=True)
+        async with self.client.stream(
+            "POST", self.config.url, json=payload, headers=self.headers(api_key)
+        ) as response:
+            if response.status_code != 200:
+                body = await response.aread()
+                raise UpstreamError(response.status_code, body.decode("utf-8", "replace"))
+
+            async for line in response.aiter_lines():
+                if not line.startswith("data:"):
+                    continue
+                data = line[len("data:"):].strip()
+                if data == "[DONE]":
+                    break
+
+                chunk = json.loads(data)
+                if "error" in chunk:
+                    error = chunk["error"]
+                    raise UpstreamError(error.get("code", 500), error.get("message", str(error)))
+
+                for choice in chunk.get("choices") or []:
+                    content = (choice.get("delta") or {}).get("content")
+                    if content:
+                        yield content
@@ -0,0 +1,199 @@
+"""
+ONNX Runtime embedding backend for CPU serving.
+
+Runs an exported (and optionally int8-quantized) copy of a sentence-transformer
+model with onnxruntime + tokenizers, so serving does not need torch. The
+pipeline mirrors all-MiniLM-L6-v2: tokenize → transformer → mean pooling over
+the attention mask → L2 normalization.
+
+Export once (needs torch + transformers, e.g. at image build time):
+    python onnx_embedder.py export --model all-MiniLM-L6-v2 --quantize
+
+Check the exported model against the PyTorch SentenceTransformer:
+    python onnx_embedder.py check --model all-MiniLM-L6-v2 --quantized --tolerance 0.02
+
+Serve with it:
+    EMBED_BACKEND=onnx EMBED_ONNX_QUANTIZED=1 uvicorn Phase4:app
+"""
+
+import argparse
+import os
+import sys
+from typing import List, Optional, Union
+
+import numpy as np
+
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+FP32_FILE = "model.onnx"
+INT8_FILE = "model_int8.onnx"
+
+
+def default_onnx_dir(model_name: str) -> str:
+    return os.path.join(BASE_DIR, "onnx_models", model_name.replace("/", "__"))
+
+
+class OnnxEmbedder:
+    """Drop-in for SentenceTransformer.encode backed by onnxruntime."""
+
+    def __init__(self, model_dir: str, quantized: bool = False, max_seq_length: int = 256,
+                 normalize: bool = True, intra_op_threads: Optional[int] = None):
+        import onnxruntime as ort
+        from tokenizers import Tokenizer
+
+        model_file = os.path.join(model_dir, INT8_FILE if quantized else FP32_FILE)
+        if not os.path.exists(model_file):
+            raise FileNotFoundError(
+                f"ONNX model not found at {model_file}. "
+                "Run: python onnx_embedder.py export"
+                + (" --quantize" if quantized else "")
+            )
+
+        self.model_file = model_file
+        self.normalize = normalize
+
+        self.tokenizer = Tokenizer.from_file(os.path.join(model_dir, "tokenizer.json"))
+        self.tokenizer.enable_truncation(max_length=max_seq_length)
+        self.tokenizer.enable_padding()
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if intra_op_threads:
+            options.intra_op_num_threads = intra_op_threads
+        self.session = ort.InferenceSession(
+            model_file, sess_options=options, providers=["CPUExecutionProvider"]
+        )
+        self.input_names = {i.name for i in self.session.get_inputs()}
+        print(f" ONNX embedder loaded: {model_file}")
+
+    def get_sentence_embedding_dimension(self) -> int:
+        return int(self.session.get_outputs()[0].shape[-1])
+
+    def _encode_batch(self, texts: List[str]) -> np.ndarray:
+        encodings = self.tokenizer.encode_batch(texts)
+        input_ids = np.array([e.ids for e in encodings], dtype=np.int64)
+        attention_mask = np.array([e.attention_mask for e in encodings], dtype=np.int64)
+
+        feeds = {"input_ids": input_ids, "attention_mask": attention_mask}
+        if "token_type_ids" in self.input_names:
+            feeds["token_type_ids"] = np.array([e.type_ids for e in encodings], dtype=np.int64)
+
+        token_embeddings = self.session.run(None, feeds)[0]
+
+        mask = attention_mask[..., None].astype(np.float32)
+        summed = (token_embeddings * mask).sum(axis=1)
+        embs = summed / np.clip(mask.sum(axis=1), 1e-9, None)
+
+        if self.normalize:
+            embs = embs / np.clip(np.linalg.norm(embs, axis=1, keepdims=True), 1e-12, None)
+        return embs.astype(np.float32)
+
+    def encode(self, texts: Union[str, List[str]], batch_size: int = 32,
+               convert_to_numpy: bool = True, **kwargs) -> np.ndarray:
+        single = isinstance(texts, str)
+        if single:
+            texts = [texts]
+        if not texts:
+            return np.zeros((0, self.get_sentence_embedding_dimension()), dtype=np.float32)
+
+        embs = np.concatenate([
+            self._encode_batch(texts[i:i + batch_size])
+            for i in range(0, len(texts), batch_size)
+        ])
+        return embs[0] if single else embs
+
+
+def export(model_name: str, out_dir: str, quantize: bool = False, opset: int = 14):
+    """Export the transformer of a sentence-transformer model to ONNX."""
+    import torch
+    from transformers import AutoModel, AutoTokenizer
+
+    hub_name = model_name if "/" in model_name else f"sentence-transformers/{model_name}"
+    os.makedirs(out_dir, exist_ok=True)
+
+    tokenizer = AutoTokenizer.from_pretrained(hub_name)
+    model = AutoModel.from_pretrained(hub_name).eval()
+    tokenizer.save_pretrained(out_dir)
+
+    sample = tokenizer(["export sample"], return_tensors="pt")
+    input_names = [n for n in ("input_ids", "attention_mask", "token_type_ids") if n in sample]
+    dynamic = {n: {0: "batch", 1: "sequence"} for n in input_names}
+    dynamic["last_hidden_state"] = {0: "batch", 1: "sequence"}
+
+    fp32_path = os.path.join(out_dir, FP32_FILE)
+    with torch.no_grad():
+        torch.onnx.export(
+            model,
+            tuple(sample[n] for n in input_names),
+            fp32_path,
+            input_names=input_names,
+            output_names=["last_hidden_state"],
+            dynamic_axes=dynamic,
+            opset_version=opset,
+        )
+    print(f"✔ Exported {hub_name} → {fp32_path}")
+
+    if quantize:
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+
+        int8_path = os.path.join(out_dir, INT8_FILE)
+        quantize_dynamic(fp32_path, int8_path, weight_type=QuantType.QInt8)
+        print(f"✔ Quantized (dynamic int8) → {int8_path}")
+
+
+def check(model_name: str, model_dir: str, quantized: bool, tolerance: float,
+          texts: Optional[List[str]] = None) -> bool:
+    """Compare ONNX embeddings with the PyTorch SentenceTransformer ones.
+
+    Passes when every pair has cosine similarity >= 1 - tolerance.
+    """
+    from sentence_transformers import SentenceTransformer
+
+    texts = texts or [
+        "Beware the ides of March.",
+        "Friends, Romans, countrymen, lend me your ears.",
+        "Et tu, Brute? Then fall, Caesar!",
+        "Why does Brutus join the conspiracy against Caesar?",
+        "The fault, dear Brutus, is not in our stars, but in ourselves.",
+    ]
+    reference = SentenceTransformer(model_name).encode(texts, convert_to_numpy=True)
+    candidate = OnnxEmbedder(model_dir, quantized=quantized).encode(texts)
+
+    ref = reference / np.linalg.norm(reference, axis=1, keepdims=True)
+    cand = candidate / np.linalg.norm(candidate, axis=1, keepdims=True)
+    cosines = (ref * cand).sum(axis=1)
+    max_abs = float(np.abs(reference - candidate).max())
+
+    ok = bool(cosines.min() >= 1.0 - tolerance)
+    print(f"min cosine={cosines.min():.5f}  mean cosine={cosines.mean():.5f}  "
+          f"max |diff|={max_abs:.5f}  tolerance={tolerance}  → {'PASS' if ok else 'FAIL'}")
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export / check the ONNX embedder")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p_export = sub.add_parser("export", help="export (and optionally quantize) a model")
+    p_export.add_argument("--model", default=os.environ.get("EMBED_MODEL", "all-MiniLM-L6-v2"))
+    p_export.add_argument("--out", default=None)
+    p_export.add_argument("--quantize", action="store_true")
+
+    p_check = sub.add_parser("check", help="compare ONNX vs. PyTorch embeddings")
+    p_check.add_argument("--model", default=os.environ.get("EMBED_MODEL", "all-MiniLM-L6-v2"))
+    p_check.add_argument("--dir", default=None)
+    p_check.add_argument("--quantized", action="store_true")
+    p_check.add_argument("--tolerance", type=float, default=0.02,
+                         help="allowed 1 - cosine similarity per text")
+
+    args = parser.parse_args()
+    if args.command == "export":
+        export(args.model, args.out or default_onnx_dir(args.model), quantize=args.quantize)
+    else:
+        ok = check(args.model, args.dir or default_onnx_dir(args.model),
+                   quantized=args.quantized, tolerance=args.tolerance)
+        sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,148 @@
+"""
+Structured, leveled and sampled logging for the query pipeline.
+
+Pipeline code logs named events with fields instead of printing:
+
+    log_event(logging.INFO, "retrieved", passages=5, backend="numpy")
+
+Each HTTP request gets a RequestContext (request id, whether it is sampled)
+in a context variable, so events carry the request id without threading it
+through every call. Configuration comes from the environment:
+
+    LOG_LEVEL        minimum level (default INFO)
+    LOG_FORMAT       "text" (default) or "json" (one object per line)
+    LOG_SAMPLE_RATE  fraction of requests whose DEBUG/INFO events are kept
+                     (default 1.0); warnings, errors and profiled requests
+                     are always kept
+
+Records are handed to a QueueHandler and written by a background listener
+thread, so request handlers never block on stderr. Forked workers start
+their own listener thread.
+"""
+
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+import time
+import uuid
+from contextvars import ContextVar
+from dataclasses import dataclass
+from typing import Any, Dict, Optional
+
+
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.environ.get("LOG_FORMAT", "text").strip().lower()
+LOG_SAMPLE_RATE = float(os.environ.get("LOG_SAMPLE_RATE", 1.0))
+
+logger = logging.getLogger("rag")
+
+
+@dataclass
+class RequestContext:
+    request_id: str = "-"
+    sampled: bool = True  # INFO/DEBUG events for this request are logged
+    profile: Optional[str] = None  # "timings" | "cprofile" | "flame" (see profiling.py)
+    dump_path: Optional[str] = None
+
+
+# Outside a request (startup, background work) everything is logged
+_current: ContextVar[RequestContext] = ContextVar("rag_request", default=RequestContext())
+
+
+def current_request() -> RequestContext:
+    return _current.get()
+
+
+def begin_request(request_id: Optional[str] = None, profile: Optional[str] = None) -> RequestContext:
+    """Start a request context in the current task (and the threads it awaits)."""
+    ctx = RequestContext(
+        request_id=request_id or uuid.uuid4().hex[:12],
+        # Profiled requests are always logged in full
+        sampled=(profile is not None or LOG_SAMPLE_RATE >= 1.0
+                 or random.random() < LOG_SAMPLE_RATE),
+        profile=profile,
+    )
+    _current.set(ctx)
+    return ctx
+
+
+def log_event(level: int, event: str, **fields: Any):
+    """Log `event` with `fields` unless filtered by level or request sampling."""
+    if not logger.isEnabledFor(level):
+        return
+    ctx = _current.get()
+    if level < logging.WARNING and not ctx.sampled:
+        return
+    logger.log(level, event, extra={"fields": fields, "request_id": ctx.request_id})
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry: Dict[str, Any] = {
+            "ts": round(record.created, 3),
+            "level": record.levelname.lower(),
+            "event": record.getMessage(),
+            "request_id": getattr(record, "request_id", "-"),
+        }
+        entry.update(getattr(record, "fields", {}))
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        fields = " ".join(f"{k}={v!r}" if isinstance(v, str) else f"{k}={v}"
+                          for k, v in getattr(record, "fields", {}).items())
+        stamp = time.strftime("%H:%M:%S", time.localtime(record.created))
+        return (f"{stamp} {record.levelname:<7} [{getattr(record, 'request_id', '-')}] "
+                f"{record.getMessage()} {fields}").rstrip()
+
+
+_listener: Optional[logging.handlers.QueueListener] = None
+
+
+def _start_listener(stream: logging.Handler) -> logging.handlers.QueueHandler:
+    global _listener
+    records: "queue.SimpleQueue[logging.LogRecord]" = queue.SimpleQueue()
+    _listener = logging.handlers.QueueListener(records, stream)
+    _listener.start()
+    return logging.handlers.QueueHandler(records)
+
+
+def _restart_after_fork():
+    """A forked worker (prefork.py) has no writer thread; give it its own."""
+    if _listener is None:
+        return
+    stream = _listener.handlers[0]
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+    logger.addHandler(_start_listener(stream))
+
+
+def shutdown():
+    """Write out queued records and stop the writer thread."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+def configure():
+    """Attach the queue handler and start the writer thread (idempotent)."""
+    if logger.handlers:
+        return
+    stream = logging.StreamHandler(sys.stderr)
+    stream.setFormatter(JsonFormatter() if LOG_FORMAT == "json" else TextFormatter())
+
+    logger.addHandler(_start_listener(stream))
+    logger.setLevel(LOG_LEVEL)
+    logger.propagate = False
+    atexit.register(shutdown)
+    os.register_at_fork(after_in_child=_restart_after_fork)
+
+
+configure()
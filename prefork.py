@@ -0,0 +1,303 @@
+"""
+Preload-and-fork server for Phase4: load once, fork N workers.
+
+`uvicorn --workers N` starts N fresh interpreters, and each one loads its own
+embedding model and index, so memory grows by a full model per worker. This
+supervisor binds the port, imports the app module and calls its
+`preload_for_fork()` hook (Phase4 loads the SentenceTransformer weights and
+the NumPy/BM25 indexes there), freezes the loaded objects out of the garbage
+collector and only then forks the workers. The workers inherit those pages
+copy-on-write: model parameters are moved into shared memory and the index
+matrices are read-only, so the big buffers stay shared; what a worker
+touches or allocates itself (Chroma client, HTTP pool, caches, request
+state) is private.
+
+    python prefork.py --app Phase4:app --port 8002 --workers 4
+
+Each worker reports its own memory in /health ("memory") and /metrics
+(rag_process_memory_bytes); the supervisor logs a "worker_memory" event
+with every worker's unique set size (USS: pages only that process maps)
+every PREFORK_MEMORY_REPORT_S seconds (default 60, 0 = off). Workers that
+exit are restarted. Fork safety: the parent never runs a forward pass or
+opens Chroma (both start threads that a forked child would not have), so
+index rows are read in a short-lived spawned process.
+"""
+
+import argparse
+import gc
+import importlib
+import logging
+import multiprocessing as mp
+import os
+import signal
+import socket
+import sys
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+from pipeline_log import log_event, shutdown as shutdown_logging
+
+
+PREFORK_MEMORY_REPORT_S = float(os.environ.get("PREFORK_MEMORY_REPORT_S", 60))
+
+
+# ======== Memory Accounting ========
+def process_memory(pid: Any = "self") -> Optional[Dict[str, float]]:
+    """RSS, PSS, USS and shared MiB of a process from /proc/<pid>/smaps_rollup.
+
+    USS (private pages) is what the process would give back if it exited;
+    PSS splits each shared page between the processes mapping it. None if
+    the process is gone or /proc is not available (non-Linux).
+    """
+    fields = {}
+    try:
+        with open(f"/proc/{pid}/smaps_rollup") as f:
+            for line in f:
+                parts = line.split()
+                if len(parts) == 3 and parts[2] == "kB":
+                    fields[parts[0].rstrip(":")] = int(parts[1]) / 1024
+    except OSError:
+        return None
+    return {
+        "rss_mb": round(fields.get("Rss", 0.0), 1),
+        "pss_mb": round(fields.get("Pss", 0.0), 1),
+        "uss_mb": round(fields.get("Private_Clean", 0.0) + fields.get("Private_Dirty", 0.0), 1),
+        "shared_mb": round(fields.get("Shared_Clean", 0.0) + fields.get("Shared_Dirty", 0.0), 1),
+    }
+
+
+def _cmdline(pid: Any) -> Optional[bytes]:
+    try:
+        with open(f"/proc/{pid}/cmdline", "rb") as f:
+            return f.read()
+    except OSError:
+        return None
+
+
+def worker_pids(parent: int) -> List[int]:
+    """Live workers of the supervisor `parent`, found by scanning /proc:
+    forked children still have its command line (helper processes do not)."""
+    command = _cmdline(parent)
+    pids = []
+    for entry in os.listdir("/proc") if os.path.isdir("/proc") else []:
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                # "pid (comm) state ppid ..."; comm may contain spaces
+                ppid = int(f.read().rsplit(")", 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        if ppid == parent and _cmdline(entry) == command:
+            pids.append(int(entry))
+    return sorted(pids)
+
+
+def worker_id() -> Optional[int]:
+    """This process's worker number under the prefork supervisor (else None)."""
+    value = os.environ.get("PREFORK_WORKER")
+    return int(value) if value is not None else None
+
+
+def memory_report() -> Dict[str, Any]:
+    """Memory of this process, plus the supervisor and sibling workers when forked."""
+    report: Dict[str, Any] = {"worker": worker_id(), "process": process_memory()}
+    if report["worker"] is not None:
+        parent = os.getppid()
+        report["supervisor"] = process_memory(parent)
+        report["workers"] = {str(pid): process_memory(pid) for pid in worker_pids(parent)}
+    return report
+
+
+# ======== Preloading ========
+def _call_and_send(conn, fn: Callable, args):
+    try:
+        conn.send((True, fn(*args)))
+    except BaseException as e:
+        conn.send((False, e))
+    finally:
+        conn.close()
+
+
+def run_in_subprocess(fn: Callable, *args):
+    """Run a module-level `fn(*args)` in a fresh spawned interpreter and return
+    its (picklable) result, for work whose side effects (threads, file
+    handles) must not end up in the process that is about to fork."""
+    ctx = mp.get_context("spawn")
+    receiver, sender = ctx.Pipe(duplex=False)
+    proc = ctx.Process(target=_call_and_send, args=(sender, fn, args), daemon=True)
+    proc.start()
+    sender.close()
+    try:
+        ok, value = receiver.recv()
+    except EOFError:
+        proc.join()
+        raise RuntimeError(f"{fn.__name__} subprocess exited with code {proc.exitcode}")
+    proc.join()
+    if not ok:
+        raise value
+    return value
+
+
+def share_model_memory(model):
+    """Move a torch module's parameters and buffers into shared memory, so
+    workers map the same pages even if something writes to them. Models
+    without `share_memory` (ONNX, stubs) are left as they are."""
+    share = getattr(model, "share_memory", None)
+    if callable(share):
+        share()
+
+
+# ======== Supervisor ========
+def import_app_module(name: str):
+    """Import `name`, or its lower-case form if that is missing (the Docker
+    image ships Phase4.py as phase4.py, see the dockerfile)."""
+    try:
+        return importlib.import_module(name)
+    except ModuleNotFoundError as e:
+        if e.name != name or name.lower() == name:
+            raise
+        return importlib.import_module(name.lower())
+
+
+class Supervisor:
+    def __init__(self, app_ref: str, host: str, port: int, workers: int,
+                 log_level: str = "info"):
+        self.app_ref = app_ref
+        self.host = host
+        self.port = port
+        self.workers = max(1, workers)
+        self.log_level = log_level
+        self.children: Dict[int, int] = {}  # pid -> worker number
+        self.started: Dict[int, float] = {}  # worker number -> monotonic start
+        self.stopping = False
+        self.sock: Optional[socket.socket] = None
+        self.app = None
+
+    def bind(self):
+        sock = socket.socket(socket.AF_INET6 if ":" in self.host else socket.AF_INET)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((self.host, self.port))
+        sock.listen(2048)
+        sock.set_inheritable(True)
+        self.sock = sock
+
+    def preload(self):
+        module_name, _, attr = self.app_ref.partition(":")
+        module = import_app_module(module_name)
+        self.app = getattr(module, attr or "app")
+
+        t0 = time.perf_counter()
+        hook = getattr(module, "preload_for_fork", None)
+        if hook is not None:
+            hook()
+        # Objects that exist now are shared with every worker; keep the
+        # collector from writing to them (and copying their pages)
+        gc.collect()
+        gc.freeze()
+        print(f" Preloaded {module_name} in {time.perf_counter() - t0:.1f}s "
+              f"({(process_memory() or {}).get('rss_mb', '?')} MiB RSS)")
+
+    def spawn(self, number: int):
+        pid = os.fork()
+        if pid == 0:
+            code = 1
+            try:
+                self.run_worker(number)
+                code = 0
+            finally:
+                shutdown_logging()
+                os._exit(code)
+        self.children[pid] = number
+        self.started[number] = time.monotonic()
+        log_event(logging.INFO, "worker_started", worker=number, pid=pid)
+
+    def run_worker(self, number: int):
+        import uvicorn
+
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        os.environ["PREFORK_WORKER"] = str(number)
+        # N workers each using every core for intra-op threads oversubscribe the CPU
+        torch = sys.modules.get("torch")
+        if torch is not None:
+            torch.set_num_threads(max(1, (os.cpu_count() or 1) // self.workers))
+
+        config = uvicorn.Config(self.app, log_level=self.log_level, lifespan="on")
+        uvicorn.Server(config).run(sockets=[self.sock])
+
+    def report_memory(self):
+        workers = {}
+        for pid, number in sorted(self.children.items(), key=lambda item: item[1]):
+            usage = process_memory(pid)
+            if usage is not None:
+                workers[number] = usage
+        log_event(logging.INFO, "worker_memory",
+                  supervisor_rss_mb=(process_memory() or {}).get("rss_mb"),
+                  uss_mb={n: u["uss_mb"] for n, u in workers.items()},
+                  pss_mb={n: u["pss_mb"] for n, u in workers.items()},
+                  total_pss_mb=round(sum(u["pss_mb"] for u in workers.values()), 1))
+
+    def stop(self, *_):
+        self.stopping = True
+
+    def run(self):
+        self.bind()
+        self.preload()
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        for number in range(self.workers):
+            self.spawn(number)
+
+        next_report = time.monotonic() + PREFORK_MEMORY_REPORT_S
+        while not self.stopping:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                pid, status = 0, 0
+            if pid and pid in self.children:
+                number = self.children.pop(pid)
+                log_event(logging.WARNING, "worker_exited", worker=number, pid=pid,
+                          status=os.waitstatus_to_exitcode(status))
+                if time.monotonic() - self.started[number] < 5:
+                    time.sleep(1)  # don't spin on a worker that fails at startup
+                if not self.stopping:
+                    self.spawn(number)
+                continue
+            if PREFORK_MEMORY_REPORT_S > 0 and time.monotonic() >= next_report:
+                self.report_memory()
+                next_report = time.monotonic() + PREFORK_MEMORY_REPORT_S
+            time.sleep(0.2)
+
+        for pid in self.children:
+            os.kill(pid, signal.SIGTERM)
+        deadline = time.monotonic() + 30
+        while self.children and time.monotonic() < deadline:
+            try:
+                pid, _ = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                break
+            if pid:
+                self.children.pop(pid, None)
+            else:
+                time.sleep(0.1)
+        for pid in self.children:
+            os.kill(pid, signal.SIGKILL)
+        print(" Supervisor stopped")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Preload the app once, then fork workers")
+    parser.add_argument("--app", default="Phase4:app", help="module:attribute of the ASGI app")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8002)
+    parser.add_argument("--workers", type=int, default=int(os.environ.get("WEB_CONCURRENCY", 2)))
+    parser.add_argument("--log-level", default="info", help="uvicorn log level")
+    args = parser.parse_args()
+
+    sys.path.insert(0, os.getcwd())
+    Supervisor(args.app, args.host, args.port, args.workers, args.log_level).run()
+
+
+if __name__ == "__main__":
+    main()
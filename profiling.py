@@ -0,0 +1,199 @@
+"""
+Opt-in per-request profiling for Phase4.
+
+A request is profiled when it sends an `X-Profile` header, or at random with
+probability PROFILE_SAMPLE_RATE. Profiled responses include a `profile`
+object with the stage-by-stage breakdown (the same stages as Server-Timing),
+and the breakdown is logged as a "profile" event. The header value chooses
+what else is captured, so a slow request can be dumped on a running server:
+
+    X-Profile: 1 | timings   stage breakdown only
+    X-Profile: cprofile      + cProfile stats of the event loop thread while
+                             the request runs ({request_id}.prof, for
+                             pstats/snakeviz)
+    X-Profile: flame         + stacks of every thread sampled every
+                             PROFILE_FLAME_INTERVAL_MS ms ({request_id}.folded,
+                             for flamegraph.pl or speedscope)
+
+Dumps go to PROFILE_DIR (only the newest PROFILE_MAX_DUMPS are kept); the
+path is returned in the X-Profile-Dump header. Both profilers see whatever
+else the process is doing during the request, so dump under light load. One
+dump runs at a time; a concurrent dump request gets the breakdown only.
+"""
+
+import cProfile
+import glob
+import logging
+import os
+import random
+import re
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from typing import Dict, Optional
+
+from pipeline_log import begin_request, current_request, log_event
+
+
+PROFILE_SAMPLE_RATE = float(os.environ.get("PROFILE_SAMPLE_RATE", 0.0))
+PROFILE_DIR = os.environ.get("PROFILE_DIR", os.path.join(tempfile.gettempdir(), "rag_profiles"))
+PROFILE_MAX_DUMPS = int(os.environ.get("PROFILE_MAX_DUMPS", 50))
+PROFILE_FLAME_INTERVAL_MS = float(os.environ.get("PROFILE_FLAME_INTERVAL_MS", 5.0))
+
+PROFILE_MODES = {"1": "timings", "true": "timings", "timings": "timings",
+                 "cprofile": "cprofile", "flame": "flame"}
+
+_dump_lock = threading.Lock()
+# Client request ids become part of dump file names
+_REQUEST_ID = re.compile(r"[A-Za-z0-9_-]{1,64}")
+
+
+def profile_mode(header: Optional[str]) -> Optional[str]:
+    """Profiling mode for a request from its X-Profile header and the sample rate."""
+    if header:
+        return PROFILE_MODES.get(header.strip().lower(), "timings")
+    if PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE:
+        return "timings"
+    return None
+
+
+class StackSampler:
+    """Background thread counting the stacks of all other threads (folded format)."""
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.stacks: Counter = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="stack-sampler", daemon=True)
+
+    def _run(self):
+        me = threading.get_ident()
+        names = {t.ident: t.name for t in threading.enumerate()}
+        while not self._stop.wait(self.interval):
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                parts = []
+                while frame is not None:
+                    code = frame.f_code
+                    parts.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                    frame = frame.f_back
+                thread = names.get(ident) or str(ident)
+                self.stacks[";".join([thread] + parts[::-1])] += 1
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def write(self, path: str):
+        with open(path, "w", encoding="utf-8") as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+
+
+def prune_dumps(directory: str, keep: int):
+    dumps = sorted(glob.glob(os.path.join(directory, "*.prof")) +
+                   glob.glob(os.path.join(directory, "*.folded")), key=os.path.getmtime)
+    for path in dumps[:max(0, len(dumps) - keep)]:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+class ProfilingMiddleware:
+    """Pure ASGI middleware: request context, request id and optional dumps.
+
+    Sets the pipeline_log request context for every HTTP request (so log
+    events carry its id), returns the id in X-Request-ID and, for cprofile /
+    flame requests, runs the profiler around the whole request. A client
+    X-Request-ID is kept only if it matches _REQUEST_ID, since it names the
+    dump file.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        headers = dict(scope.get("headers") or [])
+        header = headers.get(b"x-profile")
+        request_id = headers.get(b"x-request-id", b"").decode("latin-1")
+        ctx = begin_request(request_id if _REQUEST_ID.fullmatch(request_id) else None,
+                            profile_mode(header.decode("latin-1") if header else None))
+
+        profiler = sampler = None
+        if ctx.profile in ("cprofile", "flame") and _dump_lock.acquire(blocking=False):
+            suffix = ".prof" if ctx.profile == "cprofile" else ".folded"
+            ctx.dump_path = os.path.join(PROFILE_DIR, f"{int(time.time())}-{ctx.request_id}{suffix}")
+            if ctx.profile == "cprofile":
+                profiler = cProfile.Profile()
+                profiler.enable()
+            else:
+                sampler = StackSampler(PROFILE_FLAME_INTERVAL_MS / 1000)
+                sampler.start()
+
+        def finish_dump():
+            nonlocal profiler, sampler
+            if profiler is None and sampler is None:
+                return
+            try:
+                if profiler is not None:
+                    profiler.disable()
+                else:
+                    sampler.stop()
+                # A failed dump is logged; it must never break the response
+                try:
+                    os.makedirs(PROFILE_DIR, exist_ok=True)
+                    if profiler is not None:
+                        profiler.dump_stats(ctx.dump_path)
+                    else:
+                        sampler.write(ctx.dump_path)
+                    prune_dumps(PROFILE_DIR, PROFILE_MAX_DUMPS)
+                except OSError as e:
+                    log_event(logging.WARNING, "profile_dump_failed", path=ctx.dump_path,
+                              error=str(e))
+            finally:
+                profiler = sampler = None
+                _dump_lock.release()
+
+        async def send_with_ids(message):
+            if message["type"] == "http.response.start":
+                extra = [(b"x-request-id", ctx.request_id.encode("latin-1"))]
+                if ctx.dump_path:
+                    extra.append((b"x-profile-dump", ctx.dump_path.encode("utf-8")))
+                message = dict(message, headers=list(message.get("headers") or []) + extra)
+            elif message["type"] == "http.response.body" and not message.get("more_body"):
+                # Write the dump before the last chunk, so it exists once the
+                # client has the whole response
+                finish_dump()
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_ids)
+        finally:
+            finish_dump()
+
+
+def profile_report(stages_ms: Dict[str, float], total_ms: float) -> Optional[dict]:
+    """The `profile` object for a response (also logged), or None if not profiled."""
+    ctx = current_request()
+    if not ctx.profile:
+        return None
+    report = {
+        "request_id": ctx.request_id,
+        "mode": ctx.profile,
+        "stages_ms": {stage: round(ms, 3) for stage, ms in stages_ms.items()},
+        "total_ms": round(total_ms, 3),
+        "dump": ctx.dump_path,
+    }
+    log_event(logging.INFO, "profile", **report)
+    return report
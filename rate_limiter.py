@@ -0,0 +1,274 @@
+"""
+Per-key rate scheduling for the generation API keys.
+
+Each API key gets its own token bucket, so N keys give roughly N times the
+single-key throughput. Callers await a slot instead of sleeping a worker
+thread: the scheduler reserves a token on the key that frees up soonest and
+the request yields with asyncio.sleep until that reservation is due.
+
+KeyScheduler keeps the buckets in process memory. With several uvicorn
+workers or replicas on one node, SharedKeyScheduler keeps them in a SQLite
+file instead (KEY_STATE_DB): each reservation is one short write
+transaction, and SQLite's file lock serialises them across processes, so
+all workers draw on one budget per key.
+"""
+
+import asyncio
+import hashlib
+import logging
+import os
+import random
+import sqlite3
+import threading
+import time
+from typing import Callable, List, Optional, Tuple
+
+from pipeline_log import log_event
+
+
+class KeyBucket:
+    """Token bucket for a single API key.
+
+    Tokens refill at one per `interval` seconds up to `capacity`. Reservations
+    may push the balance negative, which queues later callers behind earlier
+    ones on the same key.
+    """
+
+    def __init__(self, index: int, key: str, interval: float, capacity: float = 1.0):
+        self.index = index
+        self.key = key
+        self.interval = interval
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.calls = 0
+        self.errors = 0  # failed upstream calls, counted by the caller
+
+    def refill(self, now: float):
+        elapsed = now - self.updated
+        if elapsed > 0:
+            self.tokens = min(self.capacity, self.tokens + elapsed / self.interval)
+            self.updated = now
+
+    def wait_time(self, now: float) -> float:
+        """Seconds until one whole token is available on this key."""
+        self.refill(now)
+        if self.tokens >= 1.0:
+            return 0.0
+        return (1.0 - self.tokens) * self.interval
+
+    def reserve(self, now: float, cost: float = 1.0) -> float:
+        """Take `cost` tokens and return how long the caller must wait."""
+        wait = self.wait_time(now)
+        self.tokens -= cost
+        self.calls += 1
+        return wait
+
+
+class KeyScheduler:
+    """Schedules API calls across several keys with independent rate budgets.
+
+    `cooldown_min`/`cooldown_max` keep their old meaning: the spacing between
+    two calls on the *same* key is drawn uniformly from that range.
+    """
+
+    def __init__(self, keys: List[str], cooldown_min: float = 6.0,
+                 cooldown_max: float = 8.0, burst: float = 1.0):
+        if not keys:
+            raise ValueError("At least one API key is required")
+        if cooldown_min <= 0 or cooldown_max < cooldown_min:
+            raise ValueError("Require 0 < cooldown_min <= cooldown_max")
+        self.keys = keys
+        self.cooldown_min = cooldown_min
+        self.cooldown_max = cooldown_max
+        self.buckets = [
+            KeyBucket(i, key, interval=cooldown_min, capacity=burst)
+            for i, key in enumerate(keys)
+        ]
+        self._lock = threading.Lock()
+        self.waiting = 0
+        self.rejected = 0  # reservations refused for exceeding max_wait
+        # Called with every granted wait in seconds (e.g. a metrics histogram)
+        self.wait_observer: Optional[Callable[[float], None]] = None
+        print(f" Initialized API key scheduler with {len(keys)} key(s)")
+
+    def _call_cost(self) -> float:
+        # A jittered spacing of uniform(min, max) seconds expressed in tokens.
+        spacing = random.uniform(self.cooldown_min, self.cooldown_max)
+        return spacing / self.cooldown_min
+
+    def reserve(self, max_wait: Optional[float] = None) -> Optional[Tuple[KeyBucket, float]]:
+        """Reserve a slot on the key that frees up soonest.
+
+        Returns the chosen bucket and the delay before the call may be made.
+        The reservation is made immediately, so callers queue in arrival order.
+        With `max_wait`, nothing is reserved (None is returned) if even the
+        soonest key is further away than that.
+        """
+        with self._lock:
+            now = time.monotonic()
+            bucket = min(self.buckets, key=lambda b: b.wait_time(now))
+            if max_wait is not None and bucket.wait_time(now) > max_wait:
+                self.rejected += 1
+                return None
+            return bucket, bucket.reserve(now, self._call_cost())
+
+    async def acquire(self, max_wait: Optional[float] = None) -> Optional[KeyBucket]:
+        """Wait (without blocking the event loop) for a slot and return its key.
+
+        Returns None instead of waiting longer than `max_wait` seconds.
+        """
+        return await self._await_slot(self.reserve(max_wait))
+
+    async def _await_slot(self, reservation: Optional[Tuple[KeyBucket, float]]
+                          ) -> Optional[KeyBucket]:
+        if reservation is None:
+            return None
+        bucket, wait = reservation
+        if self.wait_observer is not None:
+            self.wait_observer(wait)
+        if wait > 0:
+            log_event(logging.INFO, "key_wait", key=bucket.index, wait_s=round(wait, 3))
+            self.waiting += 1
+            try:
+                await asyncio.sleep(wait)
+            finally:
+                self.waiting -= 1
+        return bucket
+
+    def stats(self) -> dict:
+        now = time.monotonic()
+        with self._lock:
+            return {
+                "keys": len(self.buckets),
+                "waiting": self.waiting,
+                "rejected": self.rejected,
+                "per_key": [
+                    {
+                        "index": b.index,
+                        "calls": b.calls,
+                        "errors": b.errors,
+                        "next_free_in": round(b.wait_time(now), 3),
+                    }
+                    for b in self.buckets
+                ],
+            }
+
+
+class SharedKeyScheduler(KeyScheduler):
+    """KeyScheduler whose bucket state lives in a SQLite file shared by processes.
+
+    Rows are keyed by a hash of the API key (the key itself is not stored),
+    so workers configured with the same keys share their budgets. Every
+    reservation runs `BEGIN IMMEDIATE` (takes the file's write lock, waiting
+    up to `busy_timeout`), refills and charges the soonest key, and commits.
+    Timestamps are wall-clock so that all processes agree on them.
+    """
+
+    def __init__(self, keys: List[str], path: str, cooldown_min: float = 6.0,
+                 cooldown_max: float = 8.0, burst: float = 1.0, busy_timeout: float = 5.0):
+        super().__init__(keys, cooldown_min, cooldown_max, burst)
+        self.path = path
+        self.key_ids = [hashlib.sha256(key.encode("utf-8")).hexdigest()[:16] for key in keys]
+        self.busy_timeout = busy_timeout
+        self._conn: Optional[sqlite3.Connection] = None
+        self._conn_pid = None
+        with self._lock:
+            self._connection().executemany(
+                "INSERT OR IGNORE INTO key_buckets (key_id, tokens, updated) VALUES (?, ?, ?)",
+                [(key_id, burst, time.time()) for key_id in self.key_ids],
+            )
+        # Time spent waiting for the database write lock (contention)
+        self.transactions = 0
+        self.lock_wait = 0.0
+        print(f" Shared key state: {path}")
+
+    def _connection(self) -> sqlite3.Connection:
+        """This process's connection (used under self._lock).
+
+        A connection must not be used across fork(), so a worker forked from
+        a process that already built the scheduler (prefork.py) opens its
+        own; the inherited one is left alone rather than closed.
+        """
+        if self._conn_pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=self.busy_timeout, isolation_level=None,
+                                   check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS key_buckets ("
+                " key_id TEXT PRIMARY KEY, tokens REAL NOT NULL,"
+                " updated REAL NOT NULL, calls INTEGER NOT NULL DEFAULT 0)"
+            )
+            self._conn, self._conn_pid = conn, os.getpid()
+        return self._conn
+
+    def _load(self):
+        """Read every bucket's state into self.buckets (inside a transaction)."""
+        placeholders = ",".join("?" * len(self.key_ids))
+        rows = self._connection().execute(
+            f"SELECT key_id, tokens, updated, calls FROM key_buckets WHERE key_id IN ({placeholders})",
+            self.key_ids,
+        ).fetchall()
+        state = {key_id: (tokens, updated, calls) for key_id, tokens, updated, calls in rows}
+        for bucket, key_id in zip(self.buckets, self.key_ids):
+            bucket.tokens, bucket.updated, bucket.calls = state[key_id]
+
+    def reserve(self, max_wait: Optional[float] = None) -> Optional[Tuple[KeyBucket, float]]:
+        cost = self._call_cost()
+        with self._lock:
+            conn = self._connection()
+            t0 = time.perf_counter()
+            conn.execute("BEGIN IMMEDIATE")
+            self.lock_wait += time.perf_counter() - t0
+            self.transactions += 1
+            try:
+                self._load()
+                now = time.time()
+                bucket = min(self.buckets, key=lambda b: b.wait_time(now))
+                if max_wait is not None and bucket.wait_time(now) > max_wait:
+                    conn.execute("ROLLBACK")
+                    self.rejected += 1
+                    return None
+                wait = bucket.reserve(now, cost)
+                conn.execute(
+                    "UPDATE key_buckets SET tokens = ?, updated = ?, calls = calls + 1"
+                    " WHERE key_id = ?",
+                    (bucket.tokens, bucket.updated, self.key_ids[bucket.index]),
+                )
+                conn.execute("COMMIT")
+                return bucket, wait
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+
+    async def acquire(self, max_wait: Optional[float] = None) -> Optional[KeyBucket]:
+        # Waiting for another process's lock must not stall the event loop
+        return await self._await_slot(await asyncio.to_thread(self.reserve, max_wait))
+
+    def stats(self) -> dict:
+        with self._lock:
+            conn = self._connection()
+            conn.execute("BEGIN")
+            try:
+                self._load()
+            finally:
+                conn.execute("COMMIT")
+            now = time.time()
+            return {
+                "keys": len(self.buckets),
+                "shared_state": self.path,
+                "waiting": self.waiting,
+                "rejected": self.rejected,
+                "transactions": self.transactions,
+                "lock_wait_s": round(self.lock_wait, 6),
+                "per_key": [
+                    {
+                        "index": b.index,
+                        "calls": b.calls,  # across all processes
+                        "errors": b.errors,
+                        "next_free_in": round(b.wait_time(now), 3),
+                    }
+                    for b in self.buckets
+                ],
+            }
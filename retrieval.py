@@ -0,0 +1,321 @@
+"""
+In-process exact top-k retrieval over a NumPy matrix.
+
+The scene corpus is small (one vector per scene), so an exact search is a
+single matmul. NumpyIndex loads every embedding from the Chroma collection
+once into a contiguous, L2-normalized float32 matrix and answers queries with
+`Q @ M.T` plus `argpartition`, skipping Chroma's client/SQLite/HNSW path.
+
+Results use the same dict shape as Phase4.retrieve_with_chroma:
+    {"id": str, "document": str, "metadata": dict, "distance": float}
+where distance is cosine distance (1 - similarity), matching the collection's
+"hnsw:space": "cosine" setting.
+
+Metadata filters (act range, acts, scenes, speakers) are translated into
+Chroma `where` clauses by filter_where(), or applied to the NumPy matrix as a
+pre-filtered row set, so filtered queries only score matching vectors.
+
+Also holds the second step of hierarchical retrieval: given the scenes chosen
+by the scene index, best_speeches() picks the speeches (from the Phase2 speech
+collection) most similar to the query inside those scenes.
+"""
+
+import json
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+
+SceneKey = Tuple[Optional[str], Any, Any]
+
+
+def normalize_rows(matrix: np.ndarray) -> np.ndarray:
+    matrix = np.ascontiguousarray(matrix, dtype=np.float32)
+    if matrix.ndim == 1:
+        matrix = matrix[None, :]
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+SPEAKER_FLAG_PREFIX = "speaker_"
+# Metadata Phase2 keeps for its own bookkeeping (sync hashes)
+INTERNAL_METADATA_KEYS = ("content_hash",)
+
+
+def speaker_flag(name: str) -> str:
+    """Scene metadata key marking that `name` speaks in the scene.
+
+    Chroma metadata values must be scalars, so Phase2 stores a scene's
+    speakers as one boolean per speaker.
+    """
+    return f"{SPEAKER_FLAG_PREFIX}{name.strip().upper()}"
+
+
+def public_metadata(meta: Dict[str, Any]) -> Dict[str, Any]:
+    """A passage's metadata as shown to clients: without the sync hash and
+    the per-speaker filter flags, which only the index needs."""
+    return {
+        key: value for key, value in meta.items()
+        if key not in INTERNAL_METADATA_KEYS and not key.startswith(SPEAKER_FLAG_PREFIX)
+    }
+
+
+def normalize_filters(filters: Optional[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+    """Drop unset fields and canonicalize; None when nothing is filtered.
+
+    Recognized keys: act_min, act_max (inclusive), acts, scenes (a list of
+    {"act", "scene"} dicts) and speakers.
+    """
+    if not filters:
+        return None
+    out = {}
+    for key in ("act_min", "act_max"):
+        if filters.get(key) is not None:
+            out[key] = filters[key]
+    if filters.get("acts"):
+        out["acts"] = sorted(set(filters["acts"]))
+    if filters.get("scenes"):
+        out["scenes"] = sorted({(s["act"], s["scene"]) for s in filters["scenes"]})
+    if filters.get("speakers"):
+        out["speakers"] = sorted({s.strip().upper() for s in filters["speakers"]})
+    return out or None
+
+
+def filters_key(filters: Optional[Dict[str, Any]]) -> str:
+    """Stable string for normalized filters (answer-cache scope)."""
+    return json.dumps(filters, sort_keys=True) if filters else ""
+
+
+def filter_where(filters: Optional[Dict[str, Any]], speech_level: bool = False
+                 ) -> Optional[Dict[str, Any]]:
+    """Chroma `where` clause for normalized filters.
+
+    Speech rows carry a scalar "speaker"; scene rows carry speaker flags.
+    """
+    if not filters:
+        return None
+    clauses = []
+    if "act_min" in filters:
+        clauses.append({"act": {"$gte": filters["act_min"]}})
+    if "act_max" in filters:
+        clauses.append({"act": {"$lte": filters["act_max"]}})
+    if "acts" in filters:
+        clauses.append({"act": {"$in": filters["acts"]}})
+    if "scenes" in filters:
+        clauses.append(scene_where([(None, act, scene) for act, scene in filters["scenes"]]))
+    if "speakers" in filters:
+        if speech_level:
+            clauses.append({"speaker": {"$in": filters["speakers"]}})
+        else:
+            flags = [{speaker_flag(name): True} for name in filters["speakers"]]
+            clauses.append(flags[0] if len(flags) == 1 else {"$or": flags})
+    return clauses[0] if len(clauses) == 1 else {"$and": clauses}
+
+
+def matches_filters(meta: Dict[str, Any], filters: Dict[str, Any]) -> bool:
+    """In-process equivalent of filter_where() for one metadata row."""
+    act = meta.get("act")
+    try:
+        if "act_min" in filters and not act >= filters["act_min"]:
+            return False
+        if "act_max" in filters and not act <= filters["act_max"]:
+            return False
+    except TypeError:
+        return False
+    if "acts" in filters and act not in filters["acts"]:
+        return False
+    if "scenes" in filters and (act, meta.get("scene")) not in filters["scenes"]:
+        return False
+    if "speakers" in filters:
+        if "speaker" in meta:
+            return meta["speaker"] in filters["speakers"]
+        return any(meta.get(speaker_flag(name)) for name in filters["speakers"])
+    return True
+
+
+def scene_key(meta: Dict[str, Any]) -> SceneKey:
+    """(play, act, scene) of a scene or speech row; play is None for one play."""
+    return (meta.get("play"), meta.get("act"), meta.get("scene"))
+
+
+def scene_where(keys: Sequence[SceneKey]) -> Dict[str, Any]:
+    """Chroma `where` clause matching rows from any of the given scenes."""
+    clauses = []
+    for play, act, scene in keys:
+        conds = [{"act": act}, {"scene": scene}]
+        if play is not None:
+            conds.append({"play": play})
+        clauses.append({"$and": conds})
+    return clauses[0] if len(clauses) == 1 else {"$or": clauses}
+
+
+def passages_for(query_embedding: np.ndarray, ids: List[str], embeddings: np.ndarray,
+                 documents: List[str], metadatas: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Passage dicts for known rows, with cosine distance to the query."""
+    if len(ids) == 0:
+        return []
+    sims = normalize_rows(embeddings) @ normalize_rows(query_embedding)[0]
+    return [
+        {"id": i, "document": doc, "metadata": meta or {}, "distance": float(1.0 - s)}
+        for i, doc, meta, s in zip(ids, documents, metadatas, sims)
+    ]
+
+
+def best_speeches(query_embedding: np.ndarray, ids: List[str], embeddings: np.ndarray,
+                  documents: List[str], metadatas: List[Dict[str, Any]],
+                  scenes: Sequence[SceneKey], per_scene: int) -> List[Dict[str, Any]]:
+    """Pick the `per_scene` speeches most similar to the query in each scene.
+
+    Scenes keep their retrieval order; speeches within a scene are returned in
+    play order (metadata "position") so the dialogue reads naturally.
+    """
+    if len(documents) == 0:
+        return []
+    query = normalize_rows(query_embedding)[0]
+    sims = normalize_rows(embeddings) @ query
+
+    by_scene: Dict[SceneKey, List[int]] = {}
+    for row, meta in enumerate(metadatas):
+        by_scene.setdefault(scene_key(meta), []).append(row)
+
+    passages = []
+    for key in scenes:
+        rows = by_scene.get(key, [])
+        top = sorted(rows, key=lambda r: -sims[r])[:per_scene]
+        top.sort(key=lambda r: metadatas[r].get("position", 0))
+        passages.extend(
+            {
+                "id": ids[r],
+                "document": documents[r],
+                "metadata": metadatas[r],
+                "distance": float(1.0 - sims[r]),
+            }
+            for r in top
+        )
+    return passages
+
+
+class NumpyIndex:
+    def __init__(self, ids: List[str], embeddings: np.ndarray, documents: List[str],
+                 metadatas: List[Optional[Dict[str, Any]]], fingerprint: Optional[str] = None):
+        if len(ids) != len(embeddings):
+            raise ValueError("ids and embeddings must have the same length")
+        self.ids = list(ids)
+        self.matrix = normalize_rows(embeddings)
+        self.documents = list(documents)
+        self.metadatas = [m or {} for m in metadatas]
+        self.fingerprint = fingerprint
+        self._scene_rows: Optional[Dict[SceneKey, np.ndarray]] = None
+        self._row_of = {doc_id: row for row, doc_id in enumerate(self.ids)}
+        self._filter_rows: Dict[str, np.ndarray] = {}
+
+    @classmethod
+    def from_collection(cls, collection, fingerprint: Optional[str] = None) -> "NumpyIndex":
+        """Load every vector, document and metadata row from a Chroma collection."""
+        return cls.from_rows(collection.get(include=["embeddings", "documents", "metadatas"]),
+                             fingerprint)
+
+    @classmethod
+    def from_rows(cls, data: Dict[str, Any], fingerprint: Optional[str] = None) -> "NumpyIndex":
+        """Build from a Chroma `get` result (ids, embeddings, documents, metadatas)."""
+        embeddings = np.asarray(data["embeddings"], dtype=np.float32)
+        index = cls(data["ids"], embeddings, data["documents"], data["metadatas"],
+                    fingerprint=fingerprint)
+        print(f" NumPy index: {len(index)} vectors x {index.matrix.shape[1]} dims "
+              f"({index.matrix.nbytes / 1024:.0f} KiB)")
+        return index
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def filtered_rows(self, filters: Optional[Dict[str, Any]]) -> Optional[np.ndarray]:
+        """Rows matching normalized filters (None = all rows); memoized per filter."""
+        if not filters:
+            return None
+        key = filters_key(filters)
+        rows = self._filter_rows.get(key)
+        if rows is None:
+            rows = np.array([r for r, meta in enumerate(self.metadatas)
+                             if matches_filters(meta, filters)], dtype=np.int64)
+            if len(self._filter_rows) >= 256:
+                self._filter_rows.clear()
+            self._filter_rows[key] = rows
+        return rows
+
+    def top_k(self, query_embeddings: np.ndarray, k: int, rows: Optional[np.ndarray] = None):
+        """Return (indices, similarities), both shaped (n_queries, k), best first.
+
+        With `rows`, only those rows are scored (a pre-filtered candidate set).
+        """
+        queries = normalize_rows(query_embeddings)
+        if rows is not None:
+            indices, sims = self._top_k(queries @ self.matrix[rows].T, k)
+            return rows[indices], sims
+        return self._top_k(queries @ self.matrix.T, k)
+
+    @staticmethod
+    def _top_k(sims: np.ndarray, k: int):
+        k = min(k, sims.shape[1])
+        if k <= 0:
+            empty = np.empty((sims.shape[0], 0))
+            return empty.astype(np.int64), empty
+
+        if k < sims.shape[1]:
+            part = np.argpartition(-sims, k - 1, axis=1)[:, :k]
+        else:
+            part = np.broadcast_to(np.arange(sims.shape[1]), sims.shape)
+        part_sims = np.take_along_axis(sims, part, axis=1)
+        order = np.argsort(-part_sims, axis=1)
+        return np.take_along_axis(part, order, axis=1), np.take_along_axis(part_sims, order, axis=1)
+
+    def query_many(self, query_embeddings: np.ndarray, k: int = 5,
+                   filters: Optional[Dict[str, Any]] = None) -> List[List[Dict[str, Any]]]:
+        """Top-k passages for each query row, optionally among filtered rows only."""
+        indices, sims = self.top_k(query_embeddings, k, self.filtered_rows(filters))
+        return [
+            [
+                {
+                    "id": self.ids[i],
+                    "document": self.documents[i],
+                    "metadata": self.metadatas[i],
+                    "distance": float(1.0 - s),
+                }
+                for i, s in zip(row_idx, row_sims)
+            ]
+            for row_idx, row_sims in zip(indices, sims)
+        ]
+
+    def query(self, query_embedding: np.ndarray, k: int = 5,
+              filters: Optional[Dict[str, Any]] = None) -> List[Dict[str, Any]]:
+        return self.query_many(query_embedding, k, filters)[0]
+
+    def get(self, ids: Sequence[str], query_embedding: np.ndarray) -> List[Dict[str, Any]]:
+        """Passages for the given ids (unknown ids are skipped), scored against the query."""
+        rows = [self._row_of[i] for i in ids if i in self._row_of]
+        return passages_for(query_embedding, [self.ids[r] for r in rows], self.matrix[rows],
+                            [self.documents[r] for r in rows], [self.metadatas[r] for r in rows])
+
+    def rows_for_scenes(self, scenes: Sequence[SceneKey]) -> np.ndarray:
+        """Row indices of every entry belonging to the given scenes."""
+        if self._scene_rows is None:
+            groups: Dict[SceneKey, List[int]] = {}
+            for row, meta in enumerate(self.metadatas):
+                groups.setdefault(scene_key(meta), []).append(row)
+            self._scene_rows = {k: np.asarray(v) for k, v in groups.items()}
+        parts = [self._scene_rows[k] for k in scenes if k in self._scene_rows]
+        return np.concatenate(parts) if parts else np.empty(0, dtype=np.int64)
+
+    def best_in_scenes(self, query_embedding: np.ndarray, scenes: Sequence[SceneKey],
+                       per_scene: int, filters: Optional[Dict[str, Any]] = None
+                       ) -> List[Dict[str, Any]]:
+        """Hierarchical step 2: best speeches inside already-chosen scenes."""
+        rows = self.rows_for_scenes(scenes)
+        allowed = self.filtered_rows(filters)
+        if allowed is not None:
+            rows = rows[np.isin(rows, allowed)]
+        return best_speeches(
+            query_embedding, [self.ids[r] for r in rows], self.matrix[rows],
+            [self.documents[r] for r in rows], [self.metadatas[r] for r in rows],
+            scenes, per_scene,
+        )
@@ -0,0 +1,81 @@
+"""
+Single-flight coalescing of identical in-flight work.
+
+When a popular question arrives in a burst, every copy would embed, retrieve
+and pay for its own LLM call (each one queuing behind the key cooldown). A
+SingleFlight group runs the work for a key once; callers that arrive with
+the same key while it is in flight await the same result instead:
+
+    flights = SingleFlight("query")
+    result, coalesced = await flights.do(key, lambda: answer(query))
+
+Nothing is remembered once the work finishes (that is the answer cache's
+job), and a failure is raised to every waiter, so the next request retries.
+The work runs as its own task: if the caller that started it disconnects,
+the callers attached to it still get the result.
+
+    SINGLE_FLIGHT  1 (default) to coalesce, 0 to run every request on its own
+"""
+
+import asyncio
+import os
+import re
+import threading
+from typing import Any, Awaitable, Callable, Dict, Hashable, Tuple, TypeVar
+
+
+T = TypeVar("T")
+
+SINGLE_FLIGHT = os.environ.get("SINGLE_FLIGHT", "1") != "0"
+
+_SPACES = re.compile(r"\s+")
+
+
+def normalize_query(query: str) -> str:
+    """Case- and whitespace-insensitive form of a query, for exact-match keys."""
+    return _SPACES.sub(" ", query).strip().casefold()
+
+
+class SingleFlight:
+    def __init__(self, name: str, enabled: bool = SINGLE_FLIGHT):
+        self.name = name
+        self.enabled = enabled
+        self._inflight: Dict[Hashable, "asyncio.Task"] = {}
+        self._lock = threading.Lock()
+
+        self.leaders = 0    # calls that ran the work
+        self.coalesced = 0  # calls that attached to one already in flight
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[T]]) -> Tuple[T, bool]:
+        """Return (fn() result, whether this call was coalesced onto another)."""
+        if not self.enabled:
+            return await fn(), False
+
+        task = self._inflight.get(key)
+        coalesced = task is not None
+        if coalesced:
+            with self._lock:
+                self.coalesced += 1
+        else:
+            task = asyncio.ensure_future(fn())
+            self._inflight[key] = task
+            task.add_done_callback(lambda done: self._finished(key, done))
+            with self._lock:
+                self.leaders += 1
+        # A cancelled caller must not cancel the work the others are waiting on
+        return await asyncio.shield(task), coalesced
+
+    def _finished(self, key: Hashable, task: "asyncio.Task"):
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+        if not task.cancelled():
+            task.exception()  # retrieved, even if every caller went away
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "enabled": self.enabled,
+                "in_flight": len(self._inflight),
+                "leaders": self.leaders,
+                "coalesced": self.coalesced,
+            }
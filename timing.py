@@ -0,0 +1,54 @@
+"""
+Per-request stage timing, reported in the standard Server-Timing header.
+
+Phase4 times each stage of a request and returns, e.g.:
+
+    Server-Timing: embed;dur=4.1, cache;dur=0.2, retrieve;dur=1.3,
+                   pack;dur=0.8, key_wait;dur=0.0, llm;dur=812.5, total;dur=819.4
+
+Clients (A2_evaluation.py, the load test) parse it back with
+parse_server_timing(). Durations are milliseconds.
+"""
+
+import time
+from contextlib import contextmanager
+from typing import Dict
+
+
+class StageTimer:
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.stages: Dict[str, float] = {}
+
+    def add(self, name: str, seconds: float):
+        self.stages[name] = self.stages.get(name, 0.0) + seconds * 1000
+
+    @contextmanager
+    def stage(self, name: str):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - t0)
+
+    def total_ms(self) -> float:
+        return (time.perf_counter() - self.start) * 1000
+
+    def header(self) -> str:
+        parts = [f"{name};dur={ms:.1f}" for name, ms in self.stages.items()]
+        parts.append(f"total;dur={self.total_ms():.1f}")
+        return ", ".join(parts)
+
+
+def parse_server_timing(value: str) -> Dict[str, float]:
+    """{stage: ms} from a Server-Timing header value (missing durations skipped)."""
+    timings = {}
+    for metric in (value or "").split(","):
+        name, *params = [p.strip() for p in metric.split(";")]
+        for param in params:
+            if param.startswith("dur="):
+                try:
+                    timings[name] = float(param[4:])
+                except ValueError:
+                    pass
+    return timings
@@ -0,0 +1,132 @@
+"""
+Pre-populate the persistent answer cache (ANSWER_CACHE_DB) offline.
+
+Runs each question through the same pipeline as /query (retrieval, packing,
+generation with the configured keys) without starting the server, so that
+after a deploy the common questions are answered from disk instead of
+paying LLM latency. Questions already stored for the current prompt, model
+and collection are skipped, so the command can be re-run after a prompt or
+index change, or on a schedule with the latest query log.
+
+    ANSWER_CACHE_DB=cache/answers.sqlite python warm_cache.py --queries evaluation.json
+    python warm_cache.py --db cache/answers.sqlite --queries query_log.jsonl --concurrency 4
+
+--queries takes evaluation.json, a JSONL query log ({"query", "k"?,
+"filters"?} per line) or a text file with one question per line. Answers
+that fall back to the local generator are not stored; KEY_WAIT_BUDGET
+defaults to 600 s here so the warm-up waits for keys instead. The in-memory
+semantic cache is off, so every question gets its own answer.
+"""
+
+import argparse
+import asyncio
+import importlib
+import json
+import os
+import time
+
+
+def load_queries(path: str):
+    """[{"query", "k"?, "filters"?}, ...] from evaluation.json or a query log."""
+    with open(path, "r", encoding="utf-8") as f:
+        text = f.read()
+
+    stripped = text.lstrip()
+    if stripped.startswith("["):
+        items = json.loads(text)
+    elif stripped.startswith("{"):
+        items = [json.loads(line) for line in text.splitlines() if line.strip()]
+    else:
+        items = [line.strip() for line in text.splitlines() if line.strip()]
+
+    queries = []
+    for item in items:
+        if isinstance(item, str):
+            queries.append({"query": item})
+            continue
+        query = {"query": item.get("query") or item.get("question")}
+        for field in ("k", "filters"):
+            if item.get(field) is not None:
+                query[field] = item[field]
+        if query["query"]:
+            queries.append(query)
+    if not queries:
+        raise ValueError(f"No queries found in {path}")
+    return queries
+
+
+async def warm(app, queries, default_k: int, concurrency: int):
+    from retrieval import normalize_filters
+
+    store = app.answer_store
+    await app.openrouter.start()
+    try:
+        await asyncio.to_thread(app.load_resources)
+        app.refresh_cache_fingerprint()
+        stores_before = store.stats()["stores"]
+
+        counts = {"asked": 0, "already_cached": 0, "answered": 0, "fallback": 0, "errors": 0}
+        semaphore = asyncio.Semaphore(max(1, concurrency))
+        started = time.perf_counter()
+
+        async def answer(item):
+            q = item["query"].strip()
+            k = int(item.get("k") or default_k)
+            filters = normalize_filters(item.get("filters"))
+            async with semaphore:
+                counts["asked"] += 1
+                if await app.lookup_stored_answer(q, k, filters) is not None:
+                    counts["already_cached"] += 1
+                    return
+                try:
+                    result, _ = await app.answer_query(q, k, filters)
+                except Exception as e:
+                    counts["errors"] += 1
+                    print(f"  error: {q[:60]!r}: {e}")
+                    return
+                counts["fallback" if result.fallback_reason else "answered"] += 1
+                done = counts["asked"]
+                if done % 10 == 0:
+                    print(f"  {done}/{len(queries)} ({time.perf_counter() - started:.0f}s)")
+
+        await asyncio.gather(*[answer(item) for item in queries])
+        store.flush()
+        counts["stored"] = store.stats()["stores"] - stores_before
+        counts["seconds"] = round(time.perf_counter() - started, 1)
+        return counts
+    finally:
+        if app.embedding_batcher is not None:
+            app.embedding_batcher.stop()
+        store.close()
+        await app.openrouter.aclose()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Warm the persistent answer cache")
+    parser.add_argument("--queries", default="evaluation.json",
+                        help="evaluation.json or a query log (JSON, JSONL or text)")
+    parser.add_argument("--db", default=None, help="cache file (default: ANSWER_CACHE_DB)")
+    parser.add_argument("--k", type=int, default=5, help="k for questions that do not set one")
+    parser.add_argument("--concurrency", type=int, default=4, help="questions in flight")
+    parser.add_argument("--app", default="Phase4", help="module with the /query pipeline")
+    args = parser.parse_args()
+
+    if args.db:
+        os.environ["ANSWER_CACHE_DB"] = args.db
+    if not os.environ.get("ANSWER_CACHE_DB"):
+        parser.error("set ANSWER_CACHE_DB or pass --db")
+    os.environ.setdefault("KEY_WAIT_BUDGET", "600")
+    # A semantic (near-duplicate) hit would answer a question without storing it
+    os.environ.setdefault("ANSWER_CACHE_SIZE", "0")
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+
+    queries = load_queries(args.queries)
+    print(f"{len(queries)} queries from {args.queries}")
+    # Imported only now, so the settings above are seen at import time
+    app = importlib.import_module(args.app)
+    counts = asyncio.run(warm(app, queries, args.k, args.concurrency))
+    print(" ".join(f"{name}={value}" for name, value in counts.items()))
+
+
+if __name__ == "__main__":
+    main()